@@ -1,13 +1,20 @@
 from config import BM25_B
 import pickle
-from transform import transform
+from transform import tokenizer, transform
 from config import BM25_K1
+from bm25_engine import BM25Engine, CorpusStats
+from index_store import DELTA_PATH, INDEX_PATH, PICKLE_PATHS, open_index, read_manifest, remove_deltas, write_index, write_manifest
+from segments import Segment, SegmentedDocMap, merge_segments
+from tracing import span
 from collections import Counter
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-import math
+import hashlib
+import numpy as np
 import os
 import pickle
+import time
 
 class InvertedIndex:
 
@@ -16,11 +23,20 @@ class InvertedIndex:
         self.docmap = {}
         self.term_frequencies = defaultdict(Counter)   
         self.doc_length = {}  
+        self.engine = None
+
+        # the index is a base segment plus delta segments written by commit().
+        # docs added since the last commit live in `tail`, a small in-memory index.
+        self.segments = []
+        self.tail = None
+        self.tail_segment = None
+        self.next_delta = 1
+        # hash of the docs of the last sync, None once the index was changed any other way.
+        self.corpus_hash = None
 
     # inverted idex is built here individually for each doc.
-    # this private func is called iteratively for each doc.
-    def __add_document(self, doc_id, text):
-        token_list = transform(text)
+    # this private func is called iteratively for each doc, with its already tokenized text.
+    def __add_document(self, doc_id, token_list):
         for token in token_list:
             if not token:
                 continue
@@ -29,12 +45,13 @@ class InvertedIndex:
         self.doc_length[doc_id] = len(token_list)
         self.term_frequencies[doc_id].update(token_list)
 
-    # get a average doc length by dividing the sum of the lengths of all the docs.
-    # by the total number of the docs indexed.
-    def __get_avg_doc_length(self) -> float:
-        if len(self.doc_length) == 0:
-            return 0.0
-        return sum(self.doc_length.values()) / len(self.doc_length)
+    def __remove_document(self, doc_id):
+        for token in self.term_frequencies.pop(doc_id):
+            self.index[token].discard(doc_id)
+            if not self.index[token]:
+                del self.index[token]
+        del self.doc_length[doc_id]
+        del self.docmap[doc_id]
 
 #-----------------------------------------------------------------------------
     # this func gets the tf for a given term and a doc.
@@ -42,18 +59,27 @@ class InvertedIndex:
         final_token = transform(term)
         try: 
             if final_token and len(final_token) == 1:
-                return self.term_frequencies[doc_id][final_token[0]]
+                segment, _ = self.find_document(doc_id)
+                return 0 if segment is None else segment.engine.tf(doc_id, final_token[0])
             raise ValueError(f"Term must be a single word, got: '{term}'")
 
         except Exception as e:
             print(e)
 
+    # number of docs a single word term appears in.
+    def get_df(self, term):
+        token = transform(term)
+        if token and len(token) == 1:
+            return self.corpus_stats(token).df[token[0]]
+        raise ValueError(f"Single Token is expected!")
+
     # b is for length normalization, higher doc length than average gets penalized more.
     # k1 is term frequency satu. lower k1 means diminishing returns for persistent occurances.
     # basically bm25tf applies length norm, and freq satu on the regular tf.
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         raw_tf = self.get_tf(doc_id, term)
-        length_norm = 1 - b + b * (self.doc_length[doc_id] / self.__get_avg_doc_length())
+        segment, pos = self.find_document(doc_id)
+        length_norm = 1 - b + b * (segment.engine.doc_len[pos] / self.corpus_stats([]).avgdl)
         return (raw_tf * (k1 + 1)) / (raw_tf + k1 * length_norm)
 
     # it calculates the score based on how rare the term is among the docs.
@@ -62,7 +88,7 @@ class InvertedIndex:
     def get_bm25_idf(self, term) -> float:
         token = transform(term)
         if token and len(token) == 1:
-            return math.log((len(self.docmap) - len(self.index[token[0]]) + 0.5) / (len(self.index[token[0]]) + 0.5) + 1)
+            return self.corpus_stats(token).idf(token[0])
         raise ValueError(f"Single Token is expected!")
     
     # both are multiplied to get the bm25 score.
@@ -71,66 +97,269 @@ class InvertedIndex:
         bm25_idf = self.get_bm25_idf(term)
         return bm25_tf * bm25_idf
     
-    # this func tokenizes each term in the query, and runs the bm25 func.
-    # then adds to a dict then sorts it in the descending order and return it.
-    def bm25_search(self, query, limit=5):
-        tokenized_query = transform(query)
-        score_dict = defaultdict(float)
+    # this func tokenizes the query once and lets the engine score all postings of it with array ops.
+    # the tokens are stemmed once, like the docs were. scoring term by term through bm25() stemmed
+    # them again, and Porter stems are not stable ("agreed" -> agre -> agr).
+    # returns a dict of doc_id -> score in the descending order.
+    # with prune the engine skips postings that cannot change the top `limit`,
+    # self.engine.stats counts the postings evaluated and skipped.
+    # once docs were added or deleted after the build, every segment is scored with
+    # the N, avgdl and df of the whole live corpus and the per segment results are merged.
+    def bm25_search(self, query, limit=5, k1=BM25_K1, b=BM25_B, prune=True):
+        with span("tokenize"):
+            tokens = transform(query)
+        with span("score"):
+            segments = self.live_segments()
+            if len(segments) == 1 and len(segments[0].deleted) == 0:
+                return segments[0].engine.search(tokens, limit, k1, b, prune)
+
+            stats = self.corpus_stats(tokens)
+            results = {}
+            for segment in segments:
+                results.update(segment.search(tokens, limit, k1, b, prune, stats))
+            return dict(sorted(results.items(), key=lambda item: (-item[1], item[0]))[:limit])
 
-        for term in tokenized_query:
-            doc_set = self.index[term]
-            for doc_id in doc_set:
-                score_dict[doc_id] += self.bm25(doc_id, term)
+    # N, avgdl and the df of the given terms over the live docs of all segments.
+    def corpus_stats(self, tokens):
+        segments = self.live_segments()
+        n_docs = sum(segment.live_count for segment in segments)
+        total_length = sum(segment.live_length for segment in segments)
+        df = {token: sum(segment.df(token) for segment in segments) for token in set(tokens)}
+        return CorpusStats(n_docs, total_length / n_docs if n_docs else 0.0, df)
 
-        return dict(sorted(score_dict.items(), key=lambda item: item[1], reverse=True)[:limit])
+    # avgdl, idf and the postings arrays are fixed here, after build.
+    def build_engine(self):
+        self.__set_base(BM25Engine.from_index(self.index, self.term_frequencies, self.doc_length), self.docmap)
+
+    def __set_base(self, engine, docmap):
+        self.engine = engine
+        self.segments = [Segment(engine, docmap, INDEX_PATH)]
+        self.tail = None
+        self.tail_segment = None
+        self.docmap = SegmentedDocMap(self.live_segments)
+
+    # the committed segments, plus the uncommitted docs as one more segment.
+    def live_segments(self):
+        if self.tail is None or not self.tail.doc_length:
+            return self.segments
+        if self.tail_segment is None:
+            engine = BM25Engine.from_index(self.tail.index, self.tail.term_frequencies, self.tail.doc_length)
+            self.tail_segment = Segment(engine, dict(self.tail.docmap))
+        return self.segments + [self.tail_segment]
+
+    # the segment holding the live copy of a doc, and its position there.
+    def find_document(self, doc_id):
+        for segment in reversed(self.live_segments()):
+            pos = segment.position(doc_id)
+            if pos is not None:
+                return segment, pos
+        return None, None
 
 
 #-----------------------------------------------------------------------------
 
     def get_document(self, term):
-        return sorted(self.index[term.lower()])
-        
+        doc_ids = []
+        for segment in self.live_segments():
+            doc_idx, _ = segment.engine.postings(term.lower())
+            live = np.isin(doc_idx, segment.deleted, invert=True)
+            doc_ids.extend(segment.engine.doc_ids[doc_idx[live]].tolist())
+        return sorted(doc_ids)
+
+    # writes a freshly built index as the new base, any older delta segments are dropped.
+    # changes made after that are written by commit().
     def save(self):
-        os.makedirs("cache", exist_ok=True)
         try:
-            with open("cache/index.pkl", "wb") as f:
-                pickle.dump(self.index, f)
-            
-            with open("cache/docmap.pkl", "wb") as f:
-                pickle.dump(self.docmap, f)
+            remove_deltas()
+            write_index(INDEX_PATH, self.engine, self.docmap)
+        except Exception as e:
+            print(e)
 
-            with open("cache/term_frequencies.pkl", "wb") as f:
-                pickle.dump(self.term_frequencies, f)
+    # the index files are memory mapped, so loading is constant time,
+    # and postings are only read from disk when a query touches them.
+    # an old pickle cache is converted on the first load.
+    def load(self):
+        try:
+            if not os.path.exists(INDEX_PATH) and os.path.exists(PICKLE_PATHS[0]):
+                print(f"Converting pickle cache to {INDEX_PATH}")
+                self.load_pickles()
+                self.save()
 
-            with open("cache/doc_lengths.pkl", "wb") as f:
-                pickle.dump(self.doc_length ,f)
+            manifest = read_manifest()
+            self.segments = []
+            for entry in manifest["segments"]:
+                engine, docmap = open_index(entry["path"])
+                self.segments.append(Segment(engine, docmap, entry["path"], entry["deleted"]))
+            self.engine = self.segments[0].engine
+            self.next_delta = manifest["next_delta"]
+            self.corpus_hash = manifest.get("corpus_hash")
+            self.docmap = SegmentedDocMap(self.live_segments)
 
         except Exception as e:
             print(e)
 
-    def load(self):
-        try:
+    # reads the old four pickle cache, kept for the conversion to the index file.
+    def load_pickles(self):
+        index_path, docmap_path, tf_path, doc_length_path = PICKLE_PATHS
 
-            with open("cache/index.pkl", "rb") as f:
-                self.index = pickle.load(f)
+        with open(index_path, "rb") as f:
+            self.index = pickle.load(f)
 
-            with open("cache/docmap.pkl", "rb") as f:
-                self.docmap = pickle.load(f)
+        with open(docmap_path, "rb") as f:
+            self.docmap = pickle.load(f)
 
-            with open("cache/term_frequencies.pkl", "rb") as f:
-                self.term_frequencies = pickle.load(f)
+        with open(tf_path, "rb") as f:
+            self.term_frequencies = pickle.load(f)
 
-            with open("cache/doc_lengths.pkl", "rb") as f:
-                self.doc_length = pickle.load(f)
+        with open(doc_length_path, "rb") as f:
+            self.doc_length = pickle.load(f)
 
-        except Exception as e:
-            print(e)
+        self.build_engine()
 
 #-----------------------------------------------------------------------------
     # it build the inverted index iteravtively.
-    def build(self, movies):
-        for each in movies["movies"]:
-            self.__add_document(each["id"], f"{each['title']} {each['description']}")
-        for each in movies["movies"]:
+    # with workers > 1 the docs are split into contiguous shards, each worker process
+    # tokenizes and indexes its shard, and the shards are merged back in order,
+    # so the result is the same as the serial build.
+    # time spent per phase is kept in self.build_stats.
+    def build(self, movies, workers=1):
+        docs = movies["movies"]
+        self.build_stats = {}
+
+        start = time.perf_counter()
+        if workers > 1 and len(docs) > 1:
+            size = max(1, -(-len(docs) // (workers * SHARDS_PER_WORKER)))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                shards = list(pool.map(index_shard, [docs[i:i + size] for i in range(0, len(docs), size)]))
+            self.build_stats["index"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for shard in shards:
+                self.__merge_shard(*shard)
+            self.build_stats["merge"] = time.perf_counter() - start
+        else:
+            self.index_documents(docs)
+            self.build_stats["index"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for each in docs:
             self.docmap[each["id"]] = each
+        self.build_engine()
+        self.build_stats["engine"] = time.perf_counter() - start
+
+    # all the docs are tokenized in one batch, then added one by one.
+    def index_documents(self, docs):
+        texts = [f"{each['title']} {each['description']}" for each in docs]
+        for each, token_list in zip(docs, tokenizer.transform_many(texts)):
+            self.__add_document(each["id"], token_list)
+
+    # merging a shard does what __add_document did for each of its docs.
+    def __merge_shard(self, index, term_frequencies, doc_length):
+        for token, doc_set in index.items():
+            self.index[token] |= doc_set
+        for doc_id, counts in term_frequencies.items():
+            self.term_frequencies[doc_id].update(counts)
+        self.doc_length.update(doc_length)
+
+
+#-----------------------------------------------------------------------------
+    # add, update and delete are visible to searches right away.
+    # commit() writes the added docs as one small delta segment and the deletes as tombstones,
+    # so applying a few changes never re-tokenizes the corpus.
+    def add_document(self, doc):
+        if self.is_indexed(doc["id"]):
+            raise ValueError(f"Document {doc['id']} is already indexed, use update_document")
+        if self.tail is None:
+            self.tail = InvertedIndex()
+        self.tail.__add_document(doc["id"], transform(f"{doc['title']} {doc['description']}"))
+        self.tail.docmap[doc["id"]] = doc
+        self.tail_segment = None
+        self.corpus_hash = None
+
+    def update_document(self, doc):
+        self.delete_document(doc["id"])
+        self.add_document(doc)
+
+    def delete_document(self, doc_id):
+        self.corpus_hash = None
+        if self.tail is not None and doc_id in self.tail.doc_length:
+            self.tail.__remove_document(doc_id)
+            self.tail_segment = None
+            return
+        for segment in self.segments:
+            if segment.delete(doc_id):
+                return
+        raise KeyError(f"Document {doc_id} is not indexed")
+
+    # checks the committed segments and the tail without rebuilding the tail engine.
+    def is_indexed(self, doc_id):
+        if self.tail is not None and doc_id in self.tail.doc_length:
+            return True
+        return any(segment.position(doc_id) is not None for segment in self.segments)
+
+    # brings the index in line with the given docs, only the docs that changed are touched.
+    # returns how many docs were added, updated or deleted. the hash of the docs is kept in the
+    # manifest, so docs the index was already synced with are not compared doc by doc again.
+    def sync(self, documents):
+        corpus_hash = documents_hash(documents)
+        if corpus_hash == self.corpus_hash:
+            return 0
+
+        doc_ids = {doc["id"] for doc in documents}
+        upserts = [doc for doc in documents if self.docmap.get(doc["id"]) != doc]
+        deletes = [doc_id for doc_id in self.docmap if doc_id not in doc_ids]
+
+        for doc in upserts:
+            if self.is_indexed(doc["id"]):
+                self.update_document(doc)
+            else:
+                self.add_document(doc)
+        for doc_id in deletes:
+            self.delete_document(doc_id)
+
+        self.corpus_hash = corpus_hash
+        self.commit()
+        return len(upserts) + len(deletes)
+
+    def commit(self):
+        if self.tail is not None and self.tail.doc_length:
+            segment = self.live_segments()[-1]
+            segment.path = DELTA_PATH.format(self.next_delta)
+            self.next_delta += 1
+            write_index(segment.path, segment.engine, segment.docmap)
+            self.segments.append(segment)
+            self.tail = None
+            self.tail_segment = None
+        write_manifest(self.segments, self.next_delta, self.corpus_hash)
+
+        if len(self.segments) > MAX_SEGMENTS:
+            self.compact()
+
+    # merges every segment into a new base without the deleted docs.
+    def compact(self):
+        engine = merge_segments(self.live_segments())
+        write_index(INDEX_PATH, engine, self.docmap)
+        remove_deltas()
+        self.__set_base(*open_index(INDEX_PATH))
+        self.next_delta = 1
+        if self.corpus_hash is not None:
+            write_manifest(self.segments, self.next_delta, self.corpus_hash)
+
+
+SHARDS_PER_WORKER = 4
+
+# commit() compacts once there are more segments than this.
+MAX_SEGMENTS = 8
+
+
+# a hash of the docs, changed by any edit to any of them. pickle is a few times faster than json here,
+# equal docs with their keys in another order only hash differently, which costs one full sync.
+def documents_hash(documents):
+    return hashlib.blake2b(pickle.dumps(documents, protocol=5), digest_size=16).hexdigest()
+
 
+# runs in a worker process, builds the dicts of one shard of docs.
+def index_shard(docs):
+    shard = InvertedIndex()
+    shard.index_documents(docs)
+    return shard.index, shard.term_frequencies, shard.doc_length
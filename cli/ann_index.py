@@ -0,0 +1,87 @@
+import numpy as np
+import os
+
+# training k-means on every vector is wasted work, this many per list is plenty.
+TRAIN_POINTS_PER_LIST = 256
+# rows scored per matmul while assigning vectors, bounds the memory of the score block.
+ASSIGN_BATCH = 65536
+
+
+class IVFIndex:
+    """Inverted file index over unit length vectors.
+
+    Spherical k-means splits the vectors into `n_lists` lists around their
+    centroids. A query is compared with the centroids and only the rows of the
+    `nprobe` closest lists become candidates, which the caller scores exactly
+    against the real vectors. More lists probed means higher recall and more work.
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows, n_vectors):
+        self.centroids = centroids
+        # rows of list l are list_rows[list_offsets[l]:list_offsets[l + 1]]
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.n_vectors = n_vectors
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_iter=10, seed=0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+
+        sample = vectors
+        if len(vectors) > n_lists * TRAIN_POINTS_PER_LIST:
+            sample = vectors[rng.choice(len(vectors), n_lists * TRAIN_POINTS_PER_LIST, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = assign(sample, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            order = np.argsort(assignment, kind="stable")
+            sums = np.zeros_like(centroids)
+            starts = np.r_[0, np.cumsum(counts)[:-1]][counts > 0]
+            sums[counts > 0] = np.add.reduceat(sample[order], starts)
+            # an empty list gets a random point, so every list keeps being used.
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.divide(sums, norms, out=np.zeros_like(sums), where=norms > 0)
+
+        assignment = assign(vectors, centroids)
+        list_rows = np.argsort(assignment, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+        return cls(centroids, list_offsets, list_rows, len(vectors))
+
+    # sorted rows of the `nprobe` lists whose centroids are closest to the query.
+    def candidates(self, query, nprobe):
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        closest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = [self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in closest.tolist()]
+        return np.sort(np.concatenate(rows))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_rows=self.list_rows, n_vectors=np.array(self.n_vectors))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"], int(data["n_vectors"]))
+
+
+# list of every vector: the centroid with the highest dot product.
+def assign(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH):
+        assignment[start:start + ASSIGN_BATCH] = np.argmax(vectors[start:start + ASSIGN_BATCH] @ centroids.T, axis=1)
+    return assignment
+
+
+# share of the exact top-k ids that the approximate top-k found.
+def recall_at_k(approx_ids, exact_ids):
+    if not exact_ids:
+        return 1.0
+    return len(set(approx_ids) & set(exact_ids)) / len(exact_ids)
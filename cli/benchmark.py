@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+# Benchmarks the builds and every search mode on synthetic corpora of growing size, offline:
+# the movies come from a seeded generator and the embeddings from a hashing stub model.
+# Every size runs in a fresh interpreter, for its own peak RSS, inside a temporary
+# working directory, for its own cache/. The results are JSON, so runs of different
+# commits can be compared with --compare.
+
+DEFAULT_SIZES = "1k,10k"
+N_QUERIES = 100
+# queries run before the timed ones, they pay for the lazy imports and loads.
+WARMUP_QUERIES = 5
+LIMIT = 10
+STUB_DIM = 384
+VOCABULARY_SIZE = 20000
+SEED = 0
+PERCENTILES = (50, 95, 99)
+SEARCH_MODES = ("bm25", "semantic", "chunks", "weighted", "rrf")
+
+SYLLABLES = ["ba", "ko", "ri", "ten", "mar", "lo", "sin", "da", "ve", "qui", "nor", "pel", "ast", "zu", "fen", "oli",
+             "tra", "gem", "hol", "iru", "cas", "dor", "eb", "wyn", "sa", "tho", "ul", "mi", "rek", "ga"]
+
+
+class StubModel:
+    """Offline stand-in for the SentenceTransformer: a signed feature hashing bag of words.
+
+    Texts that share words get similar vectors, so the rankings are as
+    meaningful to time as real ones, and no weights are downloaded.
+    """
+
+    def __init__(self, dim=STUB_DIM):
+        self.dim = dim
+        self.features = {}
+
+    def feature(self, word):
+        feature = self.features.get(word)
+        if feature is None:
+            h = zlib.crc32(word.encode())
+            feature = self.features[word] = (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+        return feature
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                column, sign = self.feature(word.strip(".,!?"))
+                vectors[row, column] += sign
+        return vectors
+
+
+# made up words, the same for a seed.
+def make_vocabulary(size, rng):
+    vocabulary = []
+    seen = set()
+    while len(vocabulary) < size:
+        word = "".join(SYLLABLES[i] for i in rng.integers(0, len(SYLLABLES), rng.integers(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+# word frequencies follow Zipf's law like real text, so postings lists are as skewed.
+def zipf_weights(size):
+    weights = 1.0 / np.arange(1, size + 1) ** 1.1
+    return weights / weights.sum()
+
+
+def generate_movies(n, seed=SEED):
+    """n movies in the movies.json schema, the same ones for a seed: a title of 1-4 words
+    and a description of 3-8 sentences of 5-14 words."""
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(VOCABULARY_SIZE, rng)
+    weights = zipf_weights(len(vocabulary))
+
+    title_lengths = rng.integers(1, 5, n)
+    title_words = rng.choice(len(vocabulary), title_lengths.sum(), p=weights)
+    sentence_counts = rng.integers(3, 9, n)
+    sentence_lengths = rng.integers(5, 15, sentence_counts.sum())
+    words = rng.choice(len(vocabulary), sentence_lengths.sum(), p=weights)
+    endings = rng.choice([".", ".", ".", "?", "!"], len(sentence_lengths))
+
+    movies = []
+    title_start = word_start = sentence = 0
+    for i in range(n):
+        title = " ".join(vocabulary[w].capitalize() for w in title_words[title_start:title_start + title_lengths[i]])
+        title_start += title_lengths[i]
+        sentences = []
+        for _ in range(sentence_counts[i]):
+            text = " ".join(vocabulary[w] for w in words[word_start:word_start + sentence_lengths[sentence]])
+            word_start += sentence_lengths[sentence]
+            sentences.append(text.capitalize() + endings[sentence])
+            sentence += 1
+        movies.append({"id": i + 1, "title": title, "description": " ".join(sentences)})
+    return movies
+
+
+# queries of 1-3 words, skipping the most frequent words that would match nearly everything.
+def generate_queries(n, seed=SEED):
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(VOCABULARY_SIZE, rng)
+    weights = zipf_weights(len(vocabulary))
+    weights[:50] = 0
+    weights /= weights.sum()
+    rng = np.random.default_rng(seed + 1)
+    return [" ".join(vocabulary[w] for w in rng.choice(len(vocabulary), rng.integers(1, 4), p=weights)) for _ in range(n)]
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    for suffix, factor in (("k", 1000), ("m", 1000000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def latency_stats(seconds):
+    ms = np.array(seconds) * 1000
+    stats = {f"p{p}_ms": float(np.percentile(ms, p)) for p in PERCENTILES}
+    stats.update(mean_ms=float(ms.mean()), max_ms=float(ms.max()))
+    return stats
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def run_size(size, n_queries, limit, dim):
+    """Builds everything for a corpus of `size` in the current directory and times the searches."""
+    from hybrid_search import HybridSearch
+    from InvertedIndex import InvertedIndex
+    from query_cache import QueryEmbeddingCache
+    from semantic_search import MODEL_NAME, ChunkedSemanticSearch, SemanticSearch
+
+    result = {"size": size, "build_s": {}}
+    start = time.perf_counter()
+    documents = generate_movies(size)
+    result["generate_s"] = time.perf_counter() - start
+    model = StubModel(dim)
+
+    index = InvertedIndex()
+    result["build_s"]["index"] = timed(index.build, {"movies": documents})
+    result["build_s"]["index_save"] = timed(index.save)
+
+    # every query pays for its encode, the query caches would otherwise answer the later modes.
+    semantic = SemanticSearch(query_cache_path=None)
+    semantic._model = model
+    semantic.query_cache = QueryEmbeddingCache(MODEL_NAME, max_size=0)
+    result["build_s"]["embeddings"] = timed(semantic.build_embeddings, documents)
+    chunked = ChunkedSemanticSearch(query_cache_path=None)
+    chunked._model = model
+    chunked.query_cache = QueryEmbeddingCache(MODEL_NAME, max_size=0)
+    result["build_s"]["chunk_embeddings"] = timed(chunked.build_chunk_embeddings, documents)
+    result["cache_bytes"] = directory_bytes("cache")
+    result["build_peak_rss_mb"] = peak_rss_mb()
+
+    start = time.perf_counter()
+    hybrid = HybridSearch(documents)
+    result["hybrid_load_s"] = time.perf_counter() - start
+    hybrid.semantic_search._model = model
+    hybrid.semantic_search.query_cache = QueryEmbeddingCache(MODEL_NAME, max_size=0)
+
+    searches = {
+        "bm25": lambda query: hybrid.idx.bm25_search(query, limit),
+        "semantic": lambda query: semantic.search(query, limit),
+        "chunks": lambda query: chunked.search_chunks(query, limit),
+        "weighted": lambda query: hybrid.weighted_search(query, 0.5, limit),
+        "rrf": lambda query: hybrid.rrf_search(query, 60, limit),
+    }
+    queries = generate_queries(WARMUP_QUERIES + n_queries)
+    result["queries"] = {}
+    for mode in SEARCH_MODES:
+        for query in queries[:WARMUP_QUERIES]:
+            searches[mode](query)
+        result["queries"][mode] = latency_stats([timed(searches[mode], query) for query in queries[WARMUP_QUERIES:]])
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+# runs one size in a fresh interpreter inside its own working directory.
+def run_child(size, args):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--child", str(size),
+                   "--queries", str(args.queries), "--limit", str(args.limit), "--dim", str(args.dim)]
+        proc = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+        lines = proc.stdout.strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            return {"size": size, "error": (proc.stderr.strip().splitlines() or ["no output"])[-1]}
+        return json.loads(lines[-1])
+    finally:
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    return proc.stdout.strip() or None
+
+
+def print_result(result):
+    if "error" in result:
+        print(f"{result['size']:>9} docs  failed: {result['error']}")
+        return
+    builds = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in result["build_s"].items())
+    print(f"{result['size']:>9} docs  build: {builds}")
+    print(f"{'':>15}cache {result['cache_bytes'] / 1e6:.1f} MB, peak RSS {result['peak_rss_mb']:.0f} MB "
+          f"(builds {result['build_peak_rss_mb']:.0f} MB), hybrid load {result['hybrid_load_s']:.2f}s")
+    for mode, stats in result["queries"].items():
+        print(f"{'':>15}{mode:<9} p50 {stats['p50_ms']:8.2f} ms   p95 {stats['p95_ms']:8.2f} ms   p99 {stats['p99_ms']:8.2f} ms")
+
+
+# the metrics of two runs side by side, the relative change flagged past `threshold`.
+def compare(baseline, report, threshold):
+    old_results = {result["size"]: result for result in baseline["results"] if "error" not in result}
+    print(f"Compared with {baseline.get('commit')} (regressions over {threshold:.0%} marked with !)")
+    for result in report["results"]:
+        old = old_results.get(result["size"])
+        if old is None or "error" in result:
+            continue
+        metrics = [(f"build {name}", old["build_s"].get(name), seconds) for name, seconds in result["build_s"].items()]
+        metrics += [(f"{mode} p95", old["queries"].get(mode, {}).get("p95_ms"), stats["p95_ms"]) for mode, stats in result["queries"].items()]
+        metrics += [("peak RSS", old["peak_rss_mb"], result["peak_rss_mb"]), ("cache MB", old["cache_bytes"] / 1e6, result["cache_bytes"] / 1e6)]
+        for name, before, after in metrics:
+            if not before:
+                continue
+            change = after / before - 1
+            mark = "!" if change > threshold else " "
+            print(f"{mark} {result['size']:>9} docs  {name:<24} {before:12.2f} -> {after:12.2f}  ({change:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query benchmarks on synthetic corpora, offline")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Corpus sizes, e.g. 1k,10k,100k,1m (default: {DEFAULT_SIZES})")
+    parser.add_argument("--queries", type=int, default=N_QUERIES, help=f"Timed queries per search mode (default: {N_QUERIES})")
+    parser.add_argument("--limit", type=int, default=LIMIT, help=f"Results per query (default: {LIMIT})")
+    parser.add_argument("--dim", type=int, default=STUB_DIM, help=f"Dimensions of the stub embeddings (default: {STUB_DIM})")
+    parser.add_argument("--output", type=str, help="Also write the results as JSON to this file")
+    parser.add_argument("--compare", type=str, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression (default: 0.1)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories of the sizes")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_size(args.child, args.queries, args.limit, args.dim)))
+        return
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"queries": args.queries, "limit": args.limit, "dim": args.dim, "seed": SEED},
+        "results": [],
+    }
+    for size in [parse_size(size) for size in args.sizes.split(",")]:
+        result = run_child(size, args)
+        report["results"].append(result)
+        if not args.json:
+            print_result(result)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+from config import BM25_K1, BM25_B
+from collections import Counter
+
+import numpy as np
+
+# relative slack on the upper bound checks, so float rounding in the sums can never prune a real top-k doc.
+PRUNE_SLACK = 1e-9
+
+
+class BM25Engine:
+    """Vectorized BM25 scorer over CSR-style postings.
+
+    Postings of the term with row `t` in the vocabulary live in
+    `post_doc_idx[offsets[t]:offsets[t + 1]]` (dense doc positions, ascending)
+    with the matching term frequencies in `post_tf`. `doc_ids` is sorted, so
+    doc position i always refers to `doc_ids[i]` and `doc_len[i]`.
+    N, avgdl and IDF are fixed when the engine is created, so a query only
+    touches the postings of its own terms.
+
+    `max_score[t]` is the highest bm25 contribution term t can give to any doc
+    with the default k1/b. search() uses it to stop scoring docs that can no
+    longer reach the top `limit` (MaxScore); `stats` counts how many postings
+    were scored vs. skipped that way.
+    """
+
+    def __init__(self, vocab, offsets, post_doc_idx, post_tf, doc_ids, doc_len, max_score=None):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.post_doc_idx = post_doc_idx
+        self.post_tf = post_tf
+        self.doc_ids = doc_ids
+        self.doc_len = doc_len
+
+        self.n_docs = len(doc_ids)
+        self.avgdl = float(doc_len.sum()) / self.n_docs if self.n_docs else 0.0
+        df = np.diff(offsets)
+        self.idf = np.log((self.n_docs - df + 0.5) / (df + 0.5) + 1)
+
+        self.max_score_cache = {}
+        if max_score is not None:
+            self.max_score_cache[(BM25_K1, BM25_B)] = max_score
+        self.stats = Counter()
+
+    # turns the dict based structures of InvertedIndex into flat arrays.
+    # terms and docs are both sorted so the layout is deterministic.
+    @classmethod
+    def from_index(cls, index, term_frequencies, doc_length):
+        doc_ids = np.array(sorted(doc_length), dtype=np.int64)
+        doc_pos = {doc_id: i for i, doc_id in enumerate(doc_ids.tolist())}
+        doc_len = np.array([doc_length[doc_id] for doc_id in doc_ids.tolist()], dtype=np.int32)
+
+        terms = sorted(term for term, doc_set in index.items() if doc_set)
+        vocab = {term: i for i, term in enumerate(terms)}
+
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(index[term]) for term in terms])
+
+        post_doc_idx = np.empty(offsets[-1], dtype=np.int32)
+        post_tf = np.empty(offsets[-1], dtype=np.int32)
+        for t, term in enumerate(terms):
+            ids = sorted(index[term])
+            post_doc_idx[offsets[t]:offsets[t + 1]] = [doc_pos[doc_id] for doc_id in ids]
+            post_tf[offsets[t]:offsets[t + 1]] = [term_frequencies[doc_id][term] for doc_id in ids]
+
+        return cls(vocab, offsets, post_doc_idx, post_tf, doc_ids, doc_len)
+
+    def term_row(self, term):
+        return self.vocab.get(term)
+
+    # returns the (doc_idx, tf) arrays of a term, both empty if the term is unknown.
+    def postings(self, term):
+        t = self.term_row(term)
+        if t is None:
+            return self.post_doc_idx[:0], self.post_tf[:0]
+        start, end = self.offsets[t], self.offsets[t + 1]
+        return self.post_doc_idx[start:end], self.post_tf[start:end]
+
+    def doc_position(self, doc_id):
+        pos = int(np.searchsorted(self.doc_ids, doc_id))
+        if pos < self.n_docs and self.doc_ids[pos] == doc_id:
+            return pos
+        return None
+
+    def df(self, term):
+        t = self.term_row(term)
+        return 0 if t is None else int(self.offsets[t + 1] - self.offsets[t])
+
+    def term_idf(self, term):
+        t = self.term_row(term)
+        if t is None:
+            return float(np.log((self.n_docs + 0.5) / 0.5 + 1))
+        return float(self.idf[t])
+
+    def tf(self, doc_id, term):
+        pos = self.doc_position(doc_id)
+        doc_idx, tf = self.postings(term)
+        if pos is None or len(doc_idx) == 0:
+            return 0
+        i = int(np.searchsorted(doc_idx, pos))
+        if i < len(doc_idx) and doc_idx[i] == pos:
+            return int(tf[i])
+        return 0
+
+    # same saturation and length normalization as InvertedIndex.get_bm25_tf, on whole arrays.
+    def bm25_tf(self, tf, doc_idx, k1=BM25_K1, b=BM25_B, avgdl=None):
+        tf = tf.astype(np.float64)
+        length_norm = 1 - b + b * (self.doc_len[doc_idx] / (self.avgdl if avgdl is None else avgdl))
+        return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+
+    # every query token adds its bm25 contribution to a dense score array.
+    # repeated tokens are counted once per occurrence, as bm25_search always did.
+    # stats replaces this engine's own N, avgdl and df when it is one segment of a bigger corpus.
+    def score(self, tokens, k1=BM25_K1, b=BM25_B, stats=None):
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        matched = np.zeros(self.n_docs, dtype=bool)
+        avgdl = None if stats is None else stats.avgdl
+        for token in tokens:
+            t = self.term_row(token)
+            if t is None:
+                continue
+            idf = self.idf[t] if stats is None else stats.idf(token)
+            doc_idx, tf = self.postings(token)
+            scores[doc_idx] += idf * self.bm25_tf(tf, doc_idx, k1, b, avgdl)
+            matched[doc_idx] = True
+        return scores, matched
+
+    # same as score(), restricted to the given sorted doc positions.
+    def rescore(self, tokens, candidates, k1=BM25_K1, b=BM25_B):
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        for token in tokens:
+            t = self.term_row(token)
+            if t is None:
+                continue
+            doc_idx, tf = self.postings(token)
+            hits = find_postings(doc_idx, candidates)
+            scores[doc_idx[hits]] += self.idf[t] * self.bm25_tf(tf[hits], doc_idx[hits], k1, b)
+        return scores
+
+    # upper bound of every term's contribution, computed over all postings once per (k1, b).
+    # the default pair is stored in the index file, so this only runs for tuned parameters.
+    def max_scores(self, k1=BM25_K1, b=BM25_B):
+        key = (k1, b)
+        if key not in self.max_score_cache:
+            if len(self.post_tf) == 0:
+                self.max_score_cache[key] = np.zeros(len(self.offsets) - 1)
+            else:
+                term_rows = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+                contrib = self.idf[term_rows] * self.bm25_tf(self.post_tf, self.post_doc_idx, k1, b)
+                self.max_score_cache[key] = np.maximum.reduceat(contrib, self.offsets[:-1])
+        return self.max_score_cache[key]
+
+    # returns {doc_id: score} for the best `limit` docs, highest score first.
+    # ties are broken by doc id so the order is stable between runs.
+    # `deleted` are sorted doc positions left out of the results. with stats or deleted
+    # the upper bounds of this engine no longer hold, so those searches are exhaustive.
+    def search(self, tokens, limit=5, k1=BM25_K1, b=BM25_B, prune=True, stats=None, deleted=None):
+        if stats is not None or deleted is not None:
+            scores, matched = self.score(tokens, k1, b, stats)
+            if deleted is not None:
+                matched[deleted] = False
+            candidates = np.flatnonzero(matched)
+        elif prune:
+            scores, candidates = self.score_top_k(tokens, limit, k1, b)
+            # pruning adds terms in a different order, so the shortlist is rescored in query order
+            # to get exactly the floats (and tie order) of exhaustive scoring.
+            if len(candidates) > limit > 0:
+                threshold = kth_largest(scores[candidates], limit)
+                candidates = candidates[scores[candidates] * (1 + PRUNE_SLACK) >= threshold]
+            scores = self.rescore(tokens, candidates, k1, b)
+        else:
+            scores, matched = self.score(tokens, k1, b)
+            candidates = np.flatnonzero(matched)
+        top = top_k(candidates, scores, limit)
+        return dict(zip(self.doc_ids[top].tolist(), scores[top].tolist()))
+
+    # MaxScore, term at a time.
+    # terms are scored from the highest upper bound down. while the upper bounds of the
+    # remaining terms can still lift an unseen doc into the top `limit`, whole posting lists are added.
+    # after that only docs already seen can make it, so the remaining terms are looked up
+    # for those docs alone, and docs whose score plus the remaining bound falls below the
+    # current k-th score are dropped. the final top `limit` is identical to exhaustive scoring.
+    def score_top_k(self, tokens, limit, k1=BM25_K1, b=BM25_B):
+        weights = Counter(t for t in map(self.term_row, tokens) if t is not None)
+        rows = sorted(weights, key=lambda t: self.max_scores(k1, b)[t] * weights[t], reverse=True)
+        bounds = np.array([self.max_scores(k1, b)[t] * weights[t] for t in rows])
+        remaining = np.cumsum(bounds[::-1])[::-1]
+
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        matched = np.zeros(self.n_docs, dtype=bool)
+        candidates = None
+
+        for i, t in enumerate(rows):
+            start, end = self.offsets[t], self.offsets[t + 1]
+            doc_idx, tf = self.post_doc_idx[start:end], self.post_tf[start:end]
+
+            if candidates is None:
+                scores[doc_idx] += weights[t] * self.idf[t] * self.bm25_tf(tf, doc_idx, k1, b)
+                matched[doc_idx] = True
+                self.stats["postings_evaluated"] += len(doc_idx)
+
+                if i + 1 < len(rows) and limit > 0 and np.count_nonzero(matched) >= limit:
+                    seen = np.flatnonzero(matched)
+                    threshold = kth_largest(scores[seen], limit)
+                    if remaining[i + 1] * (1 + PRUNE_SLACK) < threshold:
+                        candidates = seen
+            else:
+                hits = find_postings(doc_idx, candidates)
+                scores[doc_idx[hits]] += weights[t] * self.idf[t] * self.bm25_tf(tf[hits], doc_idx[hits], k1, b)
+                self.stats["postings_evaluated"] += len(hits)
+                self.stats["postings_skipped"] += len(doc_idx) - len(hits)
+
+            if candidates is not None and i + 1 < len(rows):
+                threshold = kth_largest(scores[candidates], limit)
+                keep = (scores[candidates] + remaining[i + 1]) * (1 + PRUNE_SLACK) >= threshold
+                candidates = candidates[keep]
+
+        if candidates is None:
+            candidates = np.flatnonzero(matched)
+        return scores, candidates
+
+
+class CorpusStats:
+    """N, avgdl and df of the query terms for a corpus spread over several engines."""
+
+    def __init__(self, n_docs, avgdl, df):
+        self.n_docs = n_docs
+        self.avgdl = avgdl
+        self.df = df
+
+    def idf(self, term):
+        df = self.df.get(term, 0)
+        return float(np.log((self.n_docs - df + 0.5) / (df + 0.5) + 1))
+
+
+# positions in a posting list of the given doc positions that it contains.
+# the candidates and the postings are both sorted, so each lookup is a binary search.
+def find_postings(doc_idx, candidates):
+    if len(doc_idx) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pos = np.searchsorted(doc_idx, candidates)
+    pos[pos == len(doc_idx)] = 0
+    return pos[doc_idx[pos] == candidates]
+
+
+# k-th largest value of an array with at least k values.
+def kth_largest(values, k):
+    return np.partition(values, len(values) - k)[len(values) - k]
+
+
+# positions of the best `limit` candidates, ordered by score and then doc position.
+# only the candidates tied or above the k-th score are sorted.
+def top_k(candidates, scores, limit):
+    if limit <= 0:
+        return candidates[:0]
+    if len(candidates) > limit:
+        candidates = candidates[scores[candidates] >= kth_largest(scores[candidates], limit)]
+    order = np.lexsort((candidates, -scores[candidates]))[:limit]
+    return candidates[order]
@@ -1,5 +1,4 @@
 import argparse
-from nltk.stem.porter import PorterStemmer
 
 import os
 import json
@@ -11,6 +10,13 @@ import string
 BM25_K1 = 1.5
 BM25_B = 0.75
 
+# where search_server listens, and where the --server flag of the CLIs sends queries by default.
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+DEFAULT_SERVER_URL = f"http://{SERVER_HOST}:{SERVER_PORT}"
+# where llm_stub_server, the local stand-in for the Gemini API, listens.
+LLM_STUB_PORT = 8766
+
 parser = argparse.ArgumentParser(description="Keyword Search CLI")
 subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
@@ -18,6 +24,14 @@ search_parser = subparsers.add_parser("search", help="Search movies using BM25")
 search_parser.add_argument("query", type=str, help="Search query")
 
 build_parser = subparsers.add_parser("build", help="Build and save the inverted index")
+build_parser.add_argument("--workers", type=int, default=1, help="Worker processes used to tokenize the docs (default: 1)")
+
+convert_parser = subparsers.add_parser("convert", help="Convert the old pickle cache to the index file")
+
+apply_parser = subparsers.add_parser("apply", help="Apply document changes as a delta segment")
+apply_parser.add_argument("changes", type=str, help='JSON file with {"upsert": [movies], "delete": [ids]}')
+
+compact_parser = subparsers.add_parser("compact", help="Merge the delta segments into the base index")
 
 term_parser = subparsers.add_parser("tf", help="Gives the term frequency")
 term_parser.add_argument("doc_id", type=int, help="document ID")
@@ -42,16 +56,41 @@ bm25tf_parser.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tun
 bm25_parser = subparsers.add_parser("bm25search", help="bm25 score")
 bm25_parser.add_argument("bm25_query", type=str, help="Actual Query")
 bm25_parser.add_argument("bm25_limit", type=int, nargs="?", default=5, help="limited result")
+bm25_parser.add_argument("--server", nargs="?", const=DEFAULT_SERVER_URL, help=f"Ask a running search_server instead (default URL: {DEFAULT_SERVER_URL})")
 
 
 path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-with open(path, "r") as f:
-    # json.load parses the json file and returns a dictionary
-    movies_data = json.load(f)
-
 stop_path = os.path.join(os.path.dirname(__file__), "../data/stopwords.txt")
-with open(stop_path, "r") as f:
-    stop_words_list = f.read().splitlines()
 
-stemmer_instance = PorterStemmer()
-table = str.maketrans("", "", string.punctuation)
\ No newline at end of file
+table = str.maketrans("", "", string.punctuation)
+
+# the corpus, stopwords and stemmer are loaded on first use and kept,
+# so commands that only read the index never parse movies.json or import nltk.
+_movies_data = None
+_stop_words_list = None
+_stemmer_instance = None
+
+
+def load_movies():
+    global _movies_data
+    if _movies_data is None:
+        with open(path, "r") as f:
+            # json.load parses the json file and returns a dictionary
+            _movies_data = json.load(f)
+    return _movies_data
+
+
+def load_stop_words():
+    global _stop_words_list
+    if _stop_words_list is None:
+        with open(stop_path, "r") as f:
+            _stop_words_list = f.read().splitlines()
+    return _stop_words_list
+
+
+def get_stemmer():
+    global _stemmer_instance
+    if _stemmer_instance is None:
+        from nltk.stem.porter import PorterStemmer
+        _stemmer_instance = PorterStemmer()
+    return _stemmer_instance
\ No newline at end of file
@@ -0,0 +1,193 @@
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from config import load_movies
+from hybrid_search import HybridSearch
+from semantic_search import CHUNK_ANN_PATH, CHUNK_EMBEDDINGS_PATH, MOVIE_ANN_PATH, MOVIE_EMBEDDINGS_PATH, load_or_create_ivf
+
+# Measures what every search configuration trades: retrieval quality on a golden query set
+# against latency. Run it from the project root, where the cache/ directory lives.
+#
+# The golden set is a JSON list of {"query": ..., "relevant": [movie ids]} objects (or an
+# object with such a list under "test_cases"); "relevant_docs": [titles] works instead of ids.
+# Query embeddings are computed before anything is timed, so latencies are of the search
+# itself and the same for every configuration, whichever runs first.
+
+K = 5
+ALPHAS = "0.2,0.5,0.8"
+RRF_KS = "20,60,100"
+# candidate depths of the hybrid searches, "adaptive" is the default that grows while it matters.
+DEPTHS = "adaptive"
+PRECISIONS = "float32"
+METRICS = ("recall", "mrr", "ndcg")
+PERCENTILES = (50, 95, 99)
+
+
+# one {"query", "relevant"} case per entry, titles are looked up in the movies.
+def load_golden(path, documents):
+    with open(path, "r") as f:
+        data = json.load(f)
+    cases = data["test_cases"] if isinstance(data, dict) else data
+    id_by_title = {doc["title"].lower(): doc["id"] for doc in documents}
+
+    golden = []
+    for number, case in enumerate(cases, 1):
+        if "relevant" in case:
+            relevant = set(case["relevant"])
+        else:
+            missing = [title for title in case.get("relevant_docs", []) if title.lower() not in id_by_title]
+            if missing:
+                raise ValueError(f"Case {number}: no movie titled {missing[0]!r}")
+            relevant = {id_by_title[title.lower()] for title in case.get("relevant_docs", [])}
+        if not case.get("query", "").split() or not relevant:
+            raise ValueError(f"Case {number}: expected a query and at least one relevant movie")
+        golden.append((case["query"], relevant))
+    return golden
+
+
+def recall_at_k(ids, relevant, k):
+    return len(set(ids[:k]) & relevant) / len(relevant)
+
+
+# reciprocal rank of the first relevant result in the top k, 0 when there is none.
+def reciprocal_rank(ids, relevant, k):
+    for rank, doc_id in enumerate(ids[:k], 1):
+        if doc_id in relevant:
+            return 1 / rank
+    return 0.0
+
+
+# binary relevance nDCG@k.
+def ndcg_at_k(ids, relevant, k):
+    dcg = sum(1 / math.log2(rank + 1) for rank, doc_id in enumerate(ids[:k], 1) if doc_id in relevant)
+    ideal = sum(1 / math.log2(rank + 1) for rank in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal
+
+
+# the configurations as (method, params, search), search maps a query to the ranked movie ids.
+def configurations(hybrid, args):
+    semantic = hybrid.semantic_search
+    configs = [("keyword", {}, lambda query: list(hybrid.idx.bm25_search(query, args.k)))]
+
+    for precision in args.precisions.split(","):
+        for ann in ([False, True] if args.ann else [False]):
+            params = {"precision": precision, "ann": ann}
+            configs.append(("semantic", params, variant(semantic, precision, ann,
+                lambda query: [doc["id"] for _, doc in semantic.search(query, args.k)])))
+            configs.append(("chunked", params, variant(semantic, precision, ann,
+                lambda query: [result["id"] for result in semantic.search_chunks(query, args.k)])))
+
+    for depth in args.depths.split(","):
+        candidate_depth = None if depth == "adaptive" else int(depth)
+        for alpha in map(float, args.alphas.split(",")):
+            configs.append(("weighted", {"alpha": alpha, "depth": depth}, variant(semantic, "float32", False,
+                lambda query, alpha=alpha, candidate_depth=candidate_depth:
+                    [result["id"] for result in hybrid.weighted_search(query, alpha, args.k, candidate_depth)])))
+        for k in map(int, args.ks.split(",")):
+            configs.append(("rrf", {"k": k, "depth": depth}, variant(semantic, "float32", False,
+                lambda query, k=k, candidate_depth=candidate_depth:
+                    [result["id"] for result in hybrid.rrf_search(query, k, args.k, candidate_depth)])))
+    return configs
+
+
+# search with the movie and chunk embeddings searched at `precision`, through the ann indexes if `ann`.
+# the indexes are loaded (or built) once and swapped in for each call. the codes are switched to
+# by use_precision, which only loads them when the precision changes, i.e. in the untimed warm up.
+def variant(semantic, precision, ann, search):
+    indexes = {}
+    if ann:
+        indexes["ann"] = load_or_create_ivf(MOVIE_ANN_PATH, semantic.embeddings, MOVIE_EMBEDDINGS_PATH)
+        indexes["chunk_ann"] = load_or_create_ivf(CHUNK_ANN_PATH, semantic.chunk_embeddings, CHUNK_EMBEDDINGS_PATH)
+
+    def search_variant(query):
+        semantic.use_precision(precision)
+        semantic.use_chunk_precision(precision)
+        semantic.ann = indexes.get("ann")
+        semantic.chunk_ann = indexes.get("chunk_ann")
+        return search(query)
+    return search_variant
+
+
+# quality and latency of one configuration over the golden set, after one untimed warm up query.
+def evaluate(search, golden, k):
+    search(golden[0][0])
+    scores = {metric: [] for metric in METRICS}
+    seconds = []
+    for query, relevant in golden:
+        start = time.perf_counter()
+        ids = search(query)
+        seconds.append(time.perf_counter() - start)
+        scores["recall"].append(recall_at_k(ids, relevant, k))
+        scores["mrr"].append(reciprocal_rank(ids, relevant, k))
+        scores["ndcg"].append(ndcg_at_k(ids, relevant, k))
+
+    ms = np.array(seconds) * 1000
+    result = {metric: float(np.mean(values)) for metric, values in scores.items()}
+    result.update({f"p{p}_ms": float(np.percentile(ms, p)) for p in PERCENTILES})
+    result["mean_ms"] = float(ms.mean())
+    return result
+
+
+# marks the configurations no other one beats on both `metric` and p95 latency.
+def mark_pareto(rows, metric):
+    best = -1.0
+    for row in sorted(rows, key=lambda row: (row["p95_ms"], -row[metric])):
+        row["pareto"] = row[metric] > best
+        best = max(best, row[metric])
+
+
+def describe(row):
+    return " ".join(f"{name}={value}" for name, value in row["params"].items())
+
+
+def print_table(rows, k, file=sys.stdout):
+    print(f"| method | params | recall@{k} | MRR | nDCG@{k} | mean ms | p95 ms | p99 ms | pareto |", file=file)
+    print("|---|---|---:|---:|---:|---:|---:|---:|:---:|", file=file)
+    for row in rows:
+        print(f"| {row['method']} | {describe(row)} | {row['recall']:.3f} | {row['mrr']:.3f} | {row['ndcg']:.3f} "
+              f"| {row['mean_ms']:.2f} | {row['p95_ms']:.2f} | {row['p99_ms']:.2f} | {'*' if row['pareto'] else ''} |", file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval quality against latency of every search configuration")
+    parser.add_argument("golden", type=str, help='JSON golden set of {"query": ..., "relevant": [ids]} cases')
+    parser.add_argument("--k", type=int, default=K, help=f"Results per query, the k of recall@k and nDCG@k (default: {K})")
+    parser.add_argument("--alphas", default=ALPHAS, help=f"Alphas of the weighted search (default: {ALPHAS})")
+    parser.add_argument("--ks", default=RRF_KS, help=f"k parameters of the RRF search (default: {RRF_KS})")
+    parser.add_argument("--depths", default=DEPTHS, help=f"Candidate depths of the hybrid searches, e.g. adaptive,50,500 (default: {DEPTHS})")
+    parser.add_argument("--precisions", default=PRECISIONS, help=f"Embedding precisions of the semantic searches, e.g. float32,int8,binary (default: {PRECISIONS})")
+    parser.add_argument("--ann", action="store_true", help="Also evaluate the semantic searches through the ANN indexes")
+    parser.add_argument("--metric", choices=METRICS, default="ndcg", help="Quality metric of the Pareto front (default: ndcg)")
+    parser.add_argument("--pareto", type=str, help="Write the Pareto front as a markdown table to this file")
+    parser.add_argument("--output", type=str, help="Write every result as JSON to this file")
+    args = parser.parse_args()
+
+    documents = load_movies()["movies"]
+    golden = load_golden(args.golden, documents)
+    hybrid = HybridSearch(documents)
+    hybrid.semantic_search.load_or_create_embeddings(documents)
+    hybrid.semantic_search.embed_queries([query for query, _ in golden])
+
+    rows = []
+    for method, params, search in configurations(hybrid, args):
+        rows.append({"method": method, "params": params, **evaluate(search, golden, args.k)})
+        print(f"Evaluated {method} {describe(rows[-1])}", file=sys.stderr)
+    mark_pareto(rows, args.metric)
+
+    print(f"{len(golden)} queries, Pareto front by {args.metric} and p95 latency marked with *\n")
+    print_table(rows, args.k)
+    if args.pareto:
+        with open(args.pareto, "w") as f:
+            print_table([row for row in sorted(rows, key=lambda row: row["p95_ms"]) if row["pareto"]], args.k, f)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"k": args.k, "queries": len(golden), "metric": args.metric, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,168 +1,427 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import batched, product
+
+import numpy as np
 
 from InvertedIndex import InvertedIndex
+from index_store import INDEX_PATH, PICKLE_PATHS
 from semantic_search import ChunkedSemanticSearch
+from tracing import span, submit, traced
+
+# queries embedded and scored together by batch_search.
+BATCH_SIZE = 64
+# adaptive retrieval first asks both sides for this many candidates per result and grows the
+# depth DEPTH_GROWTH times while a deeper retrieval could still change the results,
+DEPTH_START_FACTOR = 10
+DEPTH_GROWTH = 4
+# up to this many per result, the depth every query used to be retrieved at.
+DEPTH_MAX_FACTOR = 500
 
 
 def normalize(scores):
     """Normalize scores using min-max normalization"""
-    if not scores:
-        return []
-    
-    min_score = min(scores)
-    max_score = max(scores)
-    
-    # If all scores are the same, return all 1.0
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    return rescale(scores, scores.min(), scores.max())
+
+
+# min-max normalization with the given bounds, all 1.0 if they are the same.
+def rescale(scores, min_score, max_score):
     if min_score == max_score:
-        return [1.0] * len(scores)
+        return np.ones_like(scores)
     
     # Apply min-max normalization
-    return [(score - min_score) / (max_score - min_score) for score in scores]
+    return (scores - min_score) / (max_score - min_score)
+
+
+class HybridResults(list):
+    """Hybrid results, a plain list that also carries the per stage timings in ms."""
+
+    def __init__(self, results, timings):
+        super().__init__(results)
+        self.timings = timings
+
+
+class Candidates:
+    """The bm25 and semantic candidates of one query, aligned over the sorted union of their ids.
+
+    Each side has the score and the 1 based rank of every id, 0.0 and 0 where
+    it did not return the id. A side is truncated when it returned all the
+    `depth` candidates asked for, a deeper retrieval could then add to it.
+    The semantic floor is the lowest semantic score at the deepest depth,
+    0.0 for a movie it did not rank, known when the semantic side was ranked
+    that deep in one go (brute force), and None when a deeper round ranks
+    it again.
+    """
+
+    def __init__(self, bm25_ids, bm25_scores, semantic_ids, semantic_scores, depth, semantic_floor=None):
+        self.ids = np.union1d(bm25_ids, semantic_ids)
+        self.depth = depth
+        self.bm25_scores, self.bm25_ranks = align(self.ids, bm25_ids, bm25_scores)
+        self.semantic_scores, self.semantic_ranks = align(self.ids, semantic_ids, semantic_scores)
+        # the lowest score returned by each side, a score it did not return is at most this.
+        self.bm25_last = bm25_scores[-1] if len(bm25_scores) else 0.0
+        self.semantic_last = semantic_scores[-1] if len(semantic_scores) else 0.0
+        self.bm25_truncated = len(bm25_ids) >= depth
+        self.semantic_truncated = len(semantic_ids) >= depth
+        self.semantic_floor = semantic_floor
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# scores and ranks of the union `ids` from the ranked candidates of one side.
+def align(ids, side_ids, side_scores):
+    scores = np.zeros(len(ids))
+    ranks = np.zeros(len(ids), dtype=np.int64)
+    positions = np.searchsorted(ids, side_ids)
+    scores[positions] = side_scores
+    ranks[positions] = np.arange(1, len(side_ids) + 1)
+    return scores, ranks
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, query_cache_path=None):
+        self.load_movies(documents, query_cache_path)
+        # bm25 runs here while the calling thread does the semantic side of a query.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bm25")
+        self.idx = load_index(documents)
+
+    # the movies and their chunk embeddings, whatever searches their keywords.
+    def load_movies(self, documents, query_cache_path):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
-        self.idx = InvertedIndex()
+        # id -> movie, and the id of the movie at every position, so fusion never scans the movies.
+        self.document_by_id = {doc["id"]: doc for doc in documents}
+        self.doc_ids = np.array([doc["id"] for doc in documents])
+        self.semantic_search = ChunkedSemanticSearch(query_cache_path)
+        with span("load_chunk_embeddings"):
+            self.semantic_search.load_or_create_chunk_embeddings(documents)
 
-        if not os.path.exists("cache/index.pkl"):
-            self.idx.build({"movies": documents})
-            self.idx.save()
-        else:
-            self.idx.load()
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _bm25_search(self, query, limit):
-        return self.idx.bm25_search(query, limit)
+        with span("bm25"):
+            return self.idx.bm25_search(query, limit)
 
-    def weighted_search(self, query, alpha, limit=5):
+    def _bm25_batch(self, queries, limit):
+        return [self._bm25_search(query, limit) for query in queries]
+
+    # the bm25 results {doc_id: score} as arrays.
+    def bm25_candidates(self, bm25_results):
+        ids = np.fromiter(bm25_results.keys(), dtype=self.doc_ids.dtype, count=len(bm25_results))
+        scores = np.fromiter(bm25_results.values(), dtype=np.float64, count=len(bm25_results))
+        return ids, scores
+
+    # the movie positions and scores of rank_movies as ids and scores rounded like rank_chunks does.
+    def semantic_candidates(self, ranked):
+        movie_idx, scores, _ = ranked
+        return self.doc_ids[movie_idx], np.round(scores.astype(np.float64), 4)
+
+    # the candidates of both sides at `depth`, the semantic ranking may be deeper.
+    def candidates(self, bm25_results, ranked, depth):
+        semantic_ids, semantic_scores = self.semantic_candidates(ranked)
+        # a brute force ranking is always as deep as the deepest round (see semantic_depth), so its last
+        # score is the lowest at any depth. unless it ranked every movie, a movie it missed scores 0.0.
+        semantic_floor = None
+        if self.ranks_once() and len(semantic_scores):
+            semantic_floor = semantic_scores[-1] if len(semantic_scores) == len(self.documents) else min(semantic_scores[-1], 0.0)
+        return Candidates(
+            *self.bm25_candidates(bm25_results), semantic_ids[:depth], semantic_scores[:depth], depth, semantic_floor
+        )
+
+    # how deep to rank the semantic side for the given rounds. brute force scores every chunk whatever
+    # the depth, so it ranks once at the deepest depth and each round takes a prefix. an ann or
+    # quantized shortlist grows with the depth, so it ranks again every round.
+    def semantic_depth(self, depths):
+        if self.ranks_once():
+            return depths[-1]
+        return None
+
+    def ranks_once(self):
+        return self.semantic_search.chunk_ann is None and self.semantic_search.chunk_quantized is None
+
+    # both retrievers for one query at `depth` candidates each. bm25 walks its postings in the pool
+    # while this thread embeds the query and scores the chunks (torch and numpy release the GIL),
+    # so retrieval takes about as long as the slower side rather than the sum of both.
+    # the query embedding and a deep enough semantic ranking of an earlier round are reused.
+    def _retrieve(self, query, depth, query_embedding=None, ranked=None, semantic_depth=None):
+        start = time.perf_counter()
+        bm25_future = submit(self.executor, timed, self._bm25_search, query, depth)
+
+        if query_embedding is None:
+            with span("embed"):
+                query_embedding = self.semantic_search.generate_embedding(query)
+        embedded = time.perf_counter()
+        if ranked is None or semantic_depth is None:
+            with span("semantic"):
+                ranked = self.semantic_search.rank_movies(query_embedding, semantic_depth or depth)
+        scored = time.perf_counter()
+
+        bm25_results, bm25_seconds = bm25_future.result()
+        timings = {
+            "bm25_ms": bm25_seconds * 1000,
+            "embed_ms": (embedded - start) * 1000,
+            "semantic_ms": (scored - embedded) * 1000,
+            "retrieval_ms": (time.perf_counter() - start) * 1000,
+        }
+        return self.candidates(bm25_results, ranked, depth), query_embedding, ranked, timings
+
+    # the depths to retrieve at: just `candidate_depth` when it is given, otherwise growing
+    # from DEPTH_START_FACTOR to DEPTH_MAX_FACTOR times the limit, and never past the corpus.
+    def candidate_depths(self, limit, candidate_depth=None):
+        if candidate_depth is not None:
+            return [candidate_depth]
+        deepest = max(limit, min(limit * DEPTH_MAX_FACTOR, len(self.documents)))
+        depths = [limit * DEPTH_START_FACTOR]
+        while depths[-1] < deepest:
+            depths.append(depths[-1] * DEPTH_GROWTH)
+        return [min(depth, deepest) for depth in depths]
+
+    # retrieves and fuses at each depth in turn, until fusing more candidates cannot change the results.
+    def _search(self, query, fuse, depths, query_embedding=None, ranked=None):
+        semantic_depth = self.semantic_depth(depths)
+        timings = {}
+        for rounds, depth in enumerate(depths, 1):
+            with span("retrieval"):
+                candidates, query_embedding, ranked, retrieval_timings = self._retrieve(
+                    query, depth, query_embedding, ranked, semantic_depth
+                )
+            start = time.perf_counter()
+            with span("fusion"):
+                results, settled = fuse(candidates)
+            timings = add_timings(timings, retrieval_timings, fusion_ms=(time.perf_counter() - start) * 1000)
+            if settled:
+                break
+        timings.update(depth=depth, rounds=rounds, total_ms=timings["retrieval_ms"] + timings["fusion_ms"])
+        return HybridResults(results, timings)
+
+    @traced()
+    def weighted_search(self, query, alpha, limit=5, candidate_depth=None):
         """Perform weighted hybrid search combining BM25 and semantic scores"""
 
-        # Get results from both searches (500x limit to ensure coverage)
-        # It gets score of 500x the limit of movies from both searches.
-        bm25_results = self._bm25_search(query, limit * 500)
-        semantic_results = self.semantic_search.search_chunks(query, limit * 500)
-        
-        # Create dictionaries to store scores by document ID
-        bm25_scores = {}
-        semantic_scores = {}
-        doc_map = {}
-        
-        # Process BM25 results
-        # It appends all the returned movies into temp dict and docmap.
-        for doc_id, score in bm25_results.items():
-            bm25_scores[doc_id] = score
-            doc_map[doc_id] = self.idx.docmap[doc_id]
-        
-        # Process semantic results
-        # it does the same for sematic result,
-        # and also finds the movie which arent added by the lexical search.
-        for result in semantic_results:
-            doc_id = result["id"]
-            semantic_scores[doc_id] = result["score"]
-            if doc_id not in doc_map:
-                # Find the document
-                for doc in self.documents:
-                    if doc["id"] == doc_id:
-                        doc_map[doc_id] = doc
-                        break
-        
-        # Get all unique document IDs
-        # it unionizes the two lists.
-        all_doc_ids = set(bm25_scores.keys()) | set(semantic_scores.keys())
-        
+        # Get results from both searches at the same time, deeper only while it matters
+        # (or at candidate_depth, the fixed depth used to be 500x the limit).
+        fuse = partial(self.weighted_fuse, alpha=alpha, limit=limit)
+        return self._search(query, fuse, self.candidate_depths(limit, candidate_depth))
+
+    # fuses the candidates of one query by normalized score, returns the results and
+    # whether a deeper retrieval could not change them.
+    def weighted_fuse(self, candidates, alpha, limit):
         # Normalize scores
-        # It sets the score to 0.0 if a movies is not present in one of the search.
-        # to normalize the score, each movie should be present in both lists.
-        bm25_score_list = [bm25_scores.get(doc_id, 0.0) for doc_id in all_doc_ids]
-        semantic_score_list = [semantic_scores.get(doc_id, 0.0) for doc_id in all_doc_ids]
-        
-        normalized_bm25 = normalize(bm25_score_list)
-        normalized_semantic = normalize(semantic_score_list)
+        # a movie missing from one of the searches has a score of 0.0 there.
+        bm25_min, semantic_min = normalization_minimums(candidates)
+        normalized_bm25 = rescale(candidates.bm25_scores, bm25_min, max_score(candidates.bm25_scores))
+        normalized_semantic = rescale(candidates.semantic_scores, semantic_min, max_score(candidates.semantic_scores))
         
         # higher alpha means result biased towards keyword results.
         # lower alpha means lower biasness towards keyword based search.
         # Calculate hybrid scores
-        results = []
-        for i, doc_id in enumerate(all_doc_ids):
-            bm25_norm = normalized_bm25[i]
-            semantic_norm = normalized_semantic[i]
-            hybrid_score = alpha * bm25_norm + (1 - alpha) * semantic_norm
-            
-            if doc_id in doc_map:
-                results.append({
-                    "id": doc_id,
-                    "title": doc_map[doc_id]["title"],
-                    "document": doc_map[doc_id].get("description", "")[:100],
-                    "hybrid_score": hybrid_score,
-                    "bm25_score": bm25_norm,
-                    "semantic_score": semantic_norm
-                })
-        
-        # Sort by hybrid score descending
-        results.sort(key=lambda x: x["hybrid_score"], reverse=True)
-        
-        return results[:limit]
+        hybrid_scores = alpha * normalized_bm25 + (1 - alpha) * normalized_semantic
+        order = rank(candidates.ids, hybrid_scores)
+        top = order[:limit]
 
+        # deeper candidates can only lower the minimum the semantic side is normalized with when
+        # it is not known yet. the order of two movies is linear in the scale of each side, so
+        # the results are settled if they are at every extreme of the minimums.
+        settled = len(candidates) > 0 and all(
+            is_settled(order, *weighted_bounds(candidates, alpha, bm25_min, semantic_min), limit)
+            for bm25_min, semantic_min in product(*lowest_minimums(candidates))
+        )
 
-    def rrf_search(self, query, k, limit=10):
+        results = []
+        for i in top.tolist():
+            doc = self.document_by_id[candidates.ids[i].item()]
+            results.append({
+                "id": doc["id"],
+                "title": doc["title"],
+                "document": doc.get("description", "")[:100],
+                "hybrid_score": hybrid_scores[i].item(),
+                "bm25_score": normalized_bm25[i].item(),
+                "semantic_score": normalized_semantic[i].item()
+            })
+        return results, settled
+
+    @traced()
+    def rrf_search(self, query, k, limit=10, candidate_depth=None):
         """Perform RRF (Reciprocal Rank Fusion) hybrid search"""
 
-        # Get results from both searches (500x limit)
-        bm25_results = self._bm25_search(query, limit * 500)
-        semantic_results = self.semantic_search.search_chunks(query, limit * 500)
-        
-        # Create dictionaries to store ranks and documents
-        bm25_ranks = {}
-        semantic_ranks = {}
-        doc_map = {}
-        
-        # Process BM25 results (rank starts at 1)
-        for rank, (doc_id, score) in enumerate(bm25_results.items(), 1):
-            bm25_ranks[doc_id] = rank
-            doc_map[doc_id] = self.idx.docmap[doc_id]
-        
-        # Process semantic results (rank starts at 1)
-        for rank, result in enumerate(semantic_results, 1):
-            doc_id = result["id"]
-            semantic_ranks[doc_id] = rank
-            if doc_id not in doc_map:
-                # Find the document
-                for doc in self.documents:
-                    if doc["id"] == doc_id:
-                        doc_map[doc_id] = doc
-                        break
-        
-        # Get all unique document IDs
-        all_doc_ids = set(bm25_ranks.keys()) | set(semantic_ranks.keys())
-        
-        # Calculate RRF scores
+        # Get results from both searches at the same time, deeper only while it matters
+        # (or at candidate_depth, the fixed depth used to be 500x the limit).
+        fuse = partial(self.rrf_fuse, k=k, limit=limit)
+        return self._search(query, fuse, self.candidate_depths(limit, candidate_depth))
+
+    # fuses the candidates of one query by reciprocal rank, returns the results and
+    # whether a deeper retrieval could not change them.
+    def rrf_fuse(self, candidates, k, limit):
+        # higher k means flatter curves, not very sensitive to ranks,
+        # whereas lower k means more aggresive to ranks, higher rank ranks higher.
+        # each side adds 1 / (k + rank) for the movies it returned.
+        rrf_scores = np.zeros(len(candidates))
+        upper = np.zeros(len(candidates))
+        unseen = -np.inf
+        for ranks, truncated in ((candidates.bm25_ranks, candidates.bm25_truncated),
+                                 (candidates.semantic_ranks, candidates.semantic_truncated)):
+            found = ranks > 0
+            rrf_scores[found] += 1.0 / (k + ranks[found])
+            # a movie missing from a truncated side may still be found there below the depth.
+            if truncated:
+                bound = 1.0 / (k + candidates.depth + 1)
+                upper[~found] += bound
+                unseen = max(unseen, 0.0) + bound
+        upper += rrf_scores
+
+        order = rank(candidates.ids, rrf_scores)
+        top = order[:limit]
+        settled = is_settled(order, rrf_scores, upper, unseen, limit)
         results = []
-        for doc_id in all_doc_ids:
-            rrf_score = 0.0
-            
-            # higher k means flatter curves, not very sensitive to ranks,
-            # whereas lower k means more aggresive to ranks, higher rank ranks higher.
-            # Add BM25 RRF component if document appears in BM25 results
-            if doc_id in bm25_ranks:
-                rrf_score += 1.0 / (k + bm25_ranks[doc_id])
-            
-            # Add semantic RRF component if document appears in semantic results
-            if doc_id in semantic_ranks:
-                rrf_score += 1.0 / (k + semantic_ranks[doc_id])
-            
-            if doc_id in doc_map:
-                results.append({
-                    "id": doc_id,
-                    "title": doc_map[doc_id]["title"],
-                    "document": doc_map[doc_id].get("description", "")[:100],
-                    "rrf_score": rrf_score,
-                    "bm25_rank": bm25_ranks.get(doc_id, None),
-                    "semantic_rank": semantic_ranks.get(doc_id, None)
-                })
-        
-        # Sort by RRF score descending
-        results.sort(key=lambda x: x["rrf_score"], reverse=True)
-        
-        return results[:limit]
+        for i in top.tolist():
+            doc = self.document_by_id[candidates.ids[i].item()]
+            bm25_rank = candidates.bm25_ranks[i].item()
+            semantic_rank = candidates.semantic_ranks[i].item()
+            results.append({
+                "id": doc["id"],
+                "title": doc["title"],
+                "document": doc.get("description", "")[:100],
+                "rrf_score": rrf_scores[i].item(),
+                "bm25_rank": bm25_rank or None,
+                "semantic_rank": semantic_rank or None
+            })
+        return results, settled
+
+    # the fuse function of a fusion method, weighted or rrf.
+    def fuser(self, method, alpha, k, limit):
+        if method == "weighted":
+            return partial(self.weighted_fuse, alpha=alpha, limit=limit)
+        return partial(self.rrf_fuse, k=k, limit=limit)
+
+    def batch_search(self, queries, method="rrf", alpha=0.5, k=60, limit=5, batch_size=BATCH_SIZE, candidate_depth=None):
+        """Perform weighted or RRF hybrid search for many queries, yielding their results in order"""
+
+        fuse = self.fuser(method, alpha, k, limit)
+        depths = self.candidate_depths(limit, candidate_depth)
+
+        # the queries of a batch are embedded together (only cache misses reach the model),
+        # and their chunks are scored while bm25 runs over them in the pool.
+        # the few queries the first depth does not settle go deeper one by one.
+        for batch in batched(queries, batch_size):
+            bm25_future = submit(self.executor, self._bm25_batch, batch, depths[0])
+            with span("embed"):
+                query_embeddings = self.semantic_search.embed_queries(batch)
+            with span("semantic"):
+                ranked_batch = self.semantic_search.rank_movies_many(query_embeddings, self.semantic_depth(depths) or depths[0])
+
+            for query, query_embedding, bm25_results, ranked in zip(batch, query_embeddings, bm25_future.result(), ranked_batch):
+                with span("fusion"):
+                    results, settled = fuse(self.candidates(bm25_results, ranked, depths[0]))
+                if not settled and len(depths) > 1:
+                    results = self._search(query, fuse, depths[1:], query_embedding, ranked)
+                yield results
+
+
+# the keyword index of the movies, built the first time and then loaded and synced with them.
+def load_index(documents):
+    idx = InvertedIndex()
+    with span("load_index"):
+        if not os.path.exists(INDEX_PATH) and not os.path.exists(PICKLE_PATHS[0]):
+            idx.build({"movies": documents})
+            idx.save()
+        else:
+            # edited movies reach the index as a small delta instead of a rebuild.
+            idx.load()
+            idx.sync(documents)
+    return idx
+
+
+# the minimums the weighted fusion normalizes each side from. bm25 scores, and the score of a
+# movie a side did not return, are never below 0. the semantic side goes down to the semantic
+# floor when it is known, so a query scores the same whatever depth it settled at, and the same
+# as at the deepest depth. with an ann or quantized shortlist the floor is not known and the
+# lowest semantic candidate is used, so those scores (not the order) depend on the depth.
+def normalization_minimums(candidates):
+    if candidates.semantic_floor is not None:
+        return 0.0, candidates.semantic_floor
+    return 0.0, min(candidates.semantic_scores.min(), 0.0) if len(candidates) else 0.0
+
+
+# the highest score of a side, 0.0 when there are no candidates.
+def max_score(scores):
+    return scores.max() if len(scores) else 0.0
+
+
+# the minimums either side of the candidates may be normalized with after a deeper retrieval,
+# only an unknown semantic floor can still go down, to the -1 of cosine similarity.
+def lowest_minimums(candidates):
+    bm25_min, semantic_min = normalization_minimums(candidates)
+    if candidates.semantic_floor is None and candidates.semantic_truncated:
+        return (bm25_min,), (semantic_min, -1.0)
+    return (bm25_min,), (semantic_min,)
+
+
+# bounds on the hybrid scores of the candidates, and of unseen movies, over any deeper retrieval
+# with both sides normalized from the given minimums. a movie missing from a truncated side may
+# still be found there with a score up to the last one it returned.
+def weighted_bounds(candidates, alpha, bm25_min, semantic_min):
+    lower = np.zeros(len(candidates))
+    upper = np.zeros(len(candidates))
+    unseen = 0.0
+    sides = (
+        (alpha, candidates.bm25_scores, candidates.bm25_ranks, candidates.bm25_last, candidates.bm25_truncated, bm25_min),
+        (1 - alpha, candidates.semantic_scores, candidates.semantic_ranks, candidates.semantic_last, candidates.semantic_truncated, semantic_min),
+    )
+    for weight, scores, ranks, last, truncated, min_score in sides:
+        top_score = max_score(scores)
+        normalized = weight * rescale(scores, min_score, top_score)
+        lower += normalized
+        upper += normalized
+        if truncated:
+            missing = ranks == 0
+            lower[missing] = -np.inf
+            upper[missing] += weight * (rescale(last, min_score, top_score) - rescale(0.0, min_score, top_score))
+            unseen += weight * rescale(last, min_score, top_score)
+        else:
+            unseen += weight * rescale(0.0, min_score, top_score)
+    if not (candidates.bm25_truncated or candidates.semantic_truncated):
+        unseen = -np.inf
+    return lower, upper, unseen
+
+
+# order of the fused candidates: score descending, then id.
+def rank(ids, scores):
+    return np.lexsort((ids, -scores))
+
+
+# the top `limit` of `order` is settled when each result scores at least the upper bound of every
+# candidate after it and of the unseen movies, so no deeper retrieval can change it.
+def is_settled(order, lower, upper, unseen, limit):
+    if len(order) < limit and unseen > -np.inf:
+        return False
+    ceiling = np.maximum.accumulate(np.r_[upper[order], unseen][::-1])[::-1]
+    top = order[:limit]
+    return bool(np.all(lower[top] >= ceiling[1:len(top) + 1]))
+
+
+# runs fn and returns its result with the seconds it took.
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+# the timings of one more retrieval round added to those of the earlier ones.
+def add_timings(timings, *more, **extra):
+    total = dict(timings)
+    for entry in (*more, extra):
+        for name, ms in entry.items():
+            total[name] = total.get(name, 0.0) + ms
+    return total
@@ -1,11 +1,18 @@
 import argparse
-import os
 import json
+import sys
+import time
+from functools import partial
 
-from hybrid_search import HybridSearch
-from dotenv import load_dotenv
-from google import genai
-from sentence_transformers import CrossEncoder
+from config import DEFAULT_SERVER_URL, load_movies
+from hybrid_search import BATCH_SIZE, HybridSearch
+from llm_cache import print_llm_cache_stats
+from llm_client import LLM_DEADLINE, LLMCallError, make_llm_client, print_llm_stats
+from reranker import RERANK_BATCH_SIZE, get_reranker, print_rerank_stats
+from search_server import query_server, to_json
+from semantic_search import QUERY_CACHE_PATH
+from sharded_search import ShardedHybridSearch
+from tracing import current_trace, print_trace, span, trace
 
 parser = argparse.ArgumentParser(description="Hybrid Search CLI")
 subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -14,32 +21,170 @@ weighted_search_parser = subparsers.add_parser("weighted-search", help="Perform
 weighted_search_parser.add_argument("query", type=str, help="Search query")
 weighted_search_parser.add_argument("--alpha", type=float, default=0.5, help="Weight for BM25 vs semantic (default: 0.5)")
 weighted_search_parser.add_argument("--limit", type=int, default=5, help="Number of results to return (default: 5)")
+weighted_search_parser.add_argument("--depth", type=int, help="Candidates retrieved from each side (default: adaptive, deeper only while it can change the results)")
+weighted_search_parser.add_argument("--shards", type=int, help="Split the movies into this many shards, searched in parallel by one worker process each")
+weighted_search_parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+weighted_search_parser.add_argument("--timings", action="store_true", help="Also print how long each search stage took")
+weighted_search_parser.add_argument("--server", nargs="?", const=DEFAULT_SERVER_URL, help=f"Ask a running search_server instead (default URL: {DEFAULT_SERVER_URL})")
+weighted_search_parser.add_argument("--profile", nargs="?", const="text", choices=["text", "json"], help="Also print how long every stage of the command took, as text (default) or JSON")
+weighted_search_parser.add_argument("--cprofile", nargs="?", const="-", metavar="FILE", help="Also run the command under cProfile, printing its top functions or saving the stats to FILE")
 
 rrf_search_parser = subparsers.add_parser("rrf-search", help="Perform RRF hybrid search")
 rrf_search_parser.add_argument("query", type=str, help="Search query")
 rrf_search_parser.add_argument("-k", type=int, default=60, help="RRF k parameter (default: 60)")
 rrf_search_parser.add_argument("--limit", type=int, default=5, help="Number of results to return (default: 5)")
+rrf_search_parser.add_argument("--depth", type=int, help="Candidates retrieved from each side (default: adaptive, deeper only while it can change the results)")
 rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method")
 rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="Reranking method")
+rrf_search_parser.add_argument("--rerank-batch-size", type=int, default=RERANK_BATCH_SIZE, help=f"Pairs the cross encoder scores per batch (default: {RERANK_BATCH_SIZE})")
+rrf_search_parser.add_argument("--no-rerank-cache", action="store_true", help="Keep the cross encoder pair scores in memory only, without reading or writing their disk cache")
+rrf_search_parser.add_argument("--no-llm-cache", action="store_true", help="Always call the LLM, without reading or writing its response cache")
+rrf_search_parser.add_argument("--llm-cache-stats", action="store_true", help="Also print the hit rate and time saved of the LLM response cache")
+rrf_search_parser.add_argument("--fake-llm", action="store_true", help="Answer the LLM prompts offline with a fake client")
+rrf_search_parser.add_argument("--llm-url", type=str, help="Send the LLM prompts to this Gemini compatible server, e.g. a running llm_stub_server")
+rrf_search_parser.add_argument("--llm-deadline", type=float, default=LLM_DEADLINE, help=f"Seconds an LLM step may take before the search goes on without it (default: {LLM_DEADLINE})")
+rrf_search_parser.add_argument("--llm-stats", action="store_true", help="Also print the calls, retries and timeouts of the LLM client")
+rrf_search_parser.add_argument("--shards", type=int, help="Split the movies into this many shards, searched in parallel by one worker process each")
+rrf_search_parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+rrf_search_parser.add_argument("--timings", action="store_true", help="Also print how long each search stage took (without reranking)")
+rrf_search_parser.add_argument("--server", nargs="?", const=DEFAULT_SERVER_URL, help=f"Ask a running search_server for the fused results (default URL: {DEFAULT_SERVER_URL})")
+rrf_search_parser.add_argument("--profile", nargs="?", const="text", choices=["text", "json"], help="Also print how long every stage of the command took, as text (default) or JSON")
+rrf_search_parser.add_argument("--cprofile", nargs="?", const="-", metavar="FILE", help="Also run the command under cProfile, printing its top functions or saving the stats to FILE")
+
+batch_parser = subparsers.add_parser("batch", help="Run the queries of a JSONL file and write the results as JSONL")
+batch_parser.add_argument("input", type=str, nargs="?", default="-", help='JSONL file of {"query": ..., "id": ...} objects or strings, - for stdin (default)')
+batch_parser.add_argument("--output", type=str, default="-", help="JSONL file for the results, - for stdout (default)")
+batch_parser.add_argument("--method", type=str, choices=["rrf", "weighted"], default="rrf", help="Fusion method (default: rrf)")
+batch_parser.add_argument("--alpha", type=float, default=0.5, help="Weight for BM25 vs semantic of the weighted method (default: 0.5)")
+batch_parser.add_argument("-k", type=int, default=60, help="RRF k parameter (default: 60)")
+batch_parser.add_argument("--limit", type=int, default=5, help="Number of results per query (default: 5)")
+batch_parser.add_argument("--depth", type=int, help="Candidates retrieved from each side (default: adaptive, deeper only while it can change the results)")
+batch_parser.add_argument("--shards", type=int, help="Split the movies into this many shards, searched in parallel by one worker process each")
+batch_parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+batch_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help=f"Queries embedded and scored together (default: {BATCH_SIZE})")
+batch_parser.add_argument("--profile", nargs="?", const="text", choices=["text", "json"], help="Also print how long every stage of the command took, as text (default) or JSON")
+batch_parser.add_argument("--cprofile", nargs="?", const="-", metavar="FILE", help="Also run the command under cProfile, printing its top functions or saving the stats to FILE")
 
 args = parser.parse_args()
 
 
+# candidates rated per prompt by the individual reranker, the prompts of a query go out concurrently.
+RERANK_WINDOW = 5
+
+# the one LLM client of the command, made by the first LLM call.
+llm_client = None
+
+
+# identical prompts are answered from the response cache unless --no-llm-cache is given.
+def get_llm_client():
+    global llm_client
+    if llm_client is None:
+        llm_client = make_llm_client(args.llm_url, args.fake_llm, not args.no_llm_cache, deadline=args.llm_deadline)
+    return llm_client
+
+
+# the parsers of the LLM answers, run before an answer is cached. one that raises ValueError is
+# not cached, so the prompt is asked again next time instead of replaying the unusable answer.
+def parse_query(text):
+    query = text.strip()
+    if not query:
+        raise ValueError("Empty query")
+    return query
+
+
+# one 0-10 score per line, a line for each of the `count` movies of the prompt.
+def parse_scores(text, count):
+    scores = [float(score) for score in text.split()]
+    if len(scores) != count:
+        raise ValueError(f"Expected {count} scores, got {len(scores)}")
+    return scores
+
+
+# a JSON list of the ids of the prompt's movies.
+def parse_ranked_ids(text):
+    ranked_ids = json.loads(text.strip())
+    if not isinstance(ranked_ids, list) or not all(type(temp_id) is int for temp_id in ranked_ids):
+        raise ValueError(f"Expected a JSON list of ids, got {text[:100]!r}")
+    return ranked_ids
+
+
+# the query as the LLM enhanced it, or the query itself when the LLM failed or missed its deadline.
+def enhance(query, prompt):
+    try:
+        with span("enhance"):
+            enhanced_query = get_llm_client().complete(prompt, parse=parse_query)
+    except (TimeoutError, LLMCallError, ValueError) as e:
+        print(f"Query enhancement ({args.enhance}) failed ({str(e) or 'deadline passed'}), searching for '{query}'\n")
+        return query
+    print(f"Enhanced query ({args.enhance}): '{query}' -> '{enhanced_query}'\n")
+    return enhanced_query
+
+
+# the movies and the HybridSearch over them (sharded with --shards), each load a stage of its own.
+# it is closed at the end of a with block, which stops the worker processes of the shards.
+def load_hybrid_search():
+    with span("load_movies"):
+        documents = load_movies()["movies"]
+    with span("load_hybrid_search"):
+        query_cache_path = QUERY_CACHE_PATH if args.query_cache else None
+        if args.shards:
+            return ShardedHybridSearch(documents, args.shards, query_cache_path)
+        return HybridSearch(documents, query_cache_path)
+
+
+# the results and timings of a search on the server. when the command is traced the server
+# traces the search too, and its stages join the trace under "server".
+def search_on_server(endpoint, **params):
+    with span("server"):
+        current = current_trace()
+        if current is not None:
+            params["profile"] = True
+        response = query_server(args.server, endpoint, **params)
+        if current is not None and "trace" in response:
+            current.merge(response["trace"])
+    return response["results"], response.get("timings")
+
+
+# one {"query": ..., ...} record per non blank line, a line may also be just a JSON string.
+def read_queries(lines):
+    records = []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            record = {"query": record}
+        if not isinstance(record, dict) or not isinstance(record.get("query"), str):
+            raise ValueError(f"Line {line_number}: expected a string or an object with a \"query\" string")
+        records.append(record)
+    return records
+
+
+def print_timings(timings):
+    if not timings:
+        print("No timings available")
+        return
+    print(f"Timings: bm25 {timings['bm25_ms']:.1f} ms, embed {timings['embed_ms']:.1f} ms, semantic {timings['semantic_ms']:.1f} ms"
+          f" -> retrieval {timings['retrieval_ms']:.1f} ms, fusion {timings['fusion_ms']:.1f} ms, total {timings['total_ms']:.1f} ms")
+    if "depth" in timings:
+        print(f"Depth: {timings['depth']} candidates per side after {timings['rounds']} round(s)")
+
+
 def main() -> None:
     
     match args.command:
         
         case "weighted-search":
 
-            # gets the movies.
-            path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-            with open(path, "r") as f:
-                movies_data = json.load(f)
-            documents = movies_data["movies"]
-            
-            # Perform hybrid search
-            hybrid_search = HybridSearch(documents)
-            results = hybrid_search.weighted_search(args.query, args.alpha, args.limit)
+            # with a server the movies, index and model are already loaded there.
+            if args.server:
+                results, timings = search_on_server("weighted", query=args.query, alpha=args.alpha, limit=args.limit, candidate_depth=args.depth)
+            else:
+                # gets the movies, and loads the index and embeddings.
+                with load_hybrid_search() as hybrid_search:
+                    # Perform hybrid search
+                    results = hybrid_search.weighted_search(args.query, args.alpha, args.limit, args.depth)
+                timings = results.timings
             
             # Print results
             for i, result in enumerate(results, 1):
@@ -47,43 +192,25 @@ def main() -> None:
                 print(f"   Hybrid Score: {result['hybrid_score']:.3f}")
                 print(f"   BM25: {result['bm25_score']:.3f}, Semantic: {result['semantic_score']:.3f}")
                 print(f"   {result['document']}...")
+            if args.timings:
+                print_timings(timings)
         
         case "rrf-search":
             
-            # gets the movies.
-            path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-            with open(path, "r") as f:
-                movies_data = json.load(f)
-            documents = movies_data["movies"]
-            
             # Handle query enhancement
             # this one checks for the lexical typos via the LLM.
             query = args.query
             if args.enhance == "spell":
-                load_dotenv()
-                client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-                
                 prompt = f"""Fix any spelling errors in this movie search query.
                     Only correct obvious typos. Don't change correctly spelled words.
                     Query: "{query}"
                     If no errors, return the original query.
                     Corrected:"""
                                     
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite",
-                    contents=prompt
-                )
-                
-                enhanced_query = response.text.strip()
-                print(f"Enhanced query ({args.enhance}): '{query}' -> '{enhanced_query}'\n")
-                query = enhanced_query
+                query = enhance(query, prompt)
 
 
             elif args.enhance == "rewrite":
-                load_dotenv()
-                api_key = os.environ.get("GEMINI_API_KEY")
-                client = genai.Client(api_key=api_key)
-                
                 prompt = f"""Rewrite this movie search query to be more specific and searchable.
                     Original: "{query}"
                     Consider:
@@ -97,21 +224,10 @@ def main() -> None:
                     - "scary movie with bear from few years ago" -> "bear horror movie 2015-2020"
                     Rewritten query:"""
                 
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite",
-                    contents=prompt
-                )
-                
-                enhanced_query = response.text.strip()
-                print(f"Enhanced query ({args.enhance}): '{query}' -> '{enhanced_query}'\n")
-                query = enhanced_query
+                query = enhance(query, prompt)
 
 
             elif args.enhance == "expand":
-                load_dotenv()
-                api_key = os.environ.get("GEMINI_API_KEY")
-                client = genai.Client(api_key=api_key)
-                
                 prompt = f"""Expand this movie search query with related terms.
                     Add synonyms and related concepts that might appear in movie descriptions.
                     Keep expansions relevant and focused.
@@ -125,82 +241,76 @@ def main() -> None:
                     Query: "{query}"
                     """
                 
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite",
-                    contents=prompt
-                )
-                
-                enhanced_query = response.text.strip()
-                print(f"Enhanced query ({args.enhance}): '{query}' -> '{enhanced_query}'\n")
-                query = enhanced_query
-            
-            # Perform RRF hybrid search
-            hybrid_search = HybridSearch(documents)
+                query = enhance(query, prompt)
             
             # Determine how many results to fetch
             # It needs a larger pool of candidates for reranking.
             fetch_limit = args.limit * 5 if args.rerank_method in ["individual", "batch", "cross_encoder"] else args.limit
-            results = hybrid_search.rrf_search(query, args.k, fetch_limit)
+
+            # Perform RRF hybrid search, on the server if one is given, the reranking still happens here.
+            if args.server:
+                results, timings = search_on_server("rrf", query=query, k=args.k, limit=fetch_limit, candidate_depth=args.depth)
+            else:
+                # gets the movies, and loads the index and embeddings.
+                with load_hybrid_search() as hybrid_search:
+                    results = hybrid_search.rrf_search(query, args.k, fetch_limit, args.depth)
+                timings = results.timings
             
             # Handle re-ranking
             if args.rerank_method == "individual":
 
                 print(f"Reranking top {args.limit} results using individual method...")
-                load_dotenv()
-                api_key = os.environ.get("GEMINI_API_KEY")
-                client = genai.Client(api_key=api_key)
-                
-                # Build a single prompt with all documents
-                movies_list = ""
-                for idx, result in enumerate(results, 1):
-                    movies_list += f"{idx}. {result.get('title', '')} - {result.get('document', '')}\n\n"
-                
-                prompt = f"""Rate how well each of these movies matches the search query.
-                    Query: "{query}"
-                    Movies:
-                    {movies_list}
 
-                    Consider for each movie:
-                    - Direct relevance to query
-                    - User intent (what they're looking for)
-                    - Content appropriateness
+                # Build one prompt per window of RERANK_WINDOW documents, the windows are rated concurrently
+                windows = [results[start:start + RERANK_WINDOW] for start in range(0, len(results), RERANK_WINDOW)]
+                prompts = []
+                for window in windows:
+                    movies_list = ""
+                    for idx, result in enumerate(window, 1):
+                        movies_list += f"{idx}. {result.get('title', '')} - {result.get('document', '')}\n\n"
+                    
+                    prompts.append(f"""Rate how well each of these movies matches the search query.
+                        Query: "{query}"
+                        Movies:
+                        {movies_list}
 
-                    Rate each movie 0-10 (10 = perfect match).
-                    Respond with ONLY the scores in order, one per line, no other text.
+                        Consider for each movie:
+                        - Direct relevance to query
+                        - User intent (what they're looking for)
+                        - Content appropriateness
 
-                    Example format:
-                    8.5
-                    7.0
-                    9.5
-                    Scores:"""
-                
+                        Rate each movie 0-10 (10 = perfect match).
+                        Respond with ONLY the scores in order, one per line, no other text.
 
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite",
-                    contents=prompt
-                )
-                
-                # Parse scores from response
-                # it updates the existing results list of dict with the new rerank_score key.
-                scores_text = response.text.strip().split('\n')
-                for idx, result in enumerate(results):
-                    try:
-                        if idx < len(scores_text):
-                            score = float(scores_text[idx].strip())
-                        else:
-                            score = 0.0
-                    except (ValueError, IndexError):
-                        score = 0.0
+                        Example format:
+                        8.5
+                        7.0
+                        9.5
+                        Scores:""")
+
+                with span("rerank"):
+                    responses = get_llm_client().complete_many(prompts, parse=[partial(parse_scores, count=len(window)) for window in windows])
+                failed = [response for response in responses if isinstance(response, Exception)]
+                if failed:
+                    # without the scores of every window the RRF order is kept.
+                    print(f"Reranking failed ({str(failed[0]) or 'deadline passed'}), keeping the RRF order")
+                    for result in results:
+                        result['rerank_score'] = None
+                    results = results[:args.limit]
+                else:
+                    # it updates the existing results list of dict with the new rerank_score key.
+                    for window, scores in zip(windows, responses):
+                        for result, score in zip(window, scores):
+                            result['rerank_score'] = score
                     
-                    result['rerank_score'] = score
-                
-                results = sorted(results, key=lambda x: x['rerank_score'], reverse=True)[:args.limit]
+                    results = sorted(results, key=lambda x: x['rerank_score'], reverse=True)[:args.limit]
                 
                 print(f"Reciprocal Rank Fusion Results for '{query}' (k={args.k}):\n")
                 
                 for i, result in enumerate(results, 1):
                     print(f"{i}. {result['title']}")
-                    print(f"   Rerank Score: {result['rerank_score']:.3f}/10")
+                    rerank_score = f"{result['rerank_score']:.3f}/10" if result['rerank_score'] is not None else "N/A"
+                    print(f"   Rerank Score: {rerank_score}")
                     print(f"   RRF Score: {result['rrf_score']:.3f}")
                     bm25_rank = result['bm25_rank'] if result['bm25_rank'] else "N/A"
                     semantic_rank = result['semantic_rank'] if result['semantic_rank'] else "N/A"
@@ -210,10 +320,6 @@ def main() -> None:
             elif args.rerank_method == "batch":
 
                 print(f"Reranking top {args.limit} results using batch method...\n")
-
-                load_dotenv()
-                api_key = os.environ.get("GEMINI_API_KEY")
-                client = genai.Client(api_key=api_key)
                 
                 # Build document list with IDs
                 doc_list_str = ""
@@ -229,18 +335,14 @@ def main() -> None:
                     [75, 12, 34, 2, 1]
                     """
                 
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite",
-                    contents=prompt
-                )
-                
                 # Parse JSON response
-                # If the JSON parsing or LLM response fails,
+                # If the JSON parsing or LLM response fails (or misses its deadline),
                 # ranked_ids is appended with index only,
                 # In order to revert back the focus to the rrf ranking.
                 try:
-                    ranked_ids = json.loads(response.text.strip())
-                except json.JSONDecodeError:
+                    with span("rerank"):
+                        ranked_ids = get_llm_client().complete(prompt, parse=parse_ranked_ids)
+                except (ValueError, TimeoutError, LLMCallError):
                     # Fallback: keep original order
                     ranked_ids = [i for i in range(len(results))]
                 
@@ -273,21 +375,9 @@ def main() -> None:
             elif args.rerank_method == "cross_encoder":
                 print(f"Reranking top {args.limit} results using cross_encoder method...\n")
                 
-                # Created pairs of [query, document]
-                pairs = []
-                for result in results:
-                    doc_str = f"{result.get('title', '')} - {result.get('document', '')}"
-                    pairs.append([query, doc_str])
-                
-                # Createed cross-encoder and compute scores
-                cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-                scores = cross_encoder.predict(pairs)
-                
-                # Assign scores to results
-                for idx, result in enumerate(results):
-                    result['cross_encoder_score'] = scores[idx]
-                
-                results = sorted(results, key=lambda x: x['cross_encoder_score'], reverse=True)[:args.limit]
+                # pairs of [query, document] are scored in batches, or taken from the pair score cache
+                with span("rerank"):
+                    results, rerank_stats = get_reranker(args.rerank_batch_size, not args.no_rerank_cache).rerank(query, results, args.limit)
                 
                 print(f"Reciprocal Rank Fusion Results for '{query}' (k={args.k}):")
                 
@@ -299,6 +389,7 @@ def main() -> None:
                     semantic_rank = result['semantic_rank'] if result['semantic_rank'] else "N/A"
                     print(f"   BM25 Rank: {bm25_rank}, Semantic Rank: {semantic_rank}")
                     print(f"   {result['document']}...")
+                print_rerank_stats(rerank_stats)
             else:
                 
                 # Print results without re-ranking
@@ -309,10 +400,75 @@ def main() -> None:
                     semantic_rank = result['semantic_rank'] if result['semantic_rank'] else "N/A"
                     print(f"   BM25 Rank: {bm25_rank}, Semantic Rank: {semantic_rank}")
                     print(f"   {result['document']}...")
+
+            if args.timings:
+                print_timings(timings)
+            if args.llm_cache_stats:
+                if llm_client is None or llm_client.cache is None:
+                    print("LLM cache: not used")
+                else:
+                    print_llm_cache_stats(llm_client.cache.stats())
+            if args.llm_stats:
+                if llm_client is None:
+                    print("LLM client: not used")
+                else:
+                    print_llm_stats(llm_client.stats())
         
+        case "batch":
+            start = time.perf_counter()
+            with load_hybrid_search() as hybrid_search:
+                loaded = time.perf_counter()
+
+                if args.input == "-":
+                    records = read_queries(sys.stdin)
+                else:
+                    with open(args.input, "r") as f:
+                        records = read_queries(f)
+
+                # blank queries get an error line in their place, the others are searched in batches.
+                valid = [record for record in records if record["query"].split()]
+                results = hybrid_search.batch_search(
+                    (record["query"] for record in valid), args.method, args.alpha, args.k, args.limit, args.batch_size, args.depth
+                )
+
+                out = sys.stdout if args.output == "-" else open(args.output, "w")
+                try:
+                    for record in records:
+                        if record["query"].split():
+                            out.write(json.dumps({**record, "results": next(results)}, default=to_json) + "\n")
+                        else:
+                            out.write(json.dumps({**record, "error": "Empty Text"}) + "\n")
+                    out.flush()
+                finally:
+                    if out is not sys.stdout:
+                        out.close()
+
+            elapsed = time.perf_counter() - loaded
+            rate = len(valid) / elapsed if elapsed > 0 else 0.0
+            print(f"Answered {len(valid)} queries in {elapsed:.2f}s ({rate:.1f} queries/sec), loading took {loaded - start:.2f}s", file=sys.stderr)
+
         case _:
             parser.print_help()
 
 
+# runs the command, traced when --profile or --cprofile asks for the time of its stages.
+def run():
+    if not getattr(args, "profile", None) and not getattr(args, "cprofile", None):
+        main()
+        return
+    with trace(profile=args.cprofile is not None) as current:
+        main()
+
+    # batch writes its results to stdout, its breakdown goes to stderr.
+    out = sys.stderr if args.command == "batch" else sys.stdout
+    profile = current.profile if args.cprofile == "-" else None
+    if args.cprofile and args.cprofile != "-":
+        current.profile.dump_stats(args.cprofile)
+    if args.profile == "json":
+        print(json.dumps(current.report()), file=out)
+    else:
+        print_trace(current.report(), profile, out)
+
+
 if __name__ == "__main__":
-    main()
+    run()
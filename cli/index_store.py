@@ -0,0 +1,191 @@
+from bm25_engine import BM25Engine
+from collections.abc import Mapping
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# On-disk layout of cache/index.bin (all integers little endian):
+#
+#   magic (8 bytes) | version (u32) | section count (u32)
+#   section table: name (16s) | dtype (8s) | byte offset (u64) | item count (u64)
+#   section data, each section starting on an 8 byte boundary
+#
+# Sections:
+#   vocab_offsets, vocab_bytes   sorted utf-8 terms, term t is vocab_bytes[vo[t]:vo[t + 1]]
+#   offsets                      CSR offsets, postings of term t are [offsets[t], offsets[t + 1])
+#   post_doc_idx, post_tf        postings: dense doc positions (ascending per term) and term frequencies
+#   doc_ids, doc_len             sorted doc ids and their token counts
+#   doc_offsets, doc_bytes       one json document per doc position, for the docmap
+#   max_score                    per term bm25 upper bound with the default k1/b (optional, computed when missing)
+
+INDEX_PATH = "cache/index.bin"
+DELTA_PATH = "cache/index.delta.{}.bin"
+MANIFEST_PATH = "cache/index.manifest.json"
+INDEX_MAGIC = b"BRAGIDX\x00"
+INDEX_VERSION = 1
+
+PICKLE_PATHS = ("cache/index.pkl", "cache/docmap.pkl", "cache/term_frequencies.pkl", "cache/doc_lengths.pkl")
+
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<16s8sQQ")
+
+
+class SortedVocab(Mapping):
+    """term -> row lookup by binary search over the sorted vocabulary columns."""
+
+    def __init__(self, vocab_offsets, vocab_bytes):
+        self.vocab_offsets = vocab_offsets
+        self.vocab_bytes = vocab_bytes
+
+    def term_bytes(self, t):
+        return self.vocab_bytes[self.vocab_offsets[t]:self.vocab_offsets[t + 1]].tobytes()
+
+    def __getitem__(self, term):
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.term_bytes(lo) == key:
+            return lo
+        raise KeyError(term)
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self.term_bytes(t).decode("utf-8")
+
+    def __len__(self):
+        return len(self.vocab_offsets) - 1
+
+
+class DocStore(Mapping):
+    """doc_id -> movie dict, decoded from the json column only when asked for."""
+
+    def __init__(self, doc_ids, doc_offsets, doc_bytes):
+        self.doc_ids = doc_ids
+        self.doc_offsets = doc_offsets
+        self.doc_bytes = doc_bytes
+
+    def __getitem__(self, doc_id):
+        pos = int(np.searchsorted(self.doc_ids, doc_id))
+        if pos >= len(self.doc_ids) or self.doc_ids[pos] != doc_id:
+            raise KeyError(doc_id)
+        return json.loads(self.doc_bytes[self.doc_offsets[pos]:self.doc_offsets[pos + 1]].tobytes())
+
+    def __iter__(self):
+        return iter(self.doc_ids.tolist())
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+# packs the engine arrays and the docmap into one versioned file.
+def write_index(path, engine, docmap):
+    terms = [term.encode("utf-8") for term in engine.vocab]
+    vocab_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    vocab_offsets[1:] = np.cumsum([len(term) for term in terms])
+
+    docs = [json.dumps(docmap[doc_id]).encode("utf-8") for doc_id in engine.doc_ids.tolist()]
+    doc_offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+    doc_offsets[1:] = np.cumsum([len(doc) for doc in docs])
+
+    sections = {
+        "vocab_offsets": vocab_offsets,
+        "vocab_bytes": np.frombuffer(b"".join(terms), dtype=np.uint8),
+        "offsets": np.asarray(engine.offsets, dtype="<i8"),
+        "post_doc_idx": np.asarray(engine.post_doc_idx, dtype="<i4"),
+        "post_tf": np.asarray(engine.post_tf, dtype="<i4"),
+        "doc_ids": np.asarray(engine.doc_ids, dtype="<i8"),
+        "doc_len": np.asarray(engine.doc_len, dtype="<i4"),
+        "doc_offsets": doc_offsets,
+        "doc_bytes": np.frombuffer(b"".join(docs), dtype=np.uint8),
+        "max_score": np.asarray(engine.max_scores(), dtype="<f8"),
+    }
+
+    position = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, array in sections.items():
+        position += -position % 8
+        table.append(SECTION.pack(name.encode(), array.dtype.str.encode(), position, len(array)))
+        position += array.nbytes
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(sections)))
+        f.write(b"".join(table))
+        for array in sections.values():
+            f.write(b"\x00" * (-f.tell() % 8))
+            f.write(array.tobytes())
+    # readers holding the old file keep their mapping, new readers see the new file.
+    os.replace(tmp_path, path)
+
+
+# maps the file and returns (engine, docmap) whose arrays are views into the mapping,
+# so only the pages a query touches are ever read.
+def open_index(path):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, count = HEADER.unpack_from(buf, 0)
+    if magic != INDEX_MAGIC:
+        raise ValueError(f"{path} is not an index file")
+    if version != INDEX_VERSION:
+        raise ValueError(f"Unsupported index version {version} in {path}, rebuild the index")
+
+    sections = {}
+    for i in range(count):
+        name, dtype, offset, length = SECTION.unpack_from(buf, HEADER.size + i * SECTION.size)
+        sections[name.rstrip(b"\x00").decode()] = np.frombuffer(
+            buf, dtype=np.dtype(dtype.rstrip(b"\x00").decode()), count=length, offset=offset)
+
+    engine = BM25Engine(
+        SortedVocab(sections["vocab_offsets"], sections["vocab_bytes"]),
+        sections["offsets"],
+        sections["post_doc_idx"],
+        sections["post_tf"],
+        sections["doc_ids"],
+        sections["doc_len"],
+        sections.get("max_score"),
+    )
+    docmap = DocStore(sections["doc_ids"], sections["doc_offsets"], sections["doc_bytes"])
+    return engine, docmap
+
+
+# the manifest lists the segment files in order, base first, and the doc ids deleted from each,
+# and the hash of the docs the index was last synced with. without a manifest the index is the base file alone.
+def read_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {"version": INDEX_VERSION, "next_delta": 1, "segments": [{"path": INDEX_PATH, "deleted": []}]}
+    with open(MANIFEST_PATH, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(segments, next_delta, corpus_hash=None):
+    manifest = {
+        "version": INDEX_VERSION,
+        "next_delta": next_delta,
+        "segments": [{"path": segment.path, "deleted": segment.deleted_ids()} for segment in segments],
+        "corpus_hash": corpus_hash,
+    }
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+# a fresh base file makes every delta obsolete.
+def remove_deltas():
+    manifest = read_manifest()
+    for entry in manifest["segments"]:
+        if entry["path"] != INDEX_PATH and os.path.exists(entry["path"]):
+            os.remove(entry["path"])
+    if os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
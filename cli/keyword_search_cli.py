@@ -1,9 +1,13 @@
-from config import movies_data
-from transform import transform
+from config import load_movies
+from transform import tokenizer, transform
 from config import parser
 from InvertedIndex import InvertedIndex
+from index_store import INDEX_PATH
+from search_server import query_server
+import json
 import math
 import sys
+import time
 
 
 #-------------------------------------------------------------------
@@ -44,9 +48,40 @@ def main() -> None:
                 print(f"{i}. {movie['title']}")
 
         case "build":
-            index.build(movies_data)
+            index.build(load_movies(), args.workers)
             index.save()
             print("Index built and saved successfully.")
+            print("Build phases: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in index.build_stats.items()))
+            # with workers the stems are cached in the worker processes.
+            if args.workers <= 1:
+                stats = tokenizer.cache_stats()
+                print(f"Stem cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+
+        case "convert":
+            index.load_pickles()
+            index.save()
+            print(f"Pickle cache converted to {INDEX_PATH}")
+
+        case "apply":
+            with open(args.changes, "r") as f:
+                changes = json.load(f)
+            index.load()
+            start = time.perf_counter()
+            for doc in changes.get("upsert", []):
+                if index.is_indexed(doc["id"]):
+                    index.update_document(doc)
+                else:
+                    index.add_document(doc)
+            for doc_id in changes.get("delete", []):
+                index.delete_document(doc_id)
+            index.commit()
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Applied {len(changes.get('upsert', []))} upserts and {len(changes.get('delete', []))} deletes in {elapsed:.1f} ms")
+
+        case "compact":
+            index.load()
+            index.compact()
+            print(f"Index compacted, {len(index.docmap)} documents")
 
         case "tf":
             index.load()
@@ -55,7 +90,7 @@ def main() -> None:
         case "idf":
             index.load()
             total_docs = len(index.docmap)
-            total_docs_term = len(index.index[transform(args.idf_term)[0]])
+            total_docs_term = index.get_df(args.idf_term)
 
             idf = math.log((total_docs + 1) / (total_docs_term + 1))
 
@@ -64,7 +99,7 @@ def main() -> None:
         case "tfidf":
             index.load()
             total_docs = len(index.docmap)
-            total_docs_term = len(index.index[transform(args.tfidf_term)[0]])
+            total_docs_term = index.get_df(args.tfidf_term)
             
             idf = math.log((total_docs + 1) / (total_docs_term + 1))
             tf = index.get_tf(args.tfidf_doc_id, args.tfidf_term)
@@ -83,6 +118,11 @@ def main() -> None:
             print(f"BM25 TF score of '{args.bm25tf_term}' in document '{args.bm25tf_doc_id}': {result:.2f}")
 
         case "bm25search":
+            if args.server:
+                results = query_server(args.server, "keyword", query=args.bm25_query, limit=args.bm25_limit)["results"]
+                for item in results:
+                    print(f"({item['id']}) {item['title']} - Score: {item['score']:.2f}")
+                return
             index.load()
             result = index.bm25_search(args.bm25_query, args.bm25_limit)
             for item in result.items():
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+LLM_CACHE_PATH = "cache/llm_responses.sqlite"
+# a cached answer is reused for a week, then the model is asked again.
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 10000
+# bump when the prompts or the parsing of their answers change, older answers are then never hit.
+PROMPT_VERSION = 2
+
+
+class LLMResponseCache:
+    """LLM responses in SQLite, keyed by a hash of the client, model, prompt version and prompt.
+
+    An entry expires `ttl` seconds after it was written. Past `max_entries`
+    the least recently used entries are evicted. Every entry keeps how long
+    the call took and how often it was hit, so the time saved adds up over
+    runs of the CLI.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, seconds REAL, "
+                "created REAL, last_used REAL, hits INTEGER DEFAULT 0)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def key(namespace, model, contents, version=PROMPT_VERSION):
+        payload = json.dumps([namespace, model, version, contents], sort_keys=True)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    # the cached response text, or None when there is none or it expired.
+    def get(self, key):
+        now = time.time()
+        row = self.db.execute("SELECT response, seconds, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[2] > self.ttl:
+            with self.db:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.expired += 1
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+
+        with self.db:
+            self.db.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self.hits += 1
+        self.seconds_saved += row[1]
+        return row[0]
+
+    # caches the response of a call that took `seconds`, then drops expired and least recently used entries.
+    def put(self, key, model, response, seconds):
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, seconds, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, seconds, now, now),
+            )
+            self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM responses")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        size, total_hits, total_saved = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * seconds), 0.0) FROM responses"
+        ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": self.seconds_saved,
+            "size": size,
+            "total_hits": total_hits,
+            "total_seconds_saved": total_saved,
+        }
+
+    def close(self):
+        self.db.close()
+
+
+class FakeResponse:
+    """What the fake client returns in place of a genai response, only the text is kept."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModels:
+    def __init__(self, respond, latency):
+        self.respond = respond
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, model, contents, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse(self.respond(contents))
+
+
+class FakeClient:
+    """Offline stand-in for genai.Client, answers every prompt with respond(prompt) after `latency` seconds."""
+
+    def __init__(self, respond=None, latency=0.0):
+        self.models = FakeModels(respond or fake_response, latency)
+
+
+# a plausible answer to the prompts of hybrid_search_cli: neutral scores for rating prompts,
+# the given order for ranking prompts, and the query itself for the query enhancements.
+def fake_response(prompt):
+    n_movies = len(re.findall(r"^\s*\d+\. ", prompt, re.MULTILINE))
+    if "Rate each movie" in prompt:
+        return "\n".join(["5.0"] * n_movies)
+    if "Return ONLY the IDs" in prompt:
+        return json.dumps(list(range(n_movies)))
+    query = re.search(r'(?:Query|Original): "(.*)"', prompt)
+    return query.group(1) if query else ""
+
+
+def print_llm_cache_stats(stats):
+    print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+          f"{stats['seconds_saved'] * 1000:.1f} ms of calls saved; {stats['size']} responses cached, "
+          f"hit {stats['total_hits']} times for {stats['total_seconds_saved']:.1f} s saved in total")
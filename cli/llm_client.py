@@ -0,0 +1,310 @@
+import asyncio
+import http.client
+import json
+import os
+import queue
+import random
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_cache import FakeClient, LLMResponseCache
+
+LLM_MODEL = "gemini-2.5-flash-lite"
+# seconds a call may take, retries and waits for the rate limit included.
+LLM_DEADLINE = 10.0
+LLM_RETRIES = 3
+# first wait before a retry, doubled after every failed attempt (with jitter).
+LLM_BACKOFF = 0.5
+# calls per second on average, and how many may go out at once after a quiet spell.
+LLM_RATE = 10.0
+LLM_BURST = 10
+# calls in flight at the same time, also the size of the connection pool.
+LLM_CONCURRENCY = 8
+# http statuses worth another attempt: rate limited or a server side hiccup.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class LLMCallError(RuntimeError):
+    """A failed LLM call. Retryable ones (connection errors, 429, 5xx) are attempted again."""
+
+    def __init__(self, message, status=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """Lets `rate` calls per second through on average, and up to `capacity` at once."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# the text of a genai response. a blocked or empty candidate has none, and asking again gets the same.
+def response_text(response):
+    if response.text is None:
+        raise LLMCallError("LLM response has no text (blocked or empty candidate)")
+    return response.text
+
+
+class GenaiBackend:
+    """google-genai's async API, one client and so one connection pool for every call."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def generate(self, model, prompt, timeout):
+        try:
+            response = await self.client.aio.models.generate_content(model=model, contents=prompt)
+        except Exception as e:
+            status = getattr(e, "code", None)
+            raise LLMCallError(f"{type(e).__name__}: {e}", status, status in RETRY_STATUSES or isinstance(e, OSError)) from e
+        return response_text(response)
+
+
+class ThreadBackend:
+    """A synchronous genai style client (e.g. llm_cache.FakeClient), called from worker threads."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def generate(self, model, prompt, timeout):
+        response = await asyncio.to_thread(self.client.models.generate_content, model=model, contents=prompt)
+        return response_text(response)
+
+
+class HTTPBackend:
+    """Gemini's generateContent REST call over a pool of keep-alive connections.
+
+    Works against any server that speaks the same API, such as llm_stub_server.
+    A pooled connection the server has closed in the meantime is replaced and
+    the request sent once more before it counts as a failed attempt.
+    """
+
+    def __init__(self, base_url, api_key=None, pool_size=LLM_CONCURRENCY):
+        parts = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.api_key = api_key
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.connections_opened = 0
+
+    async def generate(self, model, prompt, timeout):
+        return await asyncio.to_thread(self.request, model, prompt, timeout)
+
+    def request(self, model, prompt, timeout):
+        body = json.dumps({"contents": [{"role": "user", "parts": [{"text": prompt}]}]})
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["x-goog-api-key"] = self.api_key
+
+        connection, reused = self.connection(timeout)
+        try:
+            response, data = self.send(connection, model, body, headers, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            if not reused:
+                raise LLMCallError(f"Connection to {self.host} failed: {e!r}", retryable=True) from e
+            connection = self.open(timeout)
+            try:
+                response, data = self.send(connection, model, body, headers, timeout)
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise LLMCallError(f"Connection to {self.host} failed: {e!r}", retryable=True) from e
+        self.release(connection)
+
+        if response.status != 200:
+            raise LLMCallError(f"LLM server error {response.status}: {data[:200]!r}", response.status, response.status in RETRY_STATUSES)
+        try:
+            return json.loads(data)["candidates"][0]["content"]["parts"][0]["text"]
+        except (ValueError, KeyError, IndexError) as e:
+            raise LLMCallError(f"Unexpected LLM response: {data[:200]!r}") from e
+
+    def send(self, connection, model, body, headers, timeout):
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.timeout = timeout
+        connection.request("POST", f"{self.prefix}/v1beta/models/{model}:generateContent", body, headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    # a pooled connection if there is one, else a new one.
+    def connection(self, timeout):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return self.open(timeout), False
+
+    def open(self, timeout):
+        self.connections_opened += 1
+        return self.connection_class(self.host, timeout=timeout)
+
+    def release(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+class AsyncLLMClient:
+    """The one LLM client of a process: cached, rate limited, concurrent, with deadlines and retries.
+
+    Calls run on the client's own event loop, so the synchronous CLI can use
+    complete() and complete_many() while the backend keeps its connections
+    between calls. A call that has not succeeded by its deadline raises
+    TimeoutError, one that keeps failing raises LLMCallError, so callers can
+    fall back to what they had without the LLM. With `parse` a call returns
+    parse(text), and an answer parse raises ValueError on is not cached.
+    """
+
+    def __init__(self, backend, cache=None, namespace="gemini", model=LLM_MODEL, deadline=LLM_DEADLINE,
+                 retries=LLM_RETRIES, backoff=LLM_BACKOFF, rate=LLM_RATE, burst=LLM_BURST, concurrency=LLM_CONCURRENCY):
+        self.backend = backend
+        self.cache = cache
+        self.namespace = namespace
+        self.model = model
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+        # threaded backends get a thread per call in flight.
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm"))
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.calls = 0
+        self.cache_hits = 0
+        self.attempts = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.call_seconds = 0.0
+
+    async def generate(self, prompt, deadline=None, parse=None):
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.namespace, self.model, prompt)
+            text = self.cache.get(key)
+            if text is not None:
+                self.cache_hits += 1
+                return parse(text) if parse is not None else text
+
+        self.calls += 1
+        start = time.monotonic()
+        expires = start + (deadline if deadline is not None else self.deadline)
+        try:
+            text = await self.attempt(prompt, expires)
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+        except LLMCallError:
+            self.failures += 1
+            raise
+        seconds = time.monotonic() - start
+        self.call_seconds += seconds
+        result = text
+        if parse is not None:
+            try:
+                result = parse(text)
+            except ValueError:
+                self.rejected += 1
+                raise
+        if self.cache is not None:
+            self.cache.put(key, self.model, text, seconds)
+        return result
+
+    # tries up to 1 + retries times, backing off between attempts, all before `expires`.
+    async def attempt(self, prompt, expires):
+        wait = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.wait_for(self.send(prompt, expires), expires - time.monotonic())
+            except LLMCallError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+            self.retried += 1
+            pause = wait * random.uniform(0.5, 1.5)
+            if time.monotonic() + pause >= expires:
+                raise TimeoutError(f"LLM call did not succeed within its deadline after {attempt + 1} attempts")
+            await asyncio.sleep(pause)
+            wait *= 2
+
+    async def send(self, prompt, expires):
+        await self.bucket.acquire()
+        async with self.slots:
+            self.attempts += 1
+            return await self.backend.generate(self.model, prompt, max(expires - time.monotonic(), 0.001))
+
+    # the text of one prompt, or parse(text) with a parse function.
+    def complete(self, prompt, deadline=None, parse=None):
+        return self.loop.run_until_complete(self.generate(prompt, deadline, parse))
+
+    # the texts of independent prompts, asked concurrently under one shared deadline. `parse` is one
+    # function for every prompt or a list of one per prompt. a prompt that failed (or whose answer
+    # did not parse) has its exception in place of its text.
+    def complete_many(self, prompts, deadline=None, parse=None):
+        parses = parse if isinstance(parse, list) else [parse] * len(prompts)
+
+        async def gather():
+            return await asyncio.gather(*(self.generate(prompt, deadline, parse) for prompt, parse in zip(prompts, parses)),
+                                        return_exceptions=True)
+        return self.loop.run_until_complete(gather())
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "attempts": self.attempts,
+            "retries": self.retried,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "mean_call_ms": self.call_seconds / (self.calls - self.timeouts - self.failures) * 1000
+            if self.calls > self.timeouts + self.failures else 0.0,
+        }
+
+    def close(self):
+        self.loop.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+# the shared client: Gemini through google-genai, any Gemini compatible server at `url`
+# (with GEMINI_API_KEY from the environment, if it needs one), or the offline fake client.
+# responses are cached unless `cache` is False.
+def make_llm_client(url=None, fake=False, cache=True, **options):
+    if fake:
+        backend, namespace = ThreadBackend(FakeClient()), "fake"
+    elif url:
+        backend, namespace = HTTPBackend(url, os.environ.get("GEMINI_API_KEY")), f"http:{url}"
+    else:
+        # dotenv and google-genai are only imported when Gemini itself is called.
+        from dotenv import load_dotenv
+        from google import genai
+
+        load_dotenv()
+        backend, namespace = GenaiBackend(genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))), "gemini"
+    return AsyncLLMClient(backend, LLMResponseCache() if cache else None, namespace, **options)
+
+
+def print_llm_stats(stats):
+    print(f"LLM client: {stats['calls']} calls ({stats['cache_hits']} more answered by the cache), "
+          f"{stats['attempts']} attempts, {stats['retries']} retries, {stats['timeouts']} timeouts, "
+          f"{stats['failures']} failures, {stats['rejected']} unusable answers, {stats['mean_call_ms']:.1f} ms per call")
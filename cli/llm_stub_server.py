@@ -0,0 +1,105 @@
+from config import LLM_STUB_PORT, SERVER_HOST
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_cache import fake_response
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+
+class StubBehaviour:
+    """How the stand-in answers: after `latency` plus up to `jitter` seconds, failing `fail_rate` of the calls."""
+
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.connections = 0
+
+    def delay_and_fail(self):
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            fail = self.random.random() < self.fail_rate
+            self.failed += 1 if fail else 0
+        time.sleep(delay)
+        return fail
+
+
+# a Gemini generateContent endpoint that answers with llm_cache.fake_response, on keep-alive connections.
+def make_handler(behaviour):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with behaviour.lock:
+                behaviour.connections += 1
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if not re.fullmatch(r"/v1beta/models/[^/:]+:generateContent", self.path):
+                self.send_json(404, {"error": {"code": 404, "message": f"Unknown path '{self.path}'"}})
+                return
+            try:
+                prompt = json.loads(body)["contents"][0]["parts"][0]["text"]
+            except (ValueError, KeyError, IndexError):
+                self.send_json(400, {"error": {"code": 400, "message": "Expected contents[0].parts[0].text"}})
+                return
+
+            if behaviour.delay_and_fail():
+                self.send_json(503, {"error": {"code": 503, "message": "Injected failure"}})
+                return
+            self.send_json(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": fake_response(prompt)}]}}]})
+
+        # a client past its deadline may have hung up by the time the answer is ready.
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini API, with injected latency and failures")
+    parser.add_argument("--host", default=SERVER_HOST, help=f"Address to listen on (default: {SERVER_HOST})")
+    parser.add_argument("--port", type=int, default=LLM_STUB_PORT, help=f"Port to listen on (default: {LLM_STUB_PORT})")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds every answer takes (default: 0.2)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds, at random (default: 0)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of calls answered with a 503 (default: 0)")
+    parser.add_argument("--seed", type=int, help="Seed of the injected jitter and failures")
+    args = parser.parse_args()
+
+    behaviour = StubBehaviour(args.latency, args.jitter, args.fail_rate, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(behaviour))
+    print(f"Stand-in LLM on http://{args.host}:{args.port}, use it with --llm-url", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Answered {behaviour.requests} requests ({behaviour.failed} failed) on {behaviour.connections} connections", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import numpy as np
+import os
+
+PRECISIONS = ("float32", "float16", "int8", "binary")
+
+# codes are widened to float32 this many rows at a time, a block small enough to stay in cache.
+SCORE_BATCH = 1024
+
+
+class QuantizedVectors:
+    """Compact codes of unit length vectors, scored in a first pass.
+
+    float16 halves the matrix, int8 stores round(x / scale) with one scale per
+    dimension, binary keeps only the sign bits and scores by Hamming distance
+    (popcount of the xor). The scores only rank rows; exact scores come from
+    rescoring a shortlist against the full precision vectors.
+    """
+
+    def __init__(self, precision, codes, scale=None, dim=None):
+        self.precision = precision
+        self.codes = codes
+        self.scale = scale
+        self.dim = dim if dim is not None else codes.shape[1]
+
+    # the vectors are scaled to unit length before they are encoded.
+    @classmethod
+    def encode(cls, vectors, precision):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+        if precision == "float16":
+            return cls(precision, vectors.astype(np.float16))
+        if precision == "int8":
+            scale = np.abs(vectors).max(axis=0) / 127
+            scale[scale == 0] = 1
+            codes = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+            return cls(precision, codes, scale.astype(np.float32))
+        if precision == "binary":
+            return cls(precision, np.packbits(vectors > 0, axis=1), dim=vectors.shape[1])
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    # approximate similarity of one unit length query with the given rows (all rows when None).
+    def scores(self, query, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.precision == "binary":
+            bits = np.packbits(np.asarray(query) > 0)
+            hamming = np.bitwise_count(np.bitwise_xor(codes, bits)).sum(axis=1, dtype=np.int32)
+            # same order as cosine of the sign vectors.
+            return (self.dim - 2 * hamming).astype(np.float32) / self.dim
+
+        weights = np.asarray(query, dtype=np.float32)
+        if self.precision == "int8":
+            weights = weights * self.scale
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BATCH):
+            scores[start:start + SCORE_BATCH] = codes[start:start + SCORE_BATCH].astype(np.float32) @ weights
+        return scores
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {"codes": self.codes, "dim": np.array(self.dim)}
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path, precision):
+        with np.load(path) as data:
+            scale = data["scale"] if "scale" in data else None
+            return cls(precision, data["codes"], scale, int(data["dim"]))
+
+
+# where the codes of an embeddings file are saved, e.g. cache/chunk_embeddings.int8.npz
+def codes_path(embeddings_path, precision):
+    return f"{os.path.splitext(embeddings_path)[0]}.{precision}.npz"
+
+
+# saved codes are reused while they are newer than the embeddings and cover as many vectors,
+# otherwise they are encoded and saved.
+def load_or_create_codes(embeddings_path, vectors, precision):
+    path = codes_path(embeddings_path, precision)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(embeddings_path):
+        quantized = QuantizedVectors.load(path, precision)
+        if len(quantized) == len(vectors):
+            return quantized
+    quantized = QuantizedVectors.encode(vectors, precision)
+    quantized.save(path)
+    return quantized
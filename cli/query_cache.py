@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fcntl
+import json
+import numpy as np
+import os
+
+QUERY_CACHE_SIZE = 4096
+# entries of the disk tier, past this it is compacted to the newest half (about 1.5 kB each at 384 dims).
+QUERY_CACHE_DISK_SIZE = 65536
+
+
+class QueryEmbeddingCache:
+    """Query embeddings cached in memory (lru) and, optionally, on disk.
+
+    Keys are the model name plus the query lowercased with its whitespace
+    collapsed, which the uncased tokenizer of the model does not tell apart.
+    The disk tier is an append-only file of float32 vectors and a jsonl index
+    of key -> (offset, dim, encode seconds) next to it. Vectors are appended
+    before their key, so a crash can leave an unused vector but never a key
+    without one. Writers hold an exclusive flock on `path`.lock and readers a
+    shared one, so several processes can share the tier: offsets are taken
+    at the end of the file under the lock, keys other processes appended are
+    read on a miss, and a compaction never swaps the files under a reader.
+    """
+
+    def __init__(self, model_name, max_size=QUERY_CACHE_SIZE, path=None, max_disk_size=QUERY_CACHE_DISK_SIZE):
+        self.model_name = model_name
+        self.max_size = max_size
+        # vectors go to `path`.f32 and the index to `path`.keys.jsonl
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.memory = OrderedDict()
+        # key -> (offset, dim, seconds) of the disk tier, as of the last refresh.
+        self.disk = {}
+        # bytes of the keys file read into self.disk, and the inode of that file, which a compaction replaces.
+        self._disk_read = 0
+        self._disk_inode = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def key(self, text):
+        return f"{self.model_name}\x00{' '.join(text.lower().split())}"
+
+    @property
+    def vectors_path(self):
+        return f"{self.path}.f32"
+
+    @property
+    def keys_path(self):
+        return f"{self.path}.keys.jsonl"
+
+    @property
+    def lock_path(self):
+        return f"{self.path}.lock"
+
+    # holds the flock of the disk tier for the with block, LOCK_SH to read and LOCK_EX to write.
+    @contextmanager
+    def locked(self, operation):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    # reads the keys appended since the last refresh, or all of them once the file was compacted.
+    # a line cut short by a crash is skipped. needs the lock.
+    def refresh(self):
+        try:
+            stat = os.stat(self.keys_path)
+        except FileNotFoundError:
+            self.disk, self._disk_read, self._disk_inode = {}, 0, None
+            return
+        if stat.st_ino != self._disk_inode or stat.st_size < self._disk_read:
+            self.disk, self._disk_read, self._disk_inode = {}, 0, stat.st_ino
+        if stat.st_size == self._disk_read:
+            return
+
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._disk_read)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self.disk[entry["key"]] = (entry["offset"], entry["dim"], entry["seconds"])
+        self._disk_read += end
+
+    # the cached embedding of a query, or None. a disk hit is promoted to the memory tier.
+    def get(self, text):
+        key = self.key(text)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            self.seconds_saved += entry[1]
+            return entry[0]
+
+        if self.path is not None:
+            with self.locked(fcntl.LOCK_SH):
+                self.refresh()
+                vector = None
+                if key in self.disk:
+                    offset, dim, seconds = self.disk[key]
+                    with open(self.vectors_path, "rb") as f:
+                        f.seek(offset)
+                        vector = np.frombuffer(f.read(dim * 4), dtype=np.float32)
+            if vector is not None and len(vector) == dim:
+                self.remember(key, vector, seconds)
+                self.disk_hits += 1
+                self.seconds_saved += seconds
+                return vector
+
+        self.misses += 1
+        return None
+
+    # caches the embedding of a query that took `seconds` to encode.
+    def put(self, text, vector, seconds):
+        key = self.key(text)
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        self.remember(key, vector, seconds)
+
+        if self.path is not None:
+            with self.locked(fcntl.LOCK_EX):
+                self.refresh()
+                if key in self.disk:
+                    return
+                with open(self.vectors_path, "ab") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(vector.tobytes())
+                with open(self.keys_path, "ab") as f:
+                    # a line a crash cut short is ended first, so it does not swallow this one.
+                    if f.seek(0, os.SEEK_END) > self._disk_read:
+                        f.write(b"\n")
+                    f.write((json.dumps({"key": key, "offset": offset, "dim": len(vector), "seconds": seconds}) + "\n").encode())
+                self.refresh()
+                if len(self.disk) > self.max_disk_size:
+                    self.compact()
+
+    # rewrites the disk tier with its newest max_disk_size // 2 entries. needs the exclusive lock.
+    def compact(self):
+        keep = list(self.disk.items())[-(self.max_disk_size // 2):] if self.max_disk_size > 1 else []
+        with open(self.vectors_path, "rb") as source, open(f"{self.vectors_path}.tmp", "wb") as vectors, \
+                open(f"{self.keys_path}.tmp", "w") as keys:
+            for key, (offset, dim, seconds) in keep:
+                source.seek(offset)
+                data = source.read(dim * 4)
+                if len(data) != dim * 4:
+                    continue
+                keys.write(json.dumps({"key": key, "offset": vectors.tell(), "dim": dim, "seconds": seconds}) + "\n")
+                vectors.write(data)
+        os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+        os.replace(f"{self.keys_path}.tmp", self.keys_path)
+        self.refresh()
+
+    def remember(self, key, vector, seconds):
+        self.memory[key] = (vector, seconds)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "size": len(self.memory),
+            "disk_size": len(self.disk),
+            "encode_seconds_saved": self.seconds_saved,
+        }
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+# pairs scored per predict call.
+RERANK_BATCH_SIZE = 16
+PAIR_CACHE_SIZE = 16384
+PAIR_CACHE_PATH = "cache/rerank_scores.sqlite"
+# pair scores kept on disk, past this the least recently used are evicted.
+PAIR_CACHE_MAX_ENTRIES = 100000
+
+
+class CrossEncoderReranker:
+    """Reranks search results with a cross-encoder loaded once, scoring (query, doc) pairs in batches.
+
+    Pair scores are cached in memory (lru) and in SQLite, keyed by the model,
+    the normalized query, the doc id and a hash of the text the model saw,
+    so an edited movie is scored again. Like the LLM response cache, the
+    SQLite tier is shared safely by concurrent processes and keeps its
+    `max_entries` most recently used scores. Only uncached pairs reach the
+    model, every one of them is scored.
+    """
+
+    def __init__(self, model_name=CROSS_ENCODER_MODEL, batch_size=RERANK_BATCH_SIZE,
+                 cache_size=PAIR_CACHE_SIZE, cache_path=PAIR_CACHE_PATH, max_entries=PAIR_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self._model = None
+        self._db = None
+        self.memory = OrderedDict()
+        self.totals = {"queries": 0, "pairs": 0, "cache_hits": 0, "scored": 0, "seconds": 0.0}
+
+    # sentence_transformers is only imported, and the model only loaded, by the first pair to score.
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import CrossEncoder
+            self._model = CrossEncoder(self.model_name)
+        return self._model
+
+    # keeps the pair scores at another path from now on, or in memory only with None.
+    def use_cache_path(self, cache_path):
+        if cache_path != self.cache_path and self._db is not None:
+            self._db.close()
+            self._db = None
+        self.cache_path = cache_path
+
+    # the disk tier, opened the first time it is needed.
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.cache_path)
+            with self._db:
+                self._db.execute("CREATE TABLE IF NOT EXISTS pair_scores (key TEXT PRIMARY KEY, score REAL, last_used REAL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS pair_scores_last_used ON pair_scores (last_used)")
+        return self._db
+
+    def key(self, query, doc_id, text):
+        text_hash = hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+        payload = json.dumps([self.model_name, " ".join(query.lower().split()), doc_id, text_hash])
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    # the cached score of every key, None where there is none. disk hits are looked up in one query.
+    def cached_scores(self, keys):
+        scores = [self.memory.get(key) for key in keys]
+        for key, score in zip(keys, scores):
+            if score is not None:
+                self.memory.move_to_end(key)
+        missing = list({key for key, score in zip(keys, scores) if score is None})
+        if self.cache_path is None or not missing:
+            return scores
+
+        placeholders = ",".join("?" * len(missing))
+        found = dict(self.db.execute(f"SELECT key, score FROM pair_scores WHERE key IN ({placeholders})", missing))
+        if found:
+            with self.db:
+                self.db.execute(f"UPDATE pair_scores SET last_used = ? WHERE key IN ({','.join('?' * len(found))})",
+                                [time.time(), *found])
+            for key, score in found.items():
+                self.remember(key, score)
+        return [found.get(key) if score is None else score for key, score in zip(keys, scores)]
+
+    def remember(self, key, score):
+        self.memory[key] = score
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.cache_size:
+            self.memory.popitem(last=False)
+
+    # caches scored (key, score) pairs, then drops the least recently used past max_entries.
+    def store(self, scored):
+        for key, score in scored:
+            self.remember(key, score)
+        if self.cache_path is None:
+            return
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO pair_scores (key, score, last_used) VALUES (?, ?, ?)",
+                                [(key, score, now) for key, score in scored])
+            self.db.execute(
+                "DELETE FROM pair_scores WHERE key IN "
+                "(SELECT key FROM pair_scores ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def rerank(self, query, results, limit):
+        """The top `limit` of the results by cross-encoder score, each with a "cross_encoder_score",
+        and the stats of this call: pairs, cache_hits, scored, batches and latency_ms."""
+        start = time.perf_counter()
+        texts = [f"{result.get('title', '')} - {result.get('document', '')}" for result in results]
+        keys = [self.key(query, result.get("id"), text) for result, text in zip(results, texts)]
+        scores = self.cached_scores(keys)
+        stats = {"pairs": len(results), "cache_hits": sum(score is not None for score in scores), "scored": 0, "batches": 0}
+
+        # uncached pairs are scored a batch at a time.
+        pending = [i for i, score in enumerate(scores) if score is None]
+        for position in range(0, len(pending), self.batch_size):
+            batch = pending[position:position + self.batch_size]
+            predicted = self.model.predict([[query, texts[i]] for i in batch], batch_size=self.batch_size)
+            for i, score in zip(batch, predicted):
+                scores[i] = float(score)
+            self.store([(keys[i], scores[i]) for i in batch])
+            stats["scored"] += len(batch)
+            stats["batches"] += 1
+
+        for result, score in zip(results, scores):
+            result["cross_encoder_score"] = score
+        reranked = sorted(results, key=lambda x: x["cross_encoder_score"], reverse=True)
+        stats["latency_ms"] = (time.perf_counter() - start) * 1000
+
+        self.totals["queries"] += 1
+        for name in ("pairs", "cache_hits", "scored"):
+            self.totals[name] += stats[name]
+        self.totals["seconds"] += stats["latency_ms"] / 1000
+        return reranked[:limit], stats
+
+
+_reranker_instance = None
+
+# one shared reranker, so the model is loaded once per process. `cache` keeps the pair scores on disk too,
+# like the batch size it applies to every call, not just the first.
+def get_reranker(batch_size=RERANK_BATCH_SIZE, cache=True):
+    global _reranker_instance
+    if _reranker_instance is None:
+        _reranker_instance = CrossEncoderReranker(batch_size=batch_size)
+    _reranker_instance.batch_size = batch_size
+    _reranker_instance.use_cache_path(PAIR_CACHE_PATH if cache else None)
+    return _reranker_instance
+
+
+def print_rerank_stats(stats):
+    print(f"Reranked {stats['pairs']} pairs in {stats['latency_ms']:.1f} ms: {stats['cache_hits']} cached, "
+          f"{stats['scored']} scored in {stats['batches']} batches")
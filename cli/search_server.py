@@ -0,0 +1,234 @@
+from config import SERVER_HOST, SERVER_PORT, load_movies
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tracing import span, trace
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+# a cold query can take a while if the server is still warming up.
+CLIENT_TIMEOUT = 60
+
+
+class SearchService:
+    """Loads HybridSearch (model, chunk and movie embeddings, inverted index) once
+    and answers queries against it, keeping request counts and latencies.
+
+    Searches run one at a time: the query cache and the model are not thread
+    safe, and numpy already spreads a single search over the cores. With
+    `trace_requests` the stages of every search add up in the stats.
+    """
+
+    def __init__(self, documents, trace_requests=False, query_cache_path=None):
+        from hybrid_search import HybridSearch
+
+        start = time.perf_counter()
+        self.hybrid = HybridSearch(documents, query_cache_path)
+        self.hybrid.semantic_search.load_or_create_embeddings(documents)
+        # loads the model now, rather than in the first request.
+        self.hybrid.semantic_search.model
+        self.load_seconds = time.perf_counter() - start
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.requests = {}
+        self.trace_requests = trace_requests
+        self.stages = {}
+
+    def weighted(self, query, alpha=0.5, limit=5, candidate_depth=None):
+        return self.hybrid.weighted_search(query, alpha, limit, candidate_depth)
+
+    def rrf(self, query, k=60, limit=5, candidate_depth=None):
+        return self.hybrid.rrf_search(query, k, limit, candidate_depth)
+
+    def keyword(self, query, limit=5):
+        results = self.hybrid.idx.bm25_search(query, limit)
+        return [
+            {"id": doc_id, "title": self.hybrid.idx.docmap[doc_id]["title"], "score": score}
+            for doc_id, score in results.items()
+        ]
+
+    def semantic(self, query, limit=5):
+        return [
+            {"id": doc["id"], "title": doc["title"], "document": doc.get("description", "")[:100], "score": score}
+            for score, doc in self.hybrid.semantic_search.search(query, limit)
+        ]
+
+    def semantic_chunked(self, query, limit=5):
+        return self.hybrid.semantic_search.search_chunks(query, limit)
+
+    # runs one search and records its latency under its endpoint. with `profile` (or
+    # trace_requests) it is traced, and the report of its stages is returned with the results.
+    def handle(self, endpoint, params, profile=False):
+        start = time.perf_counter()
+        failed = True
+        traced = profile or self.trace_requests
+        try:
+            with trace() if traced else nullcontext() as current:
+                # waiting for the search before this one shows up as a stage of its own.
+                with span("lock_wait"):
+                    self.lock.acquire()
+                try:
+                    with span(endpoint):
+                        results = getattr(self, endpoint)(**params)
+                finally:
+                    self.lock.release()
+            failed = False
+            report = current.report() if traced else None
+            if self.trace_requests:
+                self.record_stages(report)
+            return results, report if profile else None
+        finally:
+            self.record(endpoint, time.perf_counter() - start, failed)
+
+    def record(self, endpoint, seconds, failed=False):
+        with self.stats_lock:
+            entry = self.requests.setdefault(endpoint, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["errors"] += 1 if failed else 0
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+
+    def record_stages(self, report):
+        with self.stats_lock:
+            for entry in report["spans"]:
+                stage = self.stages.setdefault(entry["name"], {"count": 0, "total_ms": 0.0})
+                stage["count"] += 1
+                stage["total_ms"] += entry["ms"]
+
+    def health(self):
+        return {
+            "status": "ok",
+            "uptime_seconds": time.time() - self.started,
+            "load_seconds": self.load_seconds,
+            "documents": len(self.hybrid.documents),
+        }
+
+    def stats(self):
+        with self.stats_lock:
+            requests = {
+                endpoint: dict(entry, mean_ms=entry["total_ms"] / entry["count"] if entry["count"] else 0.0)
+                for endpoint, entry in self.requests.items()
+            }
+            stages = {
+                name: dict(entry, mean_ms=entry["total_ms"] / entry["count"])
+                for name, entry in self.stages.items()
+            }
+        return {
+            "requests": requests,
+            "stages": stages,
+            "query_cache": self.hybrid.semantic_search.query_cache.stats(),
+            "uptime_seconds": time.time() - self.started,
+        }
+
+
+# POST /search/<endpoint> with a JSON body of the keyword arguments of the SearchService method.
+SEARCH_ENDPOINTS = ("weighted", "rrf", "keyword", "semantic", "semantic_chunked")
+
+
+def make_handler(service):
+    class SearchHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, service.health())
+            elif self.path == "/stats":
+                self.send_json(200, service.stats())
+            else:
+                self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+
+        def do_POST(self):
+            endpoint = self.path.removeprefix("/search/")
+            if not self.path.startswith("/search/") or endpoint not in SEARCH_ENDPOINTS:
+                self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+                return
+            start = time.perf_counter()
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(params, dict):
+                    raise TypeError("Expected a JSON object of search parameters")
+                profile = bool(params.pop("profile", False))
+                results, report = service.handle(endpoint, params, profile)
+            except (ValueError, TypeError, KeyError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {"error": repr(e)})
+                return
+            payload = {"results": results, "latency_ms": (time.perf_counter() - start) * 1000}
+            # hybrid results carry their per stage timings.
+            if hasattr(results, "timings"):
+                payload["timings"] = results.timings
+            if report is not None:
+                payload["trace"] = report
+            self.send_json(200, payload)
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload, default=to_json).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+    return SearchHandler
+
+
+# numpy scalars in the results become plain numbers.
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+# POST to a running server, returns the decoded JSON answer.
+def query_server(url, endpoint, **params):
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/search/{endpoint}",
+        data=json.dumps(params).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=CLIENT_TIMEOUT) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"Search server error {e.code}: {json.loads(e.read()).get('error')}")
+    except urllib.error.URLError as e:
+        raise ConnectionError(f"No search server at {url} ({e.reason}), start one with `python cli/search_server.py`")
+
+
+def main():
+    from semantic_search import QUERY_CACHE_PATH
+
+    parser = argparse.ArgumentParser(description="Search server that keeps the models and indexes loaded")
+    parser.add_argument("--host", default=SERVER_HOST, help=f"Address to listen on (default: {SERVER_HOST})")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help=f"Port to listen on (default: {SERVER_PORT})")
+    parser.add_argument("--trace", action="store_true", help="Time the stages of every search, their totals are in /stats")
+    parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+    args = parser.parse_args()
+
+    service = SearchService(load_movies()["movies"], args.trace, QUERY_CACHE_PATH if args.query_cache else None)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Loaded in {service.load_seconds:.1f}s, serving on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
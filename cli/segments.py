@@ -0,0 +1,122 @@
+from bm25_engine import BM25Engine, find_postings
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class Segment:
+    """One immutable BM25Engine plus the docs deleted from it since it was written.
+
+    Deletes are tombstones: sorted doc positions that searches leave out and
+    that are subtracted from the segment's N, total length and df.
+    """
+
+    def __init__(self, engine, docmap, path=None, deleted_ids=()):
+        self.engine = engine
+        self.docmap = docmap
+        self.path = path
+        self.deleted = np.zeros(0, dtype=np.int64)
+        self.live_count = engine.n_docs
+        self.live_length = int(engine.doc_len.sum())
+        for doc_id in deleted_ids:
+            self.delete(doc_id)
+
+    # position of a doc that is in this segment and not deleted.
+    def position(self, doc_id):
+        pos = self.engine.doc_position(doc_id)
+        if pos is None or len(find_postings(self.deleted, np.array([pos]))):
+            return None
+        return pos
+
+    def delete(self, doc_id):
+        pos = self.position(doc_id)
+        if pos is None:
+            return False
+        self.deleted = np.insert(self.deleted, np.searchsorted(self.deleted, pos), pos)
+        self.live_count -= 1
+        self.live_length -= int(self.engine.doc_len[pos])
+        return True
+
+    def df(self, term):
+        doc_idx, _ = self.engine.postings(term)
+        return len(doc_idx) - len(find_postings(doc_idx, self.deleted))
+
+    def live_doc_ids(self):
+        live = np.ones(self.engine.n_docs, dtype=bool)
+        live[self.deleted] = False
+        return self.engine.doc_ids[live]
+
+    def deleted_ids(self):
+        return self.engine.doc_ids[self.deleted].tolist()
+
+    def search(self, tokens, limit, k1, b, prune, stats):
+        deleted = self.deleted if len(self.deleted) else None
+        return self.engine.search(tokens, limit, k1, b, prune, stats, deleted)
+
+
+class SegmentedDocMap(Mapping):
+    """docmap over the live docs of every segment, newest segment first."""
+
+    def __init__(self, get_segments):
+        self.get_segments = get_segments
+
+    def __getitem__(self, doc_id):
+        for segment in reversed(self.get_segments()):
+            if segment.position(doc_id) is not None:
+                return segment.docmap[doc_id]
+        raise KeyError(doc_id)
+
+    def __iter__(self):
+        for segment in self.get_segments():
+            yield from segment.live_doc_ids().tolist()
+
+    def __len__(self):
+        return sum(segment.live_count for segment in self.get_segments())
+
+
+# compaction: one engine with the live postings of all segments, laid out as a fresh build would be.
+def merge_segments(segments):
+    terms = sorted(set().union(*(segment.engine.vocab for segment in segments)))
+    vocab = {term: i for i, term in enumerate(terms)}
+
+    post_terms, post_ids, post_tfs, live_ids, live_lens = [], [], [], [], []
+    for segment in segments:
+        engine = segment.engine
+        live = np.ones(engine.n_docs, dtype=bool)
+        live[segment.deleted] = False
+
+        rows = np.array([vocab[term] for term in engine.vocab], dtype=np.int64)
+        keep = live[engine.post_doc_idx]
+        post_terms.append(np.repeat(rows, np.diff(engine.offsets))[keep])
+        post_ids.append(engine.doc_ids[engine.post_doc_idx[keep]])
+        post_tfs.append(engine.post_tf[keep])
+        live_ids.append(engine.doc_ids[live])
+        live_lens.append(engine.doc_len[live])
+
+    doc_ids = np.concatenate(live_ids)
+    order = np.argsort(doc_ids, kind="stable")
+    doc_ids = doc_ids[order]
+    doc_len = np.concatenate(live_lens)[order].astype(np.int32)
+
+    post_term = np.concatenate(post_terms)
+    post_doc_idx = np.searchsorted(doc_ids, np.concatenate(post_ids))
+    post_tf = np.concatenate(post_tfs)
+
+    # terms whose every doc was deleted leave the vocabulary.
+    counts = np.bincount(post_term, minlength=len(terms))
+    present = counts > 0
+    post_term = (np.cumsum(present) - 1)[post_term]
+    terms = [term for term, keep in zip(terms, present.tolist()) if keep]
+
+    order = np.lexsort((post_doc_idx, post_term))
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[present])
+
+    return BM25Engine(
+        {term: i for i, term in enumerate(terms)},
+        offsets,
+        post_doc_idx[order].astype(np.int32),
+        post_tf[order].astype(np.int32),
+        doc_ids,
+        doc_len,
+    )
@@ -1,72 +1,211 @@
-from copyreg import pickle
-from sentence_transformers import SentenceTransformer
+from config import load_movies
+from ann_index import IVFIndex, recall_at_k
+from quantization import PRECISIONS, QuantizedVectors, load_or_create_codes
+from query_cache import QueryEmbeddingCache
+from tracing import span
 
+import hashlib
 import numpy as np
 import os
-import json
 import re
+import time
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+MOVIE_EMBEDDINGS_PATH = "cache/movie_embeddings.npy"
+CHUNK_EMBEDDINGS_PATH = "cache/chunk_embeddings.npy"
+CHUNK_METADATA_PATH = "cache/chunk_metadata.npy"
+# written by older versions without content hashes, those chunks are re-embedded and the file removed.
+CHUNK_METADATA_JSON_PATH = "cache/chunk_metadata.json"
+# content hash of the text behind every row of the embeddings, so a rebuild only encodes what changed.
+MOVIE_HASHES_PATH = "cache/movie_embeddings.hashes.npy"
+CHUNK_HASHES_PATH = "cache/chunk_embeddings.hashes.npy"
+# hash of every movie description the chunks were cut from, to tell without chunking if they are current.
+CHUNK_SOURCE_HASHES_PATH = "cache/chunk_embeddings.sources.npy"
+
+MOVIE_ANN_PATH = "cache/movie_embeddings.ivf.npz"
+CHUNK_ANN_PATH = "cache/chunk_embeddings.ivf.npz"
+# lists of the ann index compared with each query, more is slower with a higher recall.
+DEFAULT_NPROBE = 8
+# rows of a quantized first pass rescored exactly, per result asked for.
+RESCORE_FACTOR = 10
+# disk tier of the query embedding cache when enabled with --query-cache, by default the cache is in memory only.
+QUERY_CACHE_PATH = "cache/query_embeddings"
+
 
 class SemanticSearch:
 
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, query_cache_path=None):
+        self._model = None
+        # embeddings of queries seen before, so a repeated query skips the model.
+        self.query_cache = QueryEmbeddingCache(MODEL_NAME, path=query_cache_path)
+        # memory mapped from MOVIE_EMBEDDINGS_PATH, pages are read on demand and shared by every process.
         self.embeddings = None
+        # 1 / norm of every embedding, cosine similarity is the dot product times this.
+        self._inverse_norms = None
         self.documents = None
         self.document_map = {}
-
-    # it generates embedding for a single text.
+        # reused / embedded / dropped counts of the last build of the embeddings.
+        self.build_stats = None
+        # optional ivf index, when set searches only score the rows of the `nprobe` closest lists.
+        self.ann = None
+        self.nprobe = DEFAULT_NPROBE
+        # optional compact codes of the embeddings, when set the codes pick a shortlist per query
+        # and only those rows of the float32 vectors are read and rescored.
+        self.quantized = None
+        self.rescore_factor = RESCORE_FACTOR
+
+    # sentence_transformers (and torch with it) is only imported, and the model only loaded,
+    # the first time something needs to be encoded.
+    @property
+    def model(self):
+        if self._model is None:
+            with span("load_model"):
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(MODEL_NAME)
+        return self._model
+
+    # it generates embedding for a single text, or takes it from the query cache.
     def generate_embedding(self, text):
         if len(text.split()) == 0:
             raise ValueError("Empty Text")
-        embedding = self.model.encode([text])[0]
+        embedding = self.query_cache.get(text)
+        if embedding is None:
+            start = time.perf_counter()
+            with span("encode"):
+                embedding = self.model.encode([text])[0]
+            self.query_cache.put(text, embedding, time.perf_counter() - start)
         return embedding
 
     # it generates embedding of the whole doc via batch processing.
+    # movies whose text hashes to a row of the saved embeddings reuse that row, only the rest is encoded.
     def build_embeddings(self, documents):
         self.documents = documents
         for each in self.documents:
             self.document_map[each["id"]] = each
 
         texts = [f"{doc['title']}: {doc['description']}" for doc in self.documents]
-        self.embeddings = self.model.encode(texts, show_progress_bar=True)
-        np.save("cache/movie_embeddings.npy", self.embeddings)
+        hashes = content_hashes(texts)
+        embeddings, self.build_stats = reuse_or_encode(
+            self.model, texts, hashes, *load_hashed(MOVIE_EMBEDDINGS_PATH, MOVIE_HASHES_PATH)
+        )
+        save_hashed(MOVIE_EMBEDDINGS_PATH, embeddings, MOVIE_HASHES_PATH, hashes)
+        self.set_embeddings(np.load(MOVIE_EMBEDDINGS_PATH, mmap_mode="r"))
         return self.embeddings
 
     # it checks if the embeddings are computed and stored, and if stored, are they updated?
-    # if they are, loaded in, and if not, then recomputed.
+    # if they are, loaded in, and if not, then only the new or edited movies are recomputed.
     def load_or_create_embeddings(self, documents):
         self.documents = documents
         for each in self.documents:
             self.document_map[each["id"]] = each
+        self.build_stats = None
         
-        if os.path.exists("cache/movie_embeddings.npy"):
-            self.embeddings = np.load("cache/movie_embeddings.npy")
-            if len(self.embeddings) == len(documents):
+        if os.path.exists(MOVIE_EMBEDDINGS_PATH) and os.path.exists(MOVIE_HASHES_PATH):
+            hashes = content_hashes(f"{doc['title']}: {doc['description']}" for doc in documents)
+            if np.array_equal(np.load(MOVIE_HASHES_PATH), hashes):
+                self.set_embeddings(np.load(MOVIE_EMBEDDINGS_PATH, mmap_mode="r"))
                 return self.embeddings
         return self.build_embeddings(documents)
 
+    # what was derived from the previous embeddings is dropped with them.
+    def set_embeddings(self, embeddings):
+        self.embeddings = embeddings
+        self._inverse_norms = None
+        self.quantized = None
+
+    # computed on the first brute force search, shortlist searches only normalize their own rows.
+    @property
+    def inverse_norms(self):
+        if self._inverse_norms is None:
+            self._inverse_norms = inverse_norms(self.embeddings)
+        return self._inverse_norms
+
     # it embeds the query using the generate_embeddings and then ranks the movies based on their score.
-    # calculated via cosine similarity func.
+    # the cosine similarity against every movie is one matrix-vector product.
     def search(self, query, limit=5):
+        return self.search_vectors([self.generate_embedding(query)], limit)[0]
+
+    # all the queries are scored in one matrix-matrix product.
+    def search_many(self, queries, limit=5):
+        return self.search_vectors(self.embed_queries(queries), limit)
+
+    # one embedding per query as a matrix, the queries missing from the query cache are encoded in one batch.
+    def embed_queries(self, queries):
+        queries = list(queries)
+        for query in queries:
+            if len(query.split()) == 0:
+                raise ValueError("Empty Text")
+
+        embeddings = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            start = time.perf_counter()
+            with span("encode"):
+                encoded = self.model.encode([queries[i] for i in missing])
+            seconds = (time.perf_counter() - start) / len(missing)
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self.query_cache.put(queries[i], embedding, seconds)
+        return np.stack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+    # returns one list of (score, movie) per query vector, best first.
+    # with an ann index or quantized codes the shortlist of each query is rescored exactly,
+    # `exact` asks for brute force over the float32 vectors instead.
+    def search_vectors(self, query_vectors, limit=5, exact=False):
         if self.embeddings is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
-        final_list = []
-        query_embed = self.generate_embedding(query)
-        for i in range(len(self.embeddings)):
-            cosine_scr = cosine_similarity(self.embeddings[i], query_embed)
-            mov_iden = self.documents[i]
-            final_list.append((cosine_scr, mov_iden))
+        queries = normalize_rows(np.asarray(query_vectors))
 
-        final_list.sort(key=lambda x: x[0], reverse=True)
-        return final_list[:limit]
+        if exact or (self.ann is None and self.quantized is None):
+            scores = (queries @ self.embeddings.T) * self.inverse_norms
+            top = top_k_indices(scores, limit)
+            return [
+                [(scores[q, i], self.documents[i]) for i in top[q].tolist()]
+                for q in range(len(scores))
+            ]
+
+        results = []
+        for query in queries:
+            rows = self.ann.candidates(query, self.nprobe) if self.ann is not None else None
+            rows, scores = score_rows(query, self.embeddings, self.quantized, rows, limit * self.rescore_factor)
+            top = top_k_indices(scores, limit)[0]
+            results.append([(scores[i], self.documents[rows[i]]) for i in top.tolist()])
+        return results
+
+    # loads the ivf index of the movie embeddings, or builds and saves it if it is missing or stale.
+    def load_or_create_ann_index(self, n_lists=None, rebuild=False):
+        self.ann = load_or_create_ivf(MOVIE_ANN_PATH, self.embeddings, MOVIE_EMBEDDINGS_PATH, n_lists, rebuild)
+        return self.ann
+
+    # searches go through codes of the given precision ("float32" drops the codes and searches the
+    # vectors directly), the float32 vectors are only touched for the rows of each shortlist.
+    def use_precision(self, precision):
+        if precision == "float32":
+            self.quantized = None
+        elif self.quantized is None or self.quantized.precision != precision:
+            self.quantized = load_or_create_codes(MOVIE_EMBEDDINGS_PATH, self.embeddings, precision)
+
+    # recall@k of the ann search for a query against brute force.
+    def search_recall(self, query, limit=5):
+        query_embedding = self.generate_embedding(query)
+        approx = self.search_vectors([query_embedding], limit)[0]
+        exact = self.search_vectors([query_embedding], limit, exact=True)[0]
+        return recall_at_k([doc["id"] for _, doc in approx], [doc["id"] for _, doc in exact])
 
 
 class ChunkedSemanticSearch(SemanticSearch):
 
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, query_cache_path=None) -> None:
+        super().__init__(query_cache_path)
         self.chunk_embeddings = None
+        # one (movie_idx, chunk_idx, total_chunks) row per chunk, sorted by movie.
+        # both are memory mapped like self.embeddings.
         self.chunk_metadata = None
+        self._chunk_inverse_norms = None
+        self._chunk_starts = None
+        self.chunk_ann = None
+        self.chunk_quantized = None
 
     def semantic_chunk(self, text, max_chunk_size=4, overlap=1):
         """Split text into semantic chunks by sentences"""
@@ -125,6 +264,7 @@ class ChunkedSemanticSearch(SemanticSearch):
         
         all_chunks = []
         chunk_metadata = []
+        sources = content_hashes(doc.get("description", "") for doc in documents)
 
         # first each movie is fetched iteratively and then chunked.
         # then each chunk is added to a all_chunks list and then,
@@ -145,17 +285,20 @@ class ChunkedSemanticSearch(SemanticSearch):
                     "total_chunks": len(chunks)
                 })
         
-        # Generate embeddings
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_metadata
+        # Generate embeddings, chunks whose text was embedded before reuse their vector
+        hashes = content_hashes(all_chunks)
+        embeddings, self.build_stats = reuse_or_encode(
+            self.model, all_chunks, hashes, *load_hashed(CHUNK_EMBEDDINGS_PATH, CHUNK_HASHES_PATH)
+        )
         
         # Save to cache
-        os.makedirs("cache", exist_ok=True)
-        np.save("cache/chunk_embeddings.npy", self.chunk_embeddings)
-        
-        with open("cache/chunk_metadata.json", "w") as f:
-            json.dump(chunk_metadata, f, indent=2)
-        
+        save_hashed(CHUNK_EMBEDDINGS_PATH, embeddings, CHUNK_HASHES_PATH, hashes)
+        save_array(CHUNK_METADATA_PATH, chunk_metadata_array(chunk_metadata))
+        save_array(CHUNK_SOURCE_HASHES_PATH, sources)
+        if os.path.exists(CHUNK_METADATA_JSON_PATH):
+            os.remove(CHUNK_METADATA_JSON_PATH)
+
+        self.set_chunks(np.load(CHUNK_EMBEDDINGS_PATH, mmap_mode="r"), np.load(CHUNK_METADATA_PATH, mmap_mode="r"))
         return self.chunk_embeddings
 
 
@@ -167,107 +310,323 @@ class ChunkedSemanticSearch(SemanticSearch):
         self.document_map = {}
         for doc in documents:
             self.document_map[doc["id"]] = doc
+        self.build_stats = None
 
         
-        if os.path.exists("cache/chunk_embeddings.npy") and os.path.exists("cache/chunk_metadata.json"):
-            self.chunk_embeddings = np.load("cache/chunk_embeddings.npy")
-            
-            with open("cache/chunk_metadata.json", "r") as f:
-                metadata = json.load(f)
-                self.chunk_metadata = metadata
-            
-            return self.chunk_embeddings
-        else:
-            return self.build_chunk_embeddings(documents)
-
-
+        # the chunks are current while every description hashes the same as when they were cut.
+        if all(os.path.exists(path) for path in (CHUNK_EMBEDDINGS_PATH, CHUNK_METADATA_PATH, CHUNK_HASHES_PATH, CHUNK_SOURCE_HASHES_PATH)):
+            sources = content_hashes(doc.get("description", "") for doc in documents)
+            if np.array_equal(np.load(CHUNK_SOURCE_HASHES_PATH), sources):
+                self.set_chunks(np.load(CHUNK_EMBEDDINGS_PATH, mmap_mode="r"), np.load(CHUNK_METADATA_PATH, mmap_mode="r"))
+                return self.chunk_embeddings
+        return self.build_chunk_embeddings(documents)
+
+
+
+    # the rows must be sorted by movie, as build_chunk_embeddings saves them,
+    # so each movie's chunks are one run for the segmented max in search_chunks.
+    def set_chunks(self, embeddings, metadata):
+        self.chunk_embeddings = embeddings
+        self.chunk_metadata = chunk_metadata_array(metadata)
+        self._chunk_inverse_norms = None
+        self._chunk_starts = None
+        self.chunk_quantized = None
+
+    @property
+    def chunk_inverse_norms(self):
+        if self._chunk_inverse_norms is None:
+            self._chunk_inverse_norms = inverse_norms(self.chunk_embeddings)
+        return self._chunk_inverse_norms
+
+    # first chunk row of every movie that has chunks.
+    @property
+    def chunk_starts(self):
+        if self._chunk_starts is None:
+            self._chunk_starts = run_starts(self.chunk_metadata["movie_idx"])
+        return self._chunk_starts
 
     def search_chunks(self, query, limit=10):
         """Search across chunk embeddings and aggregate results by document"""
 
         # availability of self.embeddings is checked,
         # embedding of query is created,
-        # then score is calculated against each chunk,
-        # then movies meta data is appended to a temp variable,
-        # only movie id and score is appended to a another temp variable,
-        # if higher score of a chunk is found for a movie id,
-        # then the score is updated to the higher score,
-        # and returned after sorting in decreasing order
+        # then the scores of all chunks are one matrix-vector product,
+        # the max score per movie is a segmented max over each movie's run of chunks,
+        # and only the best `limit` movies are sorted.
         if self.chunk_embeddings is None:
             raise ValueError("No chunk embeddings loaded. call load_or_create_chunk_embeddings first.")
         
         # Generate query embedding
-        query_embedding = self.generate_embedding(query)
-        
-        # Calculate similarity scores for all chunks
-        chunk_scores = []
-        for i, chunk_embedding in enumerate(self.chunk_embeddings):
-            score = cosine_similarity(chunk_embedding, query_embedding)
-            metadata = self.chunk_metadata[i]
-            chunk_scores.append({
-                "chunk_idx": metadata["chunk_idx"],
-                "movie_idx": metadata["movie_idx"],
-                "score": score
-            })
-        
-        # Aggregate scores by movie (keep highest score per movie)
-        movie_scores = {}
-        for chunk_score in chunk_scores:
-            movie_idx = chunk_score["movie_idx"]
-            score = chunk_score["score"]
-            
-            # It repalces the score with the higher score for each movie index.
-            if movie_idx not in movie_scores or score > movie_scores[movie_idx]:
-                movie_scores[movie_idx] = score
-        
-        # Sort by score descending
-        sorted_movies = sorted(movie_scores.items(), key=lambda x: x[1], reverse=True)
-        
-        # Take top limit results
-        top_movies = sorted_movies[:limit]
-        
+        with span("embed"):
+            query_embedding = self.generate_embedding(query)
+        with span("semantic"):
+            return self.rank_chunks(query_embedding, limit)
+
+    # returns the best `limit` movies for a query vector, with the chunk that won for each movie.
+    # with an ann index or quantized codes only the shortlisted chunks are scored, exactly,
+    # `exact` asks for brute force over the float32 vectors instead.
+    def rank_chunks(self, query_embedding, limit=10, exact=False):
+        return self.format_movies(*self.rank_movies(query_embedding, limit, exact))
+
+    # rank_chunks as arrays: the movie positions, their scores and the index of their best chunk.
+    def rank_movies(self, query_embedding, limit=10, exact=False):
+        query = normalize_rows(query_embedding)
+        with span("score_chunks"):
+            if exact or (self.chunk_ann is None and self.chunk_quantized is None):
+                rows = np.arange(len(self.chunk_metadata))
+                scores = (self.chunk_embeddings @ query) * self.chunk_inverse_norms
+                starts = self.chunk_starts
+            else:
+                # shortlisted rows are sorted, so they still come in runs per movie.
+                rows = self.chunk_ann.candidates(query, self.nprobe) if self.chunk_ann is not None else None
+                rows, scores = score_rows(query, self.chunk_embeddings, self.chunk_quantized, rows, limit * self.rescore_factor)
+                starts = run_starts(self.chunk_metadata["movie_idx"][rows])
+        with span("best_movies"):
+            return self.best_movies(rows, scores, starts, limit)
+
+    def rank_chunks_many(self, query_embeddings, limit=10):
+        return [self.format_movies(*ranked) for ranked in self.rank_movies_many(query_embeddings, limit)]
+
+    # rank_movies for many query vectors, each scored with the matrix-vector product of rank_movies.
+    # one matrix-matrix product for all of them rounds the scores differently, so movies whose
+    # scores tie could come back in another order than from the same query on its own.
+    def rank_movies_many(self, query_embeddings, limit=10):
+        return [self.rank_movies(query_embedding, limit) for query_embedding in query_embeddings]
+
+    # the best `limit` movies from the scores of the chunk `rows`, whose runs per movie begin at `starts`.
+    def best_movies(self, rows, scores, starts, limit):
+        if len(rows) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, np.zeros(0, dtype=np.float32), empty
+
+        # Aggregate scores by movie (keep highest score per movie, and the first chunk that has it)
+        movie_scores = np.maximum.reduceat(scores, starts)
+        run_lengths = np.diff(np.r_[starts, len(scores)])
+        is_best = scores == np.repeat(movie_scores, run_lengths)
+        best = np.minimum.reduceat(np.where(is_best, np.arange(len(scores)), len(scores)), starts)
+        best_rows = rows[best]
+
+        # Take top limit results, their metadata is gathered in one go
+        top = top_k_indices(movie_scores, limit)[0]
+        metadata = self.chunk_metadata[best_rows[top]]
+        return metadata["movie_idx"], movie_scores[top], metadata["chunk_idx"]
+
+    def format_movies(self, movie_idx, scores, chunk_idx):
         # Format results
         results = []
-        for movie_idx, score in top_movies:
-            doc = self.documents[movie_idx]
+        for movie, score, chunk in zip(movie_idx.tolist(), scores.tolist(), chunk_idx.tolist()):
+            doc = self.documents[movie]
             results.append({
                 "id": doc["id"],
                 "title": doc["title"],
                 "document": doc.get("description", "")[:100],
                 "score": round(score, 4),
+                "chunk_idx": chunk,
             })
         
         return results
 
+    # loads the ivf index of the chunk embeddings, or builds and saves it if it is missing or stale.
+    def load_or_create_chunk_ann_index(self, n_lists=None, rebuild=False):
+        self.chunk_ann = load_or_create_ivf(CHUNK_ANN_PATH, self.chunk_embeddings, CHUNK_EMBEDDINGS_PATH, n_lists, rebuild)
+        return self.chunk_ann
 
+    # same as use_precision for the chunk embeddings.
+    def use_chunk_precision(self, precision):
+        if precision == "float32":
+            self.chunk_quantized = None
+        elif self.chunk_quantized is None or self.chunk_quantized.precision != precision:
+            self.chunk_quantized = load_or_create_codes(CHUNK_EMBEDDINGS_PATH, self.chunk_embeddings, precision)
 
-semantic_instance = SemanticSearch()
+    # recall@k of the ann chunk search for a query against brute force.
+    def search_chunks_recall(self, query, limit=10):
+        query_embedding = self.generate_embedding(query)
+        approx = self.rank_chunks(query_embedding, limit)
+        exact = self.rank_chunks(query_embedding, limit, exact=True)
+        return recall_at_k([r["id"] for r in approx], [r["id"] for r in exact])
+
+
+
+# the saved index is reused while it is newer than the embeddings and was built over as many vectors.
+def load_or_create_ivf(path, vectors, embeddings_path, n_lists=None, rebuild=False):
+    if not rebuild and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(embeddings_path):
+        ann = IVFIndex.load(path)
+        if ann.n_vectors == len(vectors):
+            return ann
+    ann = IVFIndex.build(normalize_rows(vectors), n_lists)
+    ann.save(path)
+    return ann
+
+# exact cosine scores of `rows` (all rows when None) for one unit length query, returned with the sorted rows.
+# with quantized codes the codes score the rows first, and only their best `shortlist` rows are
+# read from the float32 vectors and rescored.
+def score_rows(query, vectors, quantized=None, rows=None, shortlist=None):
+    if quantized is not None:
+        keep = np.sort(top_k_indices(quantized.scores(query, rows), shortlist)[0])
+        rows = keep if rows is None else rows[keep]
+    elif rows is None:
+        rows = np.arange(len(vectors))
+    return rows, normalize_rows(vectors[rows]) @ query
+
+# 1 / norm of every row, 0 for rows of zeros like in cosine_similarity.
+# einsum sums the squares without a squared copy of the whole matrix.
+def inverse_norms(matrix):
+    norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix, dtype=np.float32))
+    return np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+
+# index where every run of equal values starts.
+def run_starts(values):
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+
+# 16 byte digest of every text, for the model that embeds it, as one fixed width bytes array.
+def content_hashes(texts):
+    prefix = f"{MODEL_NAME}\x00".encode()
+    return np.array([hashlib.blake2b(prefix + text.encode(), digest_size=16).digest() for text in texts], dtype="S16")
+
+# the saved vectors (memory mapped) and their hashes, or (None, None) when either is missing.
+def load_hashed(vectors_path, hashes_path):
+    if not os.path.exists(vectors_path) or not os.path.exists(hashes_path):
+        return None, None
+    return np.load(vectors_path, mmap_mode="r"), np.load(hashes_path)
+
+# embeddings of `texts`: rows of `old_vectors` whose hash matches are copied, only the other texts are encoded.
+# returns them with the counts of reused, embedded and dropped (old rows no text needs any more) vectors.
+def reuse_or_encode(model, texts, hashes, old_vectors, old_hashes):
+    if old_vectors is None or len(old_vectors) == 0:
+        embeddings = model.encode(texts, show_progress_bar=True)
+        return embeddings, {"reused": 0, "embedded": len(texts), "dropped": 0 if old_vectors is None else len(old_vectors)}
+
+    old_rows = {h: row for row, h in enumerate(old_hashes.tolist())}
+    rows = np.array([old_rows.get(h, -1) for h in hashes.tolist()], dtype=np.int64)
+    reused = rows >= 0
+    missing = np.flatnonzero(~reused)
+
+    embeddings = np.empty((len(texts), old_vectors.shape[1]), dtype=old_vectors.dtype)
+    embeddings[reused] = old_vectors[rows[reused]]
+    if len(missing):
+        embeddings[missing] = model.encode([texts[i] for i in missing.tolist()], show_progress_bar=True)
+    kept = len(np.unique(rows[reused]))
+    return embeddings, {"reused": int(reused.sum()), "embedded": len(missing), "dropped": len(old_vectors) - kept}
+
+# writes the vectors and their hashes. the hashes go last and are removed first, so a crash in
+# between leaves vectors without hashes, which are re-embedded, never hashes of other vectors.
+def save_hashed(vectors_path, vectors, hashes_path, hashes):
+    if os.path.exists(hashes_path):
+        os.remove(hashes_path)
+    save_array(vectors_path, vectors)
+    save_array(hashes_path, hashes)
+
+# np.save through a temporary file and a rename: processes that still map the old file keep reading it.
+def save_array(path, array):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+# memory footprint and recall@limit against float32 brute force of every precision, first pass alone
+# and after rescoring. the queries default to a seeded sample of the stored vectors, so no model is needed.
+def precision_report(vectors_path, queries=None, n_queries=100, limit=10, rescore_factor=RESCORE_FACTOR):
+    full = np.load(vectors_path, mmap_mode="r")
+    normalized = normalize_rows(full)
+    if queries is None:
+        sample = np.random.default_rng(0).choice(len(normalized), min(n_queries, len(normalized)), replace=False)
+        queries = normalized[np.sort(sample)]
+    queries = normalize_rows(queries)
+    exact = top_k_indices(queries @ normalized.T, limit)
+
+    report = []
+    for precision in PRECISIONS:
+        if precision == "float32":
+            report.append({"precision": precision, "bytes": normalized.nbytes, "first_pass_recall": 1.0, "recall": 1.0})
+            continue
+        quantized = QuantizedVectors.encode(normalized, precision)
+        first_pass, rescored = [], []
+        for query, truth in zip(queries, exact.tolist()):
+            first_pass.append(recall_at_k(top_k_indices(quantized.scores(query), limit)[0].tolist(), truth))
+            rows, scores = score_rows(query, full, quantized, None, limit * rescore_factor)
+            rescored.append(recall_at_k(rows[top_k_indices(scores, limit)[0]].tolist(), truth))
+        report.append({
+            "precision": precision,
+            "bytes": quantized.nbytes,
+            "first_pass_recall": float(np.mean(first_pass)),
+            "recall": float(np.mean(rescored)),
+        })
+    return report
+
+_semantic_instance = None
+
+# one shared instance for the helpers below, created on first use.
+def get_semantic_instance():
+    global _semantic_instance
+    if _semantic_instance is None:
+        _semantic_instance = ChunkedSemanticSearch()
+    return _semantic_instance
 
 def verify_embeddings():
-    path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-    with open(path, "r") as f:
-        movies_data = json.load(f)
-    documents = movies_data["movies"]
+    documents = load_movies()["movies"]
+    semantic_instance = get_semantic_instance()
     result = semantic_instance.load_or_create_embeddings(documents)
     print(f"Number of docs:   {len(documents)}")
+    if semantic_instance.build_stats:
+        print_build_stats(semantic_instance.build_stats)
     print(f"Embeddings shape: {result.shape[0]} vectors in {result.shape[1]} dimensions")   
 
+def print_query_cache_stats(stats):
+    print(f"Query cache: {stats['hits']} hits, {stats['disk_hits']} disk hits, {stats['misses']} misses "
+          f"({stats['hit_rate']:.0%}), {stats['encode_seconds_saved'] * 1000:.1f} ms of encoding saved")
+
+def print_build_stats(stats):
+    print(f"Reused {stats['reused']} embeddings, embedded {stats['embedded']}, dropped {stats['dropped']}")
+
 def verify_model():
+    semantic_instance = get_semantic_instance()
     print(f"Model loaded: {semantic_instance.model}")
     print(f"Max sequence length: {semantic_instance.model.max_seq_length}")
 
 def embed_text(text):
-    result = semantic_instance.generate_embedding(text)
+    result = get_semantic_instance().generate_embedding(text)
     print(f"Text: {text}")
     print(f"First 3 dimensions: {result[:3]}")
     print(f"Dimensions: {result.shape[0]}")
 
 def embed_query_text(query):
-    result = semantic_instance.generate_embedding(query)
+    result = get_semantic_instance().generate_embedding(query)
     print(f"Query: {query}")
     print(f"First 5 dimensions: {result[:5]}")
     print(f"Shape: {result.shape}")
 
+CHUNK_METADATA_DTYPE = np.dtype([("movie_idx", np.int32), ("chunk_idx", np.int32), ("total_chunks", np.int32)])
+
+# chunk metadata as a structured array, from a list of (movie_idx, chunk_idx, total_chunks) dicts or an array.
+def chunk_metadata_array(metadata):
+    if isinstance(metadata, np.ndarray):
+        return metadata.astype(CHUNK_METADATA_DTYPE, copy=False)
+    return np.array([(m["movie_idx"], m["chunk_idx"], m["total_chunks"]) for m in metadata], dtype=CHUNK_METADATA_DTYPE)
+
+# scales every row to unit length, rows of zeros stay zero like in cosine_similarity.
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+# indices of the `limit` highest scores of every row, best first, equal scores in index order
+# like a stable sort of the whole row. partition finds the limit-th score without sorting the
+# row, only the scores at least as high (ties at the boundary included) are sorted.
+def top_k_indices(scores, limit):
+    scores = np.atleast_2d(scores)
+    limit = min(limit, scores.shape[1])
+    if limit <= 0:
+        return np.zeros((len(scores), 0), dtype=np.int64)
+    kth = -np.partition(-scores, limit - 1, axis=1)[:, limit - 1]
+    rows, columns = np.nonzero(scores >= kth[:, None])
+    order = np.lexsort((columns, -scores[rows, columns], rows))
+    # every row has at least `limit` of them, its first `limit` are the top.
+    starts = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(scores)))[:-1]))
+    return columns[order][starts[:, None] + np.arange(limit)].astype(np.int64)
+
 def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
     norm1 = np.linalg.norm(vec1)
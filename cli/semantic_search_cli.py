@@ -1,12 +1,20 @@
-from semantic_search import SemanticSearch
+from config import DEFAULT_SERVER_URL, load_movies
+from semantic_search import DEFAULT_NPROBE
+from semantic_search import RESCORE_FACTOR
+from semantic_search import QUERY_CACHE_PATH
+from semantic_search import CHUNK_EMBEDDINGS_PATH
+from semantic_search import MOVIE_EMBEDDINGS_PATH
+from semantic_search import precision_report
+from quantization import PRECISIONS
+from search_server import query_server
+from semantic_search import get_semantic_instance
 from semantic_search import embed_query_text
 from semantic_search import embed_text
 from semantic_search import verify_model
 from semantic_search import verify_embeddings
-from semantic_search import ChunkedSemanticSearch
+from semantic_search import print_build_stats
+from semantic_search import print_query_cache_stats
 import argparse
-import os
-import json
 
 
 parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -25,6 +33,13 @@ embedquery_parser.add_argument("embedquery", type=str, help="query to embed")
 search_parser = subparsers.add_parser("search", help="Search for similar movies")
 search_parser.add_argument("query", type=str, help="Search query")
 search_parser.add_argument("--limit", type=int, default=5, help="Number of results to return (default: 5)")
+search_parser.add_argument("--ann", action="store_true", help="Search through the IVF index instead of brute force")
+search_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help=f"IVF lists probed per query (default: {DEFAULT_NPROBE})")
+search_parser.add_argument("--precision", choices=PRECISIONS, default="float32", help="Precision of the embeddings kept in memory (default: float32)")
+search_parser.add_argument("--recall", action="store_true", help="Also print recall@limit of the ANN or quantized search against brute force")
+search_parser.add_argument("--cache-stats", action="store_true", help="Also print the query embedding cache counters")
+search_parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+search_parser.add_argument("--server", nargs="?", const=DEFAULT_SERVER_URL, help=f"Ask a running search_server instead (default URL: {DEFAULT_SERVER_URL})")
 
 chunk_parser = subparsers.add_parser("chunk", help="chunks the text")
 chunk_parser.add_argument("chunk_text", type=str, help="text to chunk")
@@ -41,12 +56,29 @@ embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Generate chunk
 search_chunked_parser = subparsers.add_parser("search_chunked", help="Search using chunk embeddings")
 search_chunked_parser.add_argument("query", type=str, help="Search query")
 search_chunked_parser.add_argument("--limit", type=int, default=5, help="Number of results to return (default: 5)")
+search_chunked_parser.add_argument("--ann", action="store_true", help="Search through the IVF index instead of brute force")
+search_chunked_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help=f"IVF lists probed per query (default: {DEFAULT_NPROBE})")
+search_chunked_parser.add_argument("--precision", choices=PRECISIONS, default="float32", help="Precision of the chunk embeddings kept in memory (default: float32)")
+search_chunked_parser.add_argument("--recall", action="store_true", help="Also print recall@limit of the ANN or quantized search against brute force")
+search_chunked_parser.add_argument("--cache-stats", action="store_true", help="Also print the query embedding cache counters")
+search_chunked_parser.add_argument("--query-cache", action="store_true", help=f"Also keep the query embeddings on disk, in {QUERY_CACHE_PATH}.*")
+search_chunked_parser.add_argument("--server", nargs="?", const=DEFAULT_SERVER_URL, help=f"Ask a running search_server instead (default URL: {DEFAULT_SERVER_URL})")
+
+build_ann_parser = subparsers.add_parser("build_ann", help="Build the IVF indexes of the movie and chunk embeddings")
+build_ann_parser.add_argument("--lists", type=int, help="Number of IVF lists (default: sqrt of the number of vectors)")
+
+quantize_parser = subparsers.add_parser("quantize_report", help="Memory and recall of every embedding precision")
+quantize_parser.add_argument("queries", type=str, nargs="*", help="Queries to evaluate with (default: a sample of the stored vectors)")
+quantize_parser.add_argument("--chunks", action="store_true", help="Report on the chunk embeddings instead of the movie embeddings")
+quantize_parser.add_argument("--limit", type=int, default=10, help="k of recall@k (default: 10)")
+quantize_parser.add_argument("--rescore-factor", type=int, default=RESCORE_FACTOR, help=f"Rows rescored per result (default: {RESCORE_FACTOR})")
 
 
 def main():
     
     args = parser.parse_args()
-    semantic_instance = SemanticSearch()
+    # shared with the helpers, the model inside is only loaded by commands that encode.
+    semantic_instance = get_semantic_instance()
 
     match args.command:
     
@@ -63,14 +95,25 @@ def main():
             embed_query_text(args.embedquery)
 
         case "search":
-            path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-            with open(path, "r") as f:
-                movies_data = json.load(f)
-            documents = movies_data["movies"]
+            if args.server:
+                for result in query_server(args.server, "semantic", query=args.query, limit=args.limit)["results"]:
+                    print(f"{result['title']} (score: {result['score']})")
+                return
+            if args.query_cache:
+                semantic_instance.query_cache.path = QUERY_CACHE_PATH
+            documents = load_movies()["movies"]
             semantic_instance.load_or_create_embeddings(documents)
+            if args.ann:
+                semantic_instance.load_or_create_ann_index()
+                semantic_instance.nprobe = args.nprobe
+            semantic_instance.use_precision(args.precision)
             result = semantic_instance.search(args.query, args.limit)
             for i in range(len(result)):
                 print(f"{result[i][1]['title']} (score: {result[i][0]})")
+            if (args.ann or args.precision != "float32") and args.recall:
+                print(f"Recall@{args.limit}: {semantic_instance.search_recall(args.query, args.limit):.2f}")
+            if args.cache_stats:
+                print_query_cache_stats(semantic_instance.query_cache.stats())
 
         # just for the test case.
         case "chunk":
@@ -104,30 +147,59 @@ def main():
         # it creates embeddings for the movies directly.
         case "embed_chunks":
             
-            path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-            with open(path, "r") as f:
-                movies_data = json.load(f)
-            documents = movies_data["movies"]
+            documents = load_movies()["movies"]
             
-            chunked_search = ChunkedSemanticSearch()
-            embeddings = chunked_search.load_or_create_chunk_embeddings(documents)
+            embeddings = semantic_instance.load_or_create_chunk_embeddings(documents)
             print(f"Generated {len(embeddings)} chunked embeddings")
+            if semantic_instance.build_stats:
+                print_build_stats(semantic_instance.build_stats)
 
         # it loads or creates the chunk embeddings,
         # score is printed iteratively.
         case "search_chunked":
-            path = os.path.join(os.path.dirname(__file__), "../data/movies.json")
-            with open(path, "r") as f:
-                movies_data = json.load(f)
-            documents = movies_data["movies"]
+            if args.server:
+                results = query_server(args.server, "semantic_chunked", query=args.query, limit=args.limit)["results"]
+                for i, result in enumerate(results, 1):
+                    print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
+                    print(f"   {result['document']}...")
+                return
+            if args.query_cache:
+                semantic_instance.query_cache.path = QUERY_CACHE_PATH
+            documents = load_movies()["movies"]
             
-            chunked_search = ChunkedSemanticSearch()
-            chunked_search.load_or_create_chunk_embeddings(documents)
-            results = chunked_search.search_chunks(args.query, args.limit)
+            semantic_instance.load_or_create_chunk_embeddings(documents)
+            if args.ann:
+                semantic_instance.load_or_create_chunk_ann_index()
+                semantic_instance.nprobe = args.nprobe
+            semantic_instance.use_chunk_precision(args.precision)
+            results = semantic_instance.search_chunks(args.query, args.limit)
             
             for i, result in enumerate(results, 1):
                 print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
                 print(f"   {result['document']}...")
+            if (args.ann or args.precision != "float32") and args.recall:
+                print(f"\nRecall@{args.limit}: {semantic_instance.search_chunks_recall(args.query, args.limit):.2f}")
+            if args.cache_stats:
+                print_query_cache_stats(semantic_instance.query_cache.stats())
+
+        # builds both ivf indexes, rebuilding them if they exist.
+        case "build_ann":
+            documents = load_movies()["movies"]
+            semantic_instance.load_or_create_embeddings(documents)
+            semantic_instance.load_or_create_chunk_embeddings(documents)
+            ann = semantic_instance.load_or_create_ann_index(args.lists, rebuild=True)
+            chunk_ann = semantic_instance.load_or_create_chunk_ann_index(args.lists, rebuild=True)
+            print(f"Movie IVF index: {ann.n_vectors} vectors in {len(ann.centroids)} lists")
+            print(f"Chunk IVF index: {chunk_ann.n_vectors} vectors in {len(chunk_ann.centroids)} lists")
+
+        # the embeddings must exist already, real queries are only encoded if some are given.
+        case "quantize_report":
+            path = CHUNK_EMBEDDINGS_PATH if args.chunks else MOVIE_EMBEDDINGS_PATH
+            queries = semantic_instance.model.encode(args.queries) if args.queries else None
+            report = precision_report(path, queries, limit=args.limit, rescore_factor=args.rescore_factor)
+            print(f"{'precision':<10} {'memory':>12} {'first pass recall@' + str(args.limit):>24} {'rescored recall@' + str(args.limit):>22}")
+            for row in report:
+                print(f"{row['precision']:<10} {row['bytes'] / 2**20:9.2f} MiB {row['first_pass_recall']:24.3f} {row['recall']:22.3f}")
 
         case _:
             parser.print_help()
@@ -0,0 +1,218 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import batched
+
+import numpy as np
+
+from bm25_engine import CorpusStats
+from config import BM25_B, BM25_K1
+from hybrid_search import BATCH_SIZE, HybridSearch, load_index
+from index_store import open_index, write_index
+from InvertedIndex import InvertedIndex, documents_hash
+from semantic_search import CHUNK_EMBEDDINGS_PATH, CHUNK_METADATA_PATH, ChunkedSemanticSearch
+from tracing import span
+from transform import transform
+
+SHARD_PATH = "cache/shards/shard.{}.bin"
+SHARD_MANIFEST_PATH = "cache/shards/manifest.json"
+# one shard per core by default, each served by its own worker process.
+DEFAULT_SHARDS = os.cpu_count() or 1
+
+# the shard a worker process serves, set up by open_shard when the process starts.
+_shard = None
+
+
+class Shard:
+    """One partition of the movies in a worker process: a BM25 engine over its movies
+    and its rows of the chunk embeddings.
+
+    The engine is built (when `documents` are given) and written to its own
+    index file, then memory mapped like the unsharded index. The chunk rows
+    are a slice of the memory mapped chunk embeddings, so a worker only
+    pages in the rows of its own movies.
+    """
+
+    def __init__(self, path, chunk_rows, documents=None):
+        if documents is not None:
+            index = InvertedIndex()
+            index.build({"movies": documents})
+            write_index(path, index.engine, index.docmap)
+        self.engine, _ = open_index(path)
+        self.semantic_search = ChunkedSemanticSearch(query_cache_path=None)
+        start, end = chunk_rows
+        self.semantic_search.set_chunks(
+            np.load(CHUNK_EMBEDDINGS_PATH, mmap_mode="r")[start:end], np.load(CHUNK_METADATA_PATH, mmap_mode="r")[start:end]
+        )
+
+    # the top `limit` of this shard scored with the N, avgdl and df of the whole corpus,
+    # so its scores are the ones the unsharded index gives.
+    def bm25_search(self, tokens, stats, limit, k1=BM25_K1, b=BM25_B):
+        start = time.perf_counter()
+        results = self.engine.search(tokens, limit, k1, b, True, stats)
+        return results, time.perf_counter() - start
+
+    def rank_movies(self, query_embedding, limit):
+        start = time.perf_counter()
+        ranked = self.semantic_search.rank_movies(query_embedding, limit)
+        return ranked, time.perf_counter() - start
+
+
+# the entry points of the worker processes, module level so they can be pickled.
+def open_shard(path, chunk_rows, documents):
+    global _shard
+    _shard = Shard(path, chunk_rows, documents)
+
+
+def shard_ready():
+    return _shard.engine.n_docs
+
+
+def shard_bm25_search(tokens, stats, limit):
+    return _shard.bm25_search(tokens, stats, limit)
+
+
+def shard_rank_movies(query_embedding, limit):
+    return _shard.rank_movies(query_embedding, limit)
+
+
+class ShardedHybridSearch(HybridSearch):
+    """HybridSearch over N shards of the movies, searched in parallel by one worker process each.
+
+    Shards are contiguous ranges of the movies, each with its own keyword
+    index file and its own rows of the chunk embeddings. A query is
+    scattered to every shard and the partial top-k lists are merged exactly:
+    bm25 is scored with the N, avgdl and df of the whole corpus (read from
+    the memory mapped shard indexes here), and ties are broken by id and
+    movie position as in the unsharded search, so the results are the same.
+    The query is embedded here, once, while the shards already run bm25.
+    A shard index is reused while its movies are unchanged, so an edited
+    movie only rebuilds its own shard. The worker processes run until
+    close(), or the end of a with block.
+    """
+
+    def __init__(self, documents, n_shards=DEFAULT_SHARDS, query_cache_path=None):
+        # the model, the query cache and the chunk embeddings, which the shards share.
+        self.load_movies(documents, query_cache_path)
+        self._idx = None
+
+        bounds = np.linspace(0, len(documents), min(n_shards, max(len(documents), 1)) + 1).astype(np.int64)
+        chunk_bounds = np.searchsorted(self.semantic_search.chunk_metadata["movie_idx"], bounds)
+        with span("load_shards"):
+            self.pools, paths = self.start_shards(bounds, chunk_bounds)
+            self.engines = [open_index(path)[0] for path in paths]
+        self.n_docs = sum(engine.n_docs for engine in self.engines)
+        self.total_length = sum(int(engine.doc_len.sum()) for engine in self.engines)
+        # queries of a batch run concurrently, so every shard always has one to work on.
+        self.executor = ThreadPoolExecutor(max_workers=len(self.pools), thread_name_prefix="shard")
+
+    # the unsharded keyword index, for what searches it directly (the keyword endpoint, evaluate),
+    # loaded the first time it is asked for.
+    @property
+    def idx(self):
+        if self._idx is None:
+            self._idx = load_index(self.documents)
+        return self._idx
+
+    # a worker process per shard, the shards whose movies changed since the manifest are rebuilt there.
+    def start_shards(self, bounds, chunk_bounds):
+        manifest = {"shards": []}
+        if os.path.exists(SHARD_MANIFEST_PATH):
+            with open(SHARD_MANIFEST_PATH, "r") as f:
+                manifest = json.load(f)
+        built = {entry["path"]: entry["hash"] for entry in manifest["shards"]}
+
+        # spawned workers start clean, without the threads and the model of this process.
+        context = multiprocessing.get_context("spawn")
+        pools, shards = [], []
+        for i in range(len(bounds) - 1):
+            documents = self.documents[bounds[i]:bounds[i + 1]]
+            path = SHARD_PATH.format(i)
+            digest = documents_hash(documents)
+            stale = built.get(path) != digest or not os.path.exists(path)
+            chunk_rows = (int(chunk_bounds[i]), int(chunk_bounds[i + 1]))
+            pools.append(ProcessPoolExecutor(1, context, initializer=open_shard, initargs=(path, chunk_rows, documents if stale else None)))
+            shards.append({"path": path, "hash": digest})
+
+        # the workers build their shards in parallel, the manifest is only written once all are done.
+        for pool in pools:
+            pool.submit(shard_ready).result()
+        for path in set(built) - {shard["path"] for shard in shards}:
+            if os.path.exists(path):
+                os.remove(path)
+        os.makedirs(os.path.dirname(SHARD_MANIFEST_PATH), exist_ok=True)
+        with open(SHARD_MANIFEST_PATH, "w") as f:
+            json.dump({"shards": shards}, f)
+        return pools, [shard["path"] for shard in shards]
+
+    # N, avgdl and the df of the given terms over all shards.
+    def corpus_stats(self, tokens):
+        df = {token: sum(engine.df(token) for engine in self.engines) for token in set(tokens)}
+        return CorpusStats(self.n_docs, self.total_length / self.n_docs if self.n_docs else 0.0, df)
+
+    # both retrievers for one query at `depth` candidates each, on every shard. the shards run
+    # bm25 while the query is embedded here, then rank their movies. the bm25 and semantic
+    # timings are those of the slowest shard.
+    def _retrieve(self, query, depth, query_embedding=None, ranked=None, semantic_depth=None):
+        start = time.perf_counter()
+        with span("scatter"):
+            tokens = transform(query)
+            stats = self.corpus_stats(tokens)
+            bm25_futures = [pool.submit(shard_bm25_search, tokens, stats, depth) for pool in self.pools]
+        scattered = time.perf_counter()
+
+        if query_embedding is None:
+            with span("embed"):
+                query_embedding = self.semantic_search.generate_embedding(query)
+        embedded = time.perf_counter()
+        semantic_seconds = 0.0
+        if ranked is None or semantic_depth is None:
+            with span("semantic"):
+                replies = [future.result() for future in
+                           [pool.submit(shard_rank_movies, query_embedding, semantic_depth or depth) for pool in self.pools]]
+                ranked = merge_ranked([reply[0] for reply in replies], semantic_depth or depth)
+                semantic_seconds = max(reply[1] for reply in replies)
+
+        with span("bm25"):
+            replies = [future.result() for future in bm25_futures]
+            bm25_results = merge_bm25([reply[0] for reply in replies], depth)
+        timings = {
+            "bm25_ms": max(reply[1] for reply in replies) * 1000,
+            "embed_ms": (embedded - scattered) * 1000,
+            "semantic_ms": semantic_seconds * 1000,
+            "retrieval_ms": (time.perf_counter() - start) * 1000,
+        }
+        return self.candidates(bm25_results, ranked, depth), query_embedding, ranked, timings
+
+    def batch_search(self, queries, method="rrf", alpha=0.5, k=60, limit=5, batch_size=BATCH_SIZE, candidate_depth=None):
+        """Perform weighted or RRF hybrid search for many queries, yielding their results in order"""
+
+        fuse = self.fuser(method, alpha, k, limit)
+        depths = self.candidate_depths(limit, candidate_depth)
+
+        # the queries of a batch are embedded together, then searched concurrently.
+        for batch in batched(queries, batch_size):
+            query_embeddings = self.semantic_search.embed_queries(batch)
+            yield from self.executor.map(lambda item: self._search(item[0], fuse, depths, item[1]), zip(batch, query_embeddings))
+
+    def close(self):
+        super().close()
+        for pool in self.pools:
+            pool.shutdown()
+
+
+# the top `limit` of the shards' bm25 results, by score and then id like a single engine.
+def merge_bm25(results, limit):
+    merged = {}
+    for shard_results in results:
+        merged.update(shard_results)
+    return dict(sorted(merged.items(), key=lambda item: (-item[1], item[0]))[:limit])
+
+
+# the top `limit` of the shards' rank_movies arrays, by score and then movie position like a single shard.
+def merge_ranked(ranked, limit):
+    movie_idx, scores, chunk_idx = (np.concatenate(arrays) for arrays in zip(*ranked))
+    top = np.lexsort((movie_idx, -scores))[:limit]
+    return movie_idx[top], scores[top], chunk_idx[top]
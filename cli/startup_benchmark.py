@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Runs every CLI subcommand in a fresh interpreter and reports how long the
+# import of the CLI module took and how long its first command took after that.
+# Run it from the project root, where the cache/ directory lives.
+
+COMMANDS = {
+    "keyword": [
+        ["keyword_search_cli", "search", "{query}"],
+        ["keyword_search_cli", "tf", "1", "bear"],
+        ["keyword_search_cli", "idf", "bear"],
+        ["keyword_search_cli", "bm25idf", "bear"],
+        ["keyword_search_cli", "bm25tf", "1", "bear"],
+        ["keyword_search_cli", "bm25search", "{query}"],
+    ],
+    "semantic": [
+        ["semantic_search_cli", "chunk", "{query}"],
+        ["semantic_search_cli", "semantic_chunk", "{query}"],
+        ["semantic_search_cli", "verify"],
+        ["semantic_search_cli", "embedquery", "{query}"],
+        ["semantic_search_cli", "search", "{query}"],
+        ["semantic_search_cli", "search_chunked", "{query}"],
+    ],
+    "hybrid": [
+        ["hybrid_search_cli", "weighted-search", "{query}"],
+        ["hybrid_search_cli", "rrf-search", "{query}"],
+    ],
+}
+
+# executed in the child: times the import of the cli module, then its main().
+DRIVER = """
+import contextlib, io, json, sys, time
+module, argv = sys.argv[1], sys.argv[2:]
+sys.argv = [module + ".py"] + argv
+start = time.perf_counter()
+cli = __import__(module)
+imported = time.perf_counter()
+error = None
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        cli.main()
+    except BaseException as e:
+        error = repr(e)
+done = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_query": done - imported, "error": error}))
+"""
+
+
+def run(command):
+    cli_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=cli_dir + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    proc = subprocess.run([sys.executable, "-c", DRIVER, *command], capture_output=True, text=True, env=env)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        return {"import": None, "first_query": None, "error": proc.stderr.strip().splitlines()[-1:]}
+    return json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup latency of the CLI subcommands")
+    parser.add_argument("--only", choices=list(COMMANDS), help="Only benchmark one CLI")
+    parser.add_argument("--query", default="bear in london", help="Query used by the search commands")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for group, commands in COMMANDS.items():
+        if args.only and group != args.only:
+            continue
+        for command in commands:
+            command = [part.format(query=args.query) for part in command]
+            result = run(command)
+            result["command"] = " ".join(command[:2])
+            results.append(result)
+
+            if not args.json:
+                if result["import"] is None:
+                    print(f"{result['command']:<40} failed: {result['error']}")
+                    continue
+                note = f"  ({result['error']})" if result["error"] else ""
+                print(f"{result['command']:<40} import {result['import'] * 1000:8.1f} ms   first query {result['first_query'] * 1000:8.1f} ms{note}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import contextvars
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# the trace spans are recorded into, None when nothing is traced, and the path of the open span.
+# both are context variables, so concurrent server requests each see their own trace, and
+# work handed to another thread through submit() or an asyncio task stays in the caller's spans.
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_path = contextvars.ContextVar("span_path", default="")
+
+# functions shown with a --cprofile breakdown.
+PROFILE_TOP = 15
+
+
+class Trace:
+    """The stages of one traced run: seconds and calls per span, nested spans named parent/child.
+
+    Spans keep the order they were first entered in. A span entered many
+    times, e.g. once per retrieval round, adds up. With `profile` the run
+    is also under cProfile, which sees the tracing thread only.
+    """
+
+    def __init__(self, profile=False):
+        self.spans = {}
+        self.lock = threading.Lock()
+        self.profile = cProfile.Profile() if profile else None
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def open(self, path):
+        with self.lock:
+            self.spans.setdefault(path, [0.0, 0])
+
+    def add(self, path, seconds, calls=1):
+        with self.lock:
+            entry = self.spans.setdefault(path, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    # the spans of a report made elsewhere, e.g. by a search server, as children of the open span.
+    def merge(self, report):
+        prefix = _current_path.get()
+        for entry in report["spans"]:
+            self.add(f"{prefix}/{entry['name']}" if prefix else entry["name"], entry["ms"] / 1000, entry["calls"])
+
+    # the spans depth first: children right after their parent, siblings in the order they were entered.
+    # spans of other threads can be entered in between, so the plain entry order is not enough.
+    def report(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+        with self.lock:
+            spans = dict(self.spans)
+        entered = {path: i for i, path in enumerate(spans)}
+
+        def position(path):
+            parts = path.split("/")
+            return [entered.get("/".join(parts[:i]), len(entered)) for i in range(1, len(parts) + 1)]
+
+        return {
+            "total_ms": seconds * 1000,
+            "spans": [
+                {"name": path, "ms": spans[path][0] * 1000, "calls": spans[path][1]}
+                for path in sorted(spans, key=position)
+            ],
+        }
+
+
+class span:
+    """Times its with block as a stage of the current trace. Outside of a trace it only looks the trace up."""
+
+    __slots__ = ("name", "trace", "path", "token", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        if self.trace is not None:
+            parent = _current_path.get()
+            self.path = f"{parent}/{self.name}" if parent else self.name
+            self.trace.open(self.path)
+            self.token = _current_path.set(self.path)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.path, time.perf_counter() - self.start)
+            _current_path.reset(self.token)
+        return False
+
+
+# a function whose every call is a span, `name` defaults to the function's name.
+def traced(name=None):
+    def decorate(fn):
+        span_name = name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# traces the with block, the Trace it yields holds the spans afterwards.
+@contextmanager
+def trace(profile=False):
+    current = Trace(profile)
+    token = _current_trace.set(current)
+    if current.profile is not None:
+        current.profile.enable()
+    try:
+        yield current
+    finally:
+        if current.profile is not None:
+            current.profile.disable()
+        current.seconds = time.perf_counter() - current.start
+        _current_trace.reset(token)
+
+
+# the trace of the caller, None when it is not traced.
+def current_trace():
+    return _current_trace.get()
+
+
+# executor.submit, with fn running inside the caller's trace and span.
+def submit(executor, fn, *args):
+    if _current_trace.get() is None:
+        return executor.submit(fn, *args)
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def print_trace(report, profile=None, file=sys.stdout):
+    print(f"Profile: {report['total_ms']:.1f} ms in total", file=file)
+    for entry in report["spans"]:
+        depth = entry["name"].count("/")
+        label = "  " * depth + entry["name"].rsplit("/", 1)[-1]
+        calls = f" ({entry['calls']} calls)" if entry["calls"] > 1 else ""
+        print(f"  {label:<32} {entry['ms']:10.1f} ms{calls}", file=file)
+    if profile is not None:
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        print(out.getvalue().strip(), file=file)
@@ -1,6 +1,73 @@
-from config import stemmer_instance, stop_words_list, table
+from config import get_stemmer, load_stop_words, table
+from functools import lru_cache
+
+STEM_CACHE_SIZE = 65536
+
+# joins a batch into one string, it is neither whitespace nor punctuation so it survives lower() and translate().
+BATCH_SEPARATOR = "\x00"
+
+
+class Tokenizer:
+    """lowercase -> strip punctuation -> split -> drop stopwords -> stem.
+
+    Stopwords are a frozenset and stems go through a bounded lru cache, the
+    output is token for token the same as the plain pipeline. The stopwords
+    and the stemmer are only loaded when the first text is tokenized.
+    """
+
+    def __init__(self, stop_words=None, stemmer=None, cache_size=STEM_CACHE_SIZE):
+        self._stop_words = None if stop_words is None else frozenset(stop_words)
+        self._stemmer = stemmer
+        self._stem = None
+        self.cache_size = cache_size
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            self._stop_words = frozenset(load_stop_words())
+        return self._stop_words
+
+    @property
+    def stem(self):
+        if self._stem is None:
+            stemmer = self._stemmer if self._stemmer is not None else get_stemmer()
+            self._stem = lru_cache(maxsize=self.cache_size)(stemmer.stem)
+        return self._stem
+
+    def transform(self, text):
+        stop_words = self.stop_words
+        stem = self.stem
+        return [stem(word) for word in text.lower().translate(table).split() if word not in stop_words]
+
+    # tokenizes many texts with one lower() and one translate() over the whole batch.
+    # falls back to one call per text if a text already contains the separator.
+    def transform_many(self, texts):
+        texts = list(texts)
+        joined = BATCH_SEPARATOR.join(texts)
+        if joined.count(BATCH_SEPARATOR) != max(len(texts) - 1, 0):
+            return [self.transform(text) for text in texts]
+
+        stop_words = self.stop_words
+        stem = self.stem
+        return [
+            [stem(word) for word in part.split() if word not in stop_words]
+            for part in joined.lower().translate(table).split(BATCH_SEPARATOR)
+        ] if texts else []
+
+    def cache_stats(self):
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
+
+
+tokenizer = Tokenizer()
+
 
 def transform(query):
-    tokens = query.lower().translate(table).split()
-    filtered = [word for word in tokens if word not in stop_words_list]
-    return [stemmer_instance.stem(word) for word in filtered]
\ No newline at end of file
+    return tokenizer.transform(query)
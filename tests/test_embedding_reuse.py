@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from benchmark import StubModel, generate_movies
+from semantic_search import ChunkedSemanticSearch, SemanticSearch
+
+# Rebuilding the embeddings after an edit encodes only what changed, in a directory of its own.
+
+N_MOVIES = 50
+STUB_DIM = 16
+
+
+class CountingModel(StubModel):
+    """The stub model, keeping the texts of every encode call."""
+
+    def __init__(self, dim=STUB_DIM):
+        super().__init__(dim)
+        self.encoded = []
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        self.encoded.append(list(texts))
+        return super().encode(texts, show_progress_bar, **kwargs)
+
+
+@pytest.fixture
+def movies(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return generate_movies(N_MOVIES)
+
+
+def edited(movies, position, description):
+    movies = [dict(movie) for movie in movies]
+    movies[position]["description"] = description
+    return movies
+
+
+def test_one_movie_edit_costs_one_encode(movies):
+    model = CountingModel()
+    semantic = SemanticSearch()
+    semantic._model = model
+    before = np.array(semantic.load_or_create_embeddings(movies))
+    assert semantic.build_stats == {"reused": 0, "embedded": N_MOVIES, "dropped": 0}
+
+    # unchanged movies load the saved embeddings without encoding anything.
+    semantic.load_or_create_embeddings(movies)
+    assert semantic.build_stats is None
+    assert len(model.encoded) == 1
+
+    movies = edited(movies, 7, "A bear opens a bakery in the middle of the city.")
+    after = np.array(semantic.load_or_create_embeddings(movies))
+    assert semantic.build_stats == {"reused": N_MOVIES - 1, "embedded": 1, "dropped": 1}
+    assert model.encoded[1] == [f"{movies[7]['title']}: {movies[7]['description']}"]
+    untouched = np.arange(N_MOVIES) != 7
+    assert after[untouched].tobytes() == before[untouched].tobytes()
+    assert np.array_equal(after[7], model.encode([model.encoded[1][0]])[0])
+
+
+def test_one_movie_edit_encodes_only_its_chunks(movies):
+    model = CountingModel()
+    chunked = ChunkedSemanticSearch()
+    chunked._model = model
+    before = np.array(chunked.load_or_create_chunk_embeddings(movies))
+    before_movies = np.array(chunked.chunk_metadata["movie_idx"])
+
+    description = "A bear opens a bakery. The city loves the bread. Then winter comes."
+    movies = edited(movies, 7, description)
+    after = np.array(chunked.load_or_create_chunk_embeddings(movies))
+    after_movies = np.array(chunked.chunk_metadata["movie_idx"])
+    new_chunks = chunked.semantic_chunk(description, max_chunk_size=4, overlap=1)
+    dropped = int((before_movies == 7).sum())
+
+    assert model.encoded[1] == new_chunks
+    assert chunked.build_stats == {"reused": len(after) - len(new_chunks), "embedded": len(new_chunks), "dropped": dropped}
+    assert after[after_movies != 7].tobytes() == before[before_movies != 7].tobytes()
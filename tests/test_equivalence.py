@@ -0,0 +1,206 @@
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from benchmark import StubModel, generate_movies, generate_queries
+from config import BM25_B, BM25_K1
+from hybrid_search import DEPTH_MAX_FACTOR, HybridSearch
+from InvertedIndex import InvertedIndex
+from index_store import write_index
+from semantic_search import ChunkedSemanticSearch, top_k_indices
+from sharded_search import ShardedHybridSearch
+from transform import transform
+
+# The fast paths against the plain computation they replace, on a generated corpus.
+# Caches are relative to the working directory, so every test that writes one runs in its own.
+
+N_MOVIES = 600
+N_QUERIES = 40
+LIMIT = 5
+STUB_DIM = 64
+
+
+@pytest.fixture(scope="module")
+def movies():
+    return generate_movies(N_MOVIES)
+
+
+@pytest.fixture(scope="module")
+def queries():
+    return generate_queries(N_QUERIES)
+
+
+# HybridSearch in a directory of its own, over chunk embeddings built with the stub model first,
+# so the real model is never loaded.
+@pytest.fixture(scope="module")
+def hybrid(movies, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("hybrid"))
+        model = StubModel(STUB_DIM)
+        chunked = ChunkedSemanticSearch()
+        chunked._model = model
+        chunked.build_chunk_embeddings(movies)
+        hybrid = HybridSearch(movies)
+        hybrid.semantic_search._model = model
+        yield hybrid
+
+
+@pytest.fixture(scope="module")
+def index(movies):
+    index = InvertedIndex()
+    index.build({"movies": movies})
+    return index
+
+
+# bm25 term by term over the tokenized movies, the way the index scored before the engine.
+def reference_bm25(movies, query, limit, k1=BM25_K1, b=BM25_B):
+    term_frequencies = {doc["id"]: Counter(transform(f"{doc['title']} {doc['description']}")) for doc in movies}
+    avgdl = sum(sum(counts.values()) for counts in term_frequencies.values()) / len(movies)
+    scores = Counter()
+    for term in transform(query):
+        df = sum(1 for counts in term_frequencies.values() if term in counts)
+        idf = math.log((len(movies) - df + 0.5) / (df + 0.5) + 1)
+        for doc_id, counts in term_frequencies.items():
+            if term in counts:
+                tf = counts[term]
+                length_norm = 1 - b + b * (sum(counts.values()) / avgdl)
+                scores[doc_id] += idf * (tf * (k1 + 1)) / (tf + k1 * length_norm)
+    return dict(sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit])
+
+
+def test_engine_matches_reference_bm25(movies, queries, index):
+    for query in queries:
+        expected = reference_bm25(movies, query, LIMIT)
+        results = index.bm25_search(query, LIMIT, prune=False)
+        # equal scores may fall in another order after float rounding.
+        assert sorted(results) == sorted(expected)
+        assert [results[doc_id] for doc_id in expected] == pytest.approx(list(expected.values()))
+
+
+# the index used to stem query tokens a second time, so "agreed" (agre) was looked up as agr and found
+# nothing, and "hes" (he, a stopword) left no token to score and raised a TypeError.
+def test_query_tokens_are_stemmed_once():
+    index = InvertedIndex()
+    index.build({"movies": [
+        {"id": 1, "title": "Accord", "description": "They agreed on everything."},
+        {"id": 2, "title": "Brothers", "description": "Hes the one, said the man."},
+        {"id": 3, "title": "Other", "description": "Nothing to see here."},
+    ]})
+    assert list(index.bm25_search("agreed")) == [1]
+    assert list(index.bm25_search("hes")) == [2]
+
+
+def test_pruned_search_matches_exhaustive(queries, index):
+    for query in queries:
+        for limit in (1, LIMIT, 50):
+            assert list(index.bm25_search(query, limit).items()) == list(index.bm25_search(query, limit, prune=False).items())
+    assert index.engine.stats["postings_skipped"] > 0
+
+
+# the shards are merged back in order, so the index files are byte for byte the same.
+def test_parallel_build_matches_serial(movies, index, tmp_path):
+    parallel = InvertedIndex()
+    parallel.build({"movies": movies}, workers=4)
+    write_index(str(tmp_path / "serial.bin"), index.engine, index.docmap)
+    write_index(str(tmp_path / "parallel.bin"), parallel.engine, parallel.docmap)
+    assert (tmp_path / "parallel.bin").read_bytes() == (tmp_path / "serial.bin").read_bytes()
+
+
+# ids are the same and scores equal up to float rounding.
+def assert_same_scores(results, expected):
+    assert list(results) == list(expected)
+    assert list(results.values()) == pytest.approx(list(expected.values()))
+
+
+# updates, deletes and adds as delta segments, then compacted, against a build of the edited movies.
+def test_delta_and_compact_match_rebuild(movies, queries, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, added = movies[:500], movies[500:]
+    edited = [dict(doc, description=movies[-1 - i]["description"]) for i, doc in enumerate(base[:20])] + base[40:] + added
+
+    index = InvertedIndex()
+    index.build({"movies": base})
+    index.save()
+    index = InvertedIndex()
+    index.load()
+    assert index.sync(edited) == 20 + 20 + len(added)
+    assert len(index.segments) > 1
+
+    rebuilt = InvertedIndex()
+    rebuilt.build({"movies": edited})
+    for query in queries:
+        assert_same_scores(index.bm25_search(query, LIMIT), rebuilt.bm25_search(query, LIMIT))
+
+    # a reload skips the unchanged movies, and the compacted index scores like the rebuild too.
+    index = InvertedIndex()
+    index.load()
+    assert index.sync(edited) == 0
+    index.compact()
+    assert len(index.segments) == 1
+    assert len(index.docmap) == len(edited)
+    assert all(index.docmap[doc["id"]] == doc for doc in edited)
+    for query in queries:
+        assert_same_scores(index.bm25_search(query, LIMIT), rebuilt.bm25_search(query, LIMIT))
+
+
+# the depth a query settles at changes neither the results nor their scores.
+def test_adaptive_depth_matches_deepest(hybrid, queries):
+    deepest = LIMIT * DEPTH_MAX_FACTOR
+    rounds = []
+    for query in queries:
+        weighted = hybrid.weighted_search(query, 0.5, LIMIT)
+        assert weighted == hybrid.weighted_search(query, 0.5, LIMIT, deepest)
+        rrf = hybrid.rrf_search(query, 60, LIMIT)
+        assert rrf == hybrid.rrf_search(query, 60, LIMIT, deepest)
+        rounds += [weighted.timings["rounds"], rrf.timings["rounds"]]
+    assert min(rounds) < len(hybrid.candidate_depths(LIMIT))
+    assert list(hybrid.batch_search(queries, "weighted", limit=LIMIT)) == [hybrid.weighted_search(query, 0.5, LIMIT, deepest) for query in queries]
+
+
+# a batch scores every query as a single search does, to the last bit, so even movies whose
+# scores tie (the stub model has many) come back in the same order.
+def test_batch_matches_single_searches(hybrid, queries):
+    assert list(hybrid.batch_search(queries, limit=LIMIT)) == [hybrid.rrf_search(query, 60, LIMIT) for query in queries]
+    assert list(hybrid.batch_search(queries, "weighted", 0.5, limit=LIMIT, batch_size=7)) == \
+        [hybrid.weighted_search(query, 0.5, LIMIT) for query in queries]
+
+
+# shards score with the statistics of the whole corpus and merge exactly, so nothing changes.
+def test_sharded_search_matches_unsharded(movies, queries, hybrid):
+    with ShardedHybridSearch(movies, n_shards=3) as sharded:
+        sharded.semantic_search._model = hybrid.semantic_search.model
+        rrf = []
+        for query in queries:
+            assert sharded.weighted_search(query, 0.5, LIMIT) == hybrid.weighted_search(query, 0.5, LIMIT)
+            rrf.append(hybrid.rrf_search(query, 60, LIMIT))
+            assert sharded.rrf_search(query, 60, LIMIT) == rrf[-1]
+        assert list(sharded.batch_search(queries, limit=LIMIT)) == list(hybrid.batch_search(queries, limit=LIMIT))
+        # the unsharded index is there for what searches it directly.
+        assert sharded.idx.bm25_search(queries[0], LIMIT) == hybrid.idx.bm25_search(queries[0], LIMIT)
+    # the with block stopped the workers.
+    with pytest.raises(RuntimeError):
+        sharded.pools[0].submit(len, [])
+
+
+# switching precision swaps the codes, and float32 drops them for the exact search again.
+def test_precision_switches(hybrid, queries):
+    semantic = hybrid.semantic_search
+    exact = [semantic.search_chunks(query, LIMIT) for query in queries]
+    for precision in ("int8", "binary"):
+        semantic.use_chunk_precision(precision)
+        assert semantic.chunk_quantized.precision == precision
+    semantic.use_chunk_precision("float32")
+    assert semantic.chunk_quantized is None
+    assert [semantic.search_chunks(query, LIMIT) for query in queries] == exact
+
+
+# equal scores come back in index order, as from a stable sort of every row, also at the k-th place.
+def test_top_k_keeps_ties_in_index_order():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        scores = rng.integers(0, 4, size=(3, rng.integers(1, 40))).astype(np.float32)
+        for limit in (1, 5, 50):
+            expected = np.argsort(-scores, axis=1, kind="stable")[:, :limit]
+            assert np.array_equal(top_k_indices(scores, limit), expected)
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+import llm_cache
+from llm_cache import PROMPT_VERSION, FakeClient, LLMResponseCache
+from llm_client import AsyncLLMClient, ThreadBackend
+
+# The LLM response cache, in memory or in a temporary file, in front of the offline fake client.
+
+PROMPT = 'Query: "bear movie"'
+
+
+class Clock:
+    """Stands in for time.time() in llm_cache, one second passes on every call."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache, "time", clock)
+    return clock
+
+
+def make_client(fake, cache):
+    return AsyncLLMClient(ThreadBackend(fake), cache, "fake", rate=1000.0)
+
+
+def test_second_call_is_a_hit(tmp_path):
+    fake = FakeClient()
+    client = make_client(fake, LLMResponseCache(str(tmp_path / "llm.sqlite")))
+    assert client.complete(PROMPT) == client.complete(PROMPT) == "bear movie"
+    client.close()
+
+    # and so is the call of the next process.
+    client = make_client(fake, LLMResponseCache(str(tmp_path / "llm.sqlite")))
+    client.complete(PROMPT)
+    assert fake.models.calls == 1
+    assert client.stats()["cache_hits"] == 1
+    client.close()
+
+
+def test_key_versioning():
+    cache = LLMResponseCache(":memory:")
+    key = cache.key("fake", "model", PROMPT)
+    assert key == cache.key("fake", "model", PROMPT, PROMPT_VERSION)
+    assert key != cache.key("fake", "model", PROMPT, PROMPT_VERSION + 1)
+    assert key != cache.key("gemini", "model", PROMPT)
+    assert key != cache.key("fake", "other-model", PROMPT)
+
+    # an answer to an older version of the prompts is never hit.
+    cache.put(cache.key("fake", "model", PROMPT, PROMPT_VERSION - 1), "model", "old answer", 1.0)
+    fake = FakeClient()
+    client = make_client(fake, cache)
+    client.model = "model"
+    assert client.complete(PROMPT) == "bear movie"
+    assert fake.models.calls == 1
+    client.close()
+
+
+def test_ttl_expiry(clock):
+    cache = LLMResponseCache(":memory:", ttl=10)
+    cache.put("key", "model", "answer", 1.0)
+    clock.now += 5
+    assert cache.get("key") == "answer"
+    clock.now += 10
+    assert cache.get("key") is None
+    assert cache.stats()["expired"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_lru_eviction(clock):
+    cache = LLMResponseCache(":memory:", max_entries=3)
+    for key in ("a", "b", "c"):
+        cache.put(key, "model", key.upper(), 1.0)
+    # "a" was used after "b" was written, so "b" is the least recently used.
+    assert cache.get("a") == "A"
+    cache.put("d", "model", "D", 1.0)
+
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in ("a", "c", "d")] == ["A", "C", "D"]
+    assert cache.stats()["size"] == 3
+
+
+# an answer the caller cannot parse is not replayed from the cache.
+def test_unparsable_answer_is_not_cached():
+    answers = iter(["not json", "[2, 0, 1]"])
+    fake = FakeClient(respond=lambda prompt: next(answers))
+    client = make_client(fake, LLMResponseCache(":memory:"))
+    with pytest.raises(ValueError):
+        client.complete(PROMPT, parse=json.loads)
+    assert client.cache.stats()["size"] == 0
+
+    assert client.complete(PROMPT, parse=json.loads) == [2, 0, 1]
+    assert client.complete(PROMPT, parse=json.loads) == [2, 0, 1]
+    assert fake.models.calls == 2
+    assert client.stats()["rejected"] == 1
+    client.close()
@@ -0,0 +1,114 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from llm_cache import FakeClient, LLMResponseCache, fake_response
+from llm_client import AsyncLLMClient, HTTPBackend, LLMCallError, ThreadBackend
+from llm_stub_server import StubBehaviour, make_handler
+
+# The LLM client against llm_stub_server on a free local port, with injected latency and failures.
+
+PROMPTS = [f'Query: "bear movie {i}"' for i in range(8)]
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(latency=0.0, fail_rate=0.0, seed=0):
+        behaviour = StubBehaviour(latency, 0.0, fail_rate, seed)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(behaviour))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}", behaviour
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+# a client without rate limit or backoff to speak of, so the tests only wait on the stub.
+def make_client(backend, **options):
+    options = {"rate": 1000.0, "burst": 100, "backoff": 0.001, **options}
+    return AsyncLLMClient(backend, **options)
+
+
+def test_answers_concurrently_over_pooled_connections(stub_server):
+    url, behaviour = stub_server(latency=0.2)
+    client = make_client(HTTPBackend(url))
+    start = time.monotonic()
+    texts = client.complete_many(PROMPTS)
+    elapsed = time.monotonic() - start
+    client.close()
+
+    assert texts == [fake_response(prompt) for prompt in PROMPTS]
+    # one after the other the calls would take 8 x 0.2 seconds.
+    assert elapsed < 0.2 * len(PROMPTS) / 2
+    assert client.stats()["mean_call_ms"] >= 200
+    assert behaviour.requests == len(PROMPTS)
+
+
+def test_retries_injected_failures(stub_server):
+    url, behaviour = stub_server(fail_rate=0.3)
+    client = make_client(HTTPBackend(url), retries=10)
+    texts = client.complete_many(PROMPTS * 4)
+    client.close()
+
+    assert texts == [fake_response(prompt) for prompt in PROMPTS * 4]
+    stats = client.stats()
+    assert behaviour.failed > 0
+    assert stats["retries"] == behaviour.failed
+    assert stats["attempts"] == behaviour.requests
+    assert stats["failures"] == 0
+
+
+def test_gives_up_after_the_retries(stub_server):
+    url, behaviour = stub_server(fail_rate=1.0)
+    client = make_client(HTTPBackend(url), retries=2)
+    with pytest.raises(LLMCallError) as error:
+        client.complete(PROMPTS[0])
+    client.close()
+
+    assert error.value.status == 503
+    assert behaviour.requests == 3
+    assert client.stats()["failures"] == 1
+
+
+# the deadline --llm-deadline sets covers the call itself and its retries.
+def test_deadline(stub_server):
+    url, _ = stub_server(latency=0.5)
+    client = make_client(HTTPBackend(url), deadline=0.1)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        client.complete(PROMPTS[0])
+    assert time.monotonic() - start < 0.4
+    responses = client.complete_many(PROMPTS[:3])
+    client.close()
+
+    assert all(isinstance(response, TimeoutError) for response in responses)
+    assert client.stats()["timeouts"] == 4
+
+
+def test_deadline_stops_the_retries(stub_server):
+    url, behaviour = stub_server(fail_rate=1.0)
+    client = make_client(HTTPBackend(url), retries=100, backoff=0.05, deadline=0.3)
+    with pytest.raises(TimeoutError):
+        client.complete(PROMPTS[0])
+    client.close()
+
+    assert 1 < behaviour.requests < 100
+
+
+# a blocked or empty candidate has no text, it fails without a retry and is not cached.
+def test_missing_text_is_an_error():
+    fake = FakeClient(respond=lambda prompt: None)
+    client = make_client(ThreadBackend(fake), cache=LLMResponseCache(":memory:"))
+    with pytest.raises(LLMCallError):
+        client.complete(PROMPTS[0])
+
+    assert fake.models.calls == 1
+    assert client.cache.stats()["size"] == 0
+    client.close()
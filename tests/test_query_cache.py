@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pytest
+
+from query_cache import QueryEmbeddingCache
+
+# Two caches sharing one disk tier in a temporary directory, as two processes would.
+
+DIM = 8
+
+
+def vector(i):
+    return np.full(DIM, i, dtype=np.float32)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache" / "query_embeddings")
+
+
+def test_hit_from_the_other_instance(path):
+    writer = QueryEmbeddingCache("model", path=path)
+    reader = QueryEmbeddingCache("model", path=path)
+    assert reader.get("Bear movie") is None
+    writer.put("Bear movie", vector(1), 0.5)
+
+    # the same query up to case and whitespace.
+    assert np.array_equal(reader.get("  bear   MOVIE "), vector(1))
+    assert reader.stats() == {
+        "hits": 0, "disk_hits": 1, "misses": 1, "hit_rate": 0.5,
+        "size": 1, "disk_size": 1, "encode_seconds_saved": 0.5,
+    }
+    # a disk hit is promoted to memory, the next lookup does not touch the disk.
+    assert np.array_equal(reader.get("bear movie"), vector(1))
+    assert reader.stats()["hits"] == 1
+    assert reader.stats()["encode_seconds_saved"] == 1.0
+
+    # another model does not share the entry.
+    assert QueryEmbeddingCache("other", path=path).get("bear movie") is None
+
+
+def test_keys_are_written_once(path):
+    first = QueryEmbeddingCache("model", path=path)
+    second = QueryEmbeddingCache("model", path=path)
+    first.put("bear movie", vector(1), 0.5)
+    second.put("bear movie", vector(1), 0.5)
+    with open(f"{path}.keys.jsonl") as f:
+        assert len(f.readlines()) == 1
+    assert os.path.getsize(f"{path}.f32") == DIM * 4
+
+
+def test_compaction_keeps_the_newest_half(path):
+    writer = QueryEmbeddingCache("model", path=path, max_disk_size=4)
+    reader = QueryEmbeddingCache("model", path=path, max_disk_size=4)
+    writer.put("query 0", vector(0), 0.1)
+    assert np.array_equal(reader.get("query 0"), vector(0))
+    inode = os.stat(f"{path}.keys.jsonl").st_ino
+
+    # the fifth entry takes the tier past max_disk_size, it is rewritten with the newest two.
+    for i in range(1, 5):
+        writer.put(f"query {i}", vector(i), 0.1)
+    assert os.stat(f"{path}.keys.jsonl").st_ino != inode
+    assert writer.stats()["disk_size"] == 2
+    assert os.path.getsize(f"{path}.f32") == 2 * DIM * 4
+
+    # the reader read the old file, it rereads the new one at its new offsets.
+    for i in (3, 4):
+        assert np.array_equal(reader.get(f"query {i}"), vector(i))
+    assert reader.get("query 1") is None
+    assert reader.stats()["disk_size"] == 2
+
+    # and appends after the compacted entries.
+    reader.put("query 5", vector(5), 0.1)
+    assert np.array_equal(QueryEmbeddingCache("model", path=path).get("query 5"), vector(5))
+
+
+def test_line_cut_short_is_skipped(path):
+    writer = QueryEmbeddingCache("model", path=path)
+    writer.put("query 0", vector(0), 0.1)
+    # a writer that crashed in the middle of a key.
+    with open(f"{path}.keys.jsonl", "ab") as f:
+        f.write(b'{"key": "model\\u0000query 9", "off')
+
+    reader = QueryEmbeddingCache("model", path=path)
+    assert np.array_equal(reader.get("query 0"), vector(0))
+    assert reader.stats()["disk_size"] == 1
+
+    reader.put("query 1", vector(1), 0.1)
+    assert np.array_equal(QueryEmbeddingCache("model", path=path).get("query 1"), vector(1))
+    assert np.array_equal(writer.get("query 1"), vector(1))
+    assert writer.get("query 9") is None
+
+
+def test_memory_only_without_path():
+    cache = QueryEmbeddingCache("model", max_size=2)
+    for i in range(3):
+        cache.put(f"query {i}", vector(i), 0.1)
+    assert cache.get("query 0") is None
+    assert np.array_equal(cache.get("query 2"), vector(2))
+    assert cache.stats()["size"] == 2
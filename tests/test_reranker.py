@@ -0,0 +1,104 @@
+import os
+import sqlite3
+
+import pytest
+
+import reranker
+from reranker import PAIR_CACHE_PATH, CrossEncoderReranker, get_reranker
+
+# The pair score cache of the reranker, with a stub in place of the cross encoder.
+
+QUERY = "bear movie"
+
+
+class StubCrossEncoder:
+    """Scores a pair by how often the words of its query occur in its text, keeping every pair it scored."""
+
+    def __init__(self):
+        self.scored = []
+
+    def predict(self, pairs, batch_size=None):
+        self.scored.extend(pairs)
+        return [sum(text.lower().split().count(word) for word in query.split()) for query, text in pairs]
+
+
+def results(*documents):
+    return [{"id": i, "title": f"Movie {i}", "document": document} for i, document in enumerate(documents)]
+
+
+def make_reranker(path, **options):
+    instance = CrossEncoderReranker(cache_path=path, **options)
+    instance._model = StubCrossEncoder()
+    return instance
+
+
+def size(path):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COUNT(*) FROM pair_scores").fetchone()[0]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "rerank_scores.sqlite")
+
+
+def test_memory_hit(path):
+    instance = make_reranker(path)
+    first, stats = instance.rerank(QUERY, results("a bear", "a movie about a bear", "a cat"), 2)
+    assert [result["id"] for result in first] == [1, 0]
+    assert stats["scored"] == 3 and stats["batches"] == 1
+
+    # the same query up to case and whitespace.
+    second, stats = instance.rerank("  Bear MOVIE", results("a bear", "a movie about a bear", "a cat"), 2)
+    assert second == first
+    assert stats["cache_hits"] == 3 and stats["scored"] == 0
+    assert len(instance.model.scored) == 3
+
+
+def test_sqlite_hit_from_a_fresh_instance(path):
+    make_reranker(path).rerank(QUERY, results("a bear", "a cat"), 2)
+
+    instance = make_reranker(path)
+    reranked, stats = instance.rerank(QUERY, results("a bear", "a cat"), 2)
+    assert stats["cache_hits"] == 2
+    assert instance.model.scored == []
+    assert [result["cross_encoder_score"] for result in reranked] == [2, 1]
+
+
+def test_edited_document_is_scored_again(path):
+    make_reranker(path).rerank(QUERY, results("a bear", "a cat"), 2)
+
+    instance = make_reranker(path)
+    reranked, stats = instance.rerank(QUERY, results("a bear", "a bear movie"), 2)
+    assert stats["cache_hits"] == 1
+    assert instance.model.scored == [[QUERY, "Movie 1 - a bear movie"]]
+    assert [result["id"] for result in reranked] == [1, 0]
+
+
+def test_least_recently_used_are_evicted(path):
+    instance = make_reranker(path, max_entries=3)
+    instance.rerank("first query", results("a bear", "a cat"), 2)
+    instance.rerank("second query", results("a bear", "a cat"), 2)
+    assert size(path) == 3
+
+    # the pairs of the second query are the newest, and all kept.
+    _, stats = make_reranker(path).rerank("second query", results("a bear", "a cat"), 2)
+    assert stats["cache_hits"] == 2
+
+
+def test_shared_reranker_follows_the_cache_argument(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(reranker, "_reranker_instance", None)
+    instance = get_reranker(cache=True)
+    instance._model = StubCrossEncoder()
+    instance.rerank(QUERY, results("a bear"), 1)
+    assert size(PAIR_CACHE_PATH) == 1
+
+    assert get_reranker(8, cache=False) is instance
+    assert instance.batch_size == 8
+    instance.rerank(QUERY, results("a cat"), 1)
+    assert size(PAIR_CACHE_PATH) == 1
+
+    get_reranker(cache=True).rerank(QUERY, results("a dog"), 1)
+    assert size(PAIR_CACHE_PATH) == 2
+    assert os.listdir("cache") == [os.path.basename(PAIR_CACHE_PATH)]
@@ -0,0 +1,54 @@
+from nltk.stem.porter import PorterStemmer
+
+from benchmark import generate_movies
+from config import load_stop_words, table
+from transform import BATCH_SEPARATOR, Tokenizer, transform
+
+# The tokenizer against the pipeline it replaced: a stopword list and a plain PorterStemmer.
+
+TEXTS = [
+    "The Bear who came to London, and stayed!",
+    "",
+    "   ",
+    "?!... --",
+    "He's running; they're agreed: it's the runners' run.",
+    # lower() makes İ two characters, and a final Σ another letter than an inner one.
+    "İstanbul İİ ΟΔΥΣΣΕΥΣ Σ straße STRASSE ﬁnal Ǆungla",
+    "ΟΔΥΣΣΕΥΣ",
+    f"a text{BATCH_SEPARATOR}with the separator in it",
+    "Bear" + BATCH_SEPARATOR,
+]
+
+
+def reference(text, stop_words=load_stop_words(), stemmer=PorterStemmer()):
+    tokens = text.lower().translate(table).split()
+    return [stemmer.stem(word) for word in tokens if word not in stop_words]
+
+
+def movie_texts():
+    return [f"{movie['title']} {movie['description']}" for movie in generate_movies(300)]
+
+
+def test_transform_matches_reference():
+    for text in TEXTS + movie_texts():
+        assert transform(text) == reference(text)
+
+
+def test_transform_many_matches_reference():
+    texts = TEXTS[:-2] + movie_texts()
+    # a small stem cache, so stems are evicted and computed again on the way.
+    tokenizer = Tokenizer(cache_size=64)
+    assert tokenizer.transform_many(texts) == [reference(text) for text in texts]
+    assert tokenizer.cache_stats()["size"] == 64
+
+
+# a text with the separator in it sends the whole batch through transform.
+def test_transform_many_with_the_separator():
+    texts = movie_texts()[:20] + TEXTS
+    assert Tokenizer().transform_many(texts) == [reference(text) for text in texts]
+    assert Tokenizer().transform_many(iter(TEXTS[-2:])) == [reference(text) for text in TEXTS[-2:]]
+
+
+def test_transform_many_of_nothing():
+    assert Tokenizer().transform_many([]) == []
+    assert Tokenizer().transform_many([""]) == [[]]